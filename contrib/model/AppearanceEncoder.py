@@ -19,10 +19,110 @@ class AppearanceEncoder(StyleEncoder):
         self.avg_pool = nn.AdaptiveAvgPool2d((1, 1))
 
         self.app_encoding = None
+        # Input the cached app_encoding was computed from, see encode(reuse=True)
+        self.cache_key = None
+
+        # Set by optimize_for_inference
+        self.channels_last = False
+        self.frozen_model = None
+        self.freeze_pending = False
     
-    def encode(self, app_imgs):
-        app_out = self(app_imgs)
+    def encode(self, app_imgs, reuse=False):
+        """
+        :param app_imgs (N, 3, H, W) appearance images
+        :param reuse if true, skip the encoder when app_imgs is the same, unmodified
+        tensor as in the last reuse call (in the same train/eval mode). Only valid
+        for a frozen encoder; the encoding is computed without gradients.
+        """
+        if reuse:
+            key = (app_imgs, app_imgs._version, self.training)
+            if (
+                self.cache_key is not None
+                and self.cache_key[0] is key[0]
+                and self.cache_key[1:] == key[1:]
+            ):
+                return
+            with torch.no_grad():
+                self.encode(app_imgs)
+            self.cache_key = key
+            return
+        self.cache_key = None
+
+        if self.channels_last:
+            app_imgs = app_imgs.contiguous(memory_format=torch.channels_last)
+        if self.freeze_pending:
+            self._freeze(app_imgs)
+        if self.frozen_model is not None:
+            app_out = self.frozen_model(app_imgs)
+        else:
+            app_out = self(app_imgs)
         app_out = self.avg_pool(app_out)
         app_out = torch.flatten(app_out, start_dim=1)
 
         self.app_encoding = app_out
+
+    def fold_batch_norm(self):
+        """
+        Fold the BatchNorm of each Conv2dBlock into the convolution of the next block.
+        Blocks apply norm after the activation, so the norm is an affine map on the
+        next block's input; this is exact since reflect/replicate padding commutes
+        with a per-channel affine map. The last norm feeds the SE layer and is kept.
+        :return number of BatchNorm layers folded
+        """
+        assert not self.training, "BatchNorm folding requires eval mode"
+        blocks = list(self.model)
+        n_folded = 0
+        for blk, next_blk in zip(blocks[:-1], blocks[1:]):
+            if not isinstance(blk.norm, nn.BatchNorm2d) or isinstance(
+                next_blk.pad, nn.ZeroPad2d
+            ):
+                continue
+            bn = blk.norm
+            scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+            shift = bn.bias - bn.running_mean * scale
+            conv = next_blk.conv
+            with torch.no_grad():
+                # conv(scale * x + shift) = conv'(x) with the shift absorbed in the bias
+                conv.bias += (conv.weight * shift[None, :, None, None]).sum(
+                    dim=(1, 2, 3)
+                )
+                conv.weight *= scale[None, :, None, None]
+            blk.norm = None
+            n_folded += 1
+        return n_folded
+
+    def optimize_for_inference(
+        self, fold_bn=True, channels_last=True, freeze=False, example_input=None
+    ):
+        """
+        Speed up encode() for inference; output is unchanged up to float error.
+        Call after loading weights and moving to the target device.
+        The encoder can no longer be trained afterwards.
+        :param fold_bn fold BatchNorm layers into the neighbouring convolutions
+        :param channels_last run the encoder in channels-last memory format
+        :param freeze trace and freeze the encoder with TorchScript
+        :param example_input (B, 3, H, W) image batch used for tracing;
+        if not given, the first batch passed to encode() is used
+        """
+        self.eval()
+        if fold_bn:
+            self.fold_batch_norm()
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+            self.channels_last = True
+        if freeze:
+            if example_input is not None:
+                if self.channels_last:
+                    example_input = example_input.contiguous(
+                        memory_format=torch.channels_last
+                    )
+                self._freeze(example_input)
+            else:
+                self.freeze_pending = True
+        return self
+
+    def _freeze(self, example_input):
+        with torch.no_grad():
+            traced = torch.jit.trace(self, example_input)
+        self.frozen_model = torch.jit.freeze(traced)
+        self.freeze_pending = False
@@ -25,11 +25,10 @@ import util
 import numpy as np
 import torch.nn.functional as F
 import torch
+import torch.utils.checkpoint
 import tqdm
 from dotmap import DotMap
 from data.AppearanceDataset import AppearanceDataset
-from random import randint
-from torchvision.transforms.functional_tensor import crop
 
 
 def extra_args(parser):
@@ -69,6 +68,9 @@ def extra_args(parser):
     parser.add_argument(
         "--appdir", "-DA", type=str, default=None, help="Appearance Dataset directory"
     )
+    parser.add_argument(
+        "--appcache", type=str, default=None, help="Appearance image cache directory (see scripts/preproc_appearance.py)"
+    )
     parser.add_argument(
         "--appearance_format",
         "-FA",
@@ -110,7 +112,19 @@ def extra_args(parser):
         "--patch_dim", "-P", type=int, default=128, help="The H and W dimension of image patches (power of 2)"
     )
     parser.add_argument(
-        "--subpatch_factor", "-PS", type=int, default=1, help="patch_dim / subpatch_factor * 2 = subpatches rendered and composed (power of 2)"
+        "--subpatch_factor", "-PS", type=int, default=1, help="Render the patch in subpatch_factor^2 chunks, gradient-checkpointed if > 1, to bound memory"
+    )
+    parser.add_argument(
+        "--separate_app_passes",
+        action="store_true",
+        default=None,
+        help="Render the regular and appearance passes separately instead of sharing one F1 pass",
+    )
+    parser.add_argument(
+        "--ref_bank_size",
+        type=int,
+        default=256,
+        help="Number of background patches whose reference encodings are precomputed and sampled from (0 = encode a new patch every step)",
     )
     parser.add_argument(
         "--vis_step_off",
@@ -132,7 +146,9 @@ if (app_size_h is not None and app_size_w is not None):
 
 dset, val_dset, _ = get_split_dataset(args.dataset_format, args.datadir)
 if not args.app_enc_off:
-    dset_app = AppearanceDataset(args.appdir, "train", image_size=app_size, img_ind=args.app_ind)
+    dset_app = AppearanceDataset(
+        args.appdir, "train", image_size=app_size, img_ind=args.app_ind, cache_dir=args.appcache
+    )
 print(
     "dset z_near {}, z_far {}, lindisp {}".format(dset.z_near, dset.z_far, dset.lindisp)
 )
@@ -216,6 +232,24 @@ class PixelNeRF_ATrainer(trainlib.Trainer):
         self.nerf_data = dset[args.dset_ind]
         SB = args.batch_size
         NV, _, H, W = self.nerf_data["images"].shape
+
+        # All batch entries are this scene, so keep one copy on the device together
+        # with its full ray set, generated once for the whole run
+        self.scene_images = self.nerf_data["images"].to(device=device)  # (NV, 3, H, W)
+        self.scene_poses = self.nerf_data["poses"].to(device=device)  # (NV, 4, 4)
+        self.scene_bbox = self.nerf_data.get("bbox")  # (NV, 4)
+        self.scene_rays = util.gen_rays(
+            self.scene_poses,
+            W,
+            H,
+            self.nerf_data["focal"].to(device=device),
+            self.z_near,
+            self.z_far,
+            c=self.nerf_data["c"].to(device=device),
+        ).reshape(-1, 8)  # (NV*H*W, 8)
+        self.scene_rgb = (
+            (self.scene_images * 0.5 + 0.5).permute(0, 2, 3, 1).reshape(-1, 3)
+        )  # (NV*H*W, 3)
         self.nerf_data["images"] = self.nerf_data["images"].unsqueeze(0).expand(SB, NV, 3, H, W)
         self.nerf_data["poses"] = self.nerf_data["poses"].unsqueeze(0).expand(SB, NV, 4, 4)
         self.nerf_data["focal"] = self.nerf_data["focal"].unsqueeze(0).expand(SB, 2)
@@ -232,6 +266,13 @@ class PixelNeRF_ATrainer(trainlib.Trainer):
             self.patch_dim = args.patch_dim
             self.subpatch_factor = args.subpatch_factor
             self.ssh_dim = (256, 256) # Original processing resolution of SHH Encoder
+
+            # Target encodings of the reference loss, precomputed once
+            if args.ref_bank_size > 0:
+                print("Encoding", args.ref_bank_size, "background patches for the reference loss")
+                self.ref_app_crit.build_target_bank(
+                    torch.cat([self.back_patch() for _ in range(args.ref_bank_size)])
+                )
         else:
             self.appearance_img = None
         
@@ -245,167 +286,126 @@ class PixelNeRF_ATrainer(trainlib.Trainer):
         torch.save(renderer.state_dict(), self.renderer_state_path)
 
     def choose_views(self, data):
-        all_images = data["images"].to(device=device)  # (SB, NV, 3, H, W)
-        all_poses = data["poses"].to(device=device)  # (SB, NV, 4, 4)
-        SB, NV, _, _, _ = all_images.shape
-        
-        curr_nviews = nviews[torch.randint(0, len(nviews), ()).item()]
-        if curr_nviews == 1:
-            image_ord = torch.randint(0, NV, (SB, 1)).to(device=device)
-        else:
-            image_ord = torch.empty((SB, curr_nviews), dtype=torch.long).to(device=device)
-        
-        for obj_idx in range(SB):
-            if curr_nviews > 1:
-                # Somewhat inefficient, don't know better way
-                image_ord[obj_idx] = torch.from_numpy(
-                    np.random.choice(NV, curr_nviews, replace=False)
-                )
-        
-        src_images = util.batched_index_select_nd(
-            all_images, image_ord
-        )  # (SB, NS, 3, H, W)
-        src_poses = util.batched_index_select_nd(all_poses, image_ord)  # (SB, NS, 4, 4)
-
-        return src_images, src_poses
+        SB = data["images"].shape[0]
+        NV = self.scene_images.shape[0]
 
-    def encode_chosen_views(self, data, src_images, src_poses):
+        curr_nviews = nviews[torch.randint(0, len(nviews), ()).item()]
+        image_ord = util.sampler.choose_views(SB, NV, curr_nviews, device=device)
+        return image_ord  # (SB, NS)
+
+    def encode_chosen_views(self, data, image_ord):
+        """
+        Encode the chosen source views. Each distinct view goes through the encoder
+        once and its latents are shared by all batch entries that chose it.
+        :param image_ord (SB, NS) view indices, see choose_views
+        """
         all_focals = data["focal"]  # (SB)
         all_c = data.get("c")  # (SB)
 
+        views, inverse = torch.unique(image_ord, return_inverse=True)
+        net.encoder(self.scene_images[views])  # Fills net.encoder.latents per level
+        inverse = inverse.reshape(-1)
         net.encode(
-            src_images,
-            src_poses,
+            self.scene_images[image_ord],  # (SB, NS, 3, H, W)
+            self.scene_poses[image_ord],  # (SB, NS, 4, 4)
             all_focals.to(device=device),
             c=all_c.to(device=device) if all_c is not None else None,
+            latents=[latent[inverse] for latent in net.encoder.latents],
         )
 
     def rand_rays(self, data, is_train=True, global_step=0):
         if "images" not in data:
             return {}
-        all_images = data["images"].to(device=device)  # (SB, NV, 3, H, W)
-
-        SB, NV, _, H, W = all_images.shape
-        all_poses = data["poses"].to(device=device)  # (SB, NV, 4, 4)
-        all_bboxes = data.get("bbox")  # (SB, NV, 4)  cmin rmin cmax rmax
-        all_focals = data["focal"]  # (SB)
+        SB = data["images"].shape[0]
+        NV, _, H, W = self.scene_images.shape
 
         if self.use_bbox and global_step >= args.no_bbox_step:
             self.use_bbox = False
             print(">>> Stopped using bbox sampling @ iter", global_step)
 
-        if not is_train or not self.use_bbox:
-            all_bboxes = None
-
-        all_rgb_gt = []
-        all_rays = []
-
-        for obj_idx in range(SB):
-            if all_bboxes is not None:
-                bboxes = all_bboxes[obj_idx]
-            images = all_images[obj_idx]  # (NV, 3, H, W)
-            poses = all_poses[obj_idx]  # (NV, 4, 4)
-            focal = all_focals[obj_idx]
-            c = None
-            if "c" in data:
-                c = data["c"][obj_idx]
-            images_0to1 = images * 0.5 + 0.5
-
-            cam_rays = util.gen_rays(
-                poses, W, H, focal, self.z_near, self.z_far, c=c
-            )  # (NV, H, W, 8)
-            rgb_gt_all = images_0to1
-            rgb_gt_all = (
-                rgb_gt_all.permute(0, 2, 3, 1).contiguous().reshape(-1, 3)
-            )  # (NV, H, W, 3)
-
-            if all_bboxes is not None:
-                pix = util.bbox_sample(bboxes, args.ray_batch_size)
-                pix_inds = pix[..., 0] * H * W + pix[..., 1] * W + pix[..., 2]
-            else:
-                pix_inds = torch.randint(0, NV * H * W, (args.ray_batch_size,))
-
-            rgb_gt = rgb_gt_all[pix_inds]  # (ray_batch_size, 3)
-            rays = cam_rays.view(-1, cam_rays.shape[-1])[pix_inds].to(
-                device=device
-            )  # (ray_batch_size, 8)
-
-            all_rgb_gt.append(rgb_gt)
-            all_rays.append(rays)
-
-        all_rgb_gt = torch.stack(all_rgb_gt)  # (SB, ray_batch_size, 3)
-        all_rays = torch.stack(all_rays)  # (SB, ray_batch_size, 8)
+        # Draw the pixels of all SB entries at once from the cached ray set
+        bboxes = None
+        if is_train and self.use_bbox and self.scene_bbox is not None:
+            bboxes = self.scene_bbox.unsqueeze(0).expand(SB, -1, -1)
+        pix = util.sampler.sample_pixels(
+            SB, NV, H, W, args.ray_batch_size, bboxes=bboxes, device=device
+        )
+        pix_inds = pix[..., 0] * H * W + pix[..., 1] * W + pix[..., 2]
 
-        all_bboxes = all_poses = all_images = None
+        all_rgb_gt = self.scene_rgb[pix_inds].reshape(SB, -1, 3)  # (SB, ray_batch_size, 3)
+        all_rays = self.scene_rays[pix_inds].reshape(SB, -1, 8)  # (SB, ray_batch_size, 8)
 
         return all_rays, all_rgb_gt
 
     def patch_rays(self, data):
+        """
+        Rays and ground truth of one random patch_dim window per batch entry.
+        The view and window are drawn first, and only the window's rays are generated.
+        :return rays (SB, 8, P, P), rgb_gt (SB, P*P, 3)
+        """
         if "images" not in data:
             return {}
-        all_images = data["images"].to(device=device)  # (SB, NV, 3, H, W)
-
-        SB, NV, _, H, W = all_images.shape
-        all_poses = data["poses"].to(device=device)  # (SB, NV, 4, 4)
-        all_focals = data["focal"]  # (SB)
-
-        all_rgb_gt = []
-        all_rays = []
-
-        for obj_idx in range(SB):
-            images = all_images[obj_idx]  # (NV, 3, H, W)
-            poses = all_poses[obj_idx]  # (NV, 4, 4)
-            focal = all_focals[obj_idx]
-            c = None
-            if "c" in data:
-                c = data["c"][obj_idx]
-            images_0to1 = images * 0.5 + 0.5
-
-            cam_rays = util.gen_rays(
-                poses, W, H, focal, self.z_near, self.z_far, c=c
-            ).permute(0, 3, 1, 2)
-            rgb_gt_all = images_0to1
-            rgb_gt_all = (
-                rgb_gt_all.permute(0, 2, 3, 1).contiguous().reshape(-1, 3)
-            ).reshape(NV, 3, H, W)
-
-            P = self.patch_dim
-            i = randint(0, H - P)
-            j = randint(0, W - P)
-
-            rgb_gt = crop(rgb_gt_all, i, j, P, P)
-            rays = crop(cam_rays, i, j, P, P)
-
-            all_rgb_gt.append(rgb_gt)
-            all_rays.append(rays)
+        SB = data["images"].shape[0]
+        NV, _, H, W = self.scene_images.shape
+        P = self.patch_dim
 
-        all_rgb_gt = torch.stack(all_rgb_gt)  # (SB, ray_batch_size, 3)
-        all_rays = torch.stack(all_rays)  # (SB, ray_batch_size, 8)
+        views = torch.randint(0, NV, (SB,), device=device)
+        top = torch.randint(0, H - P + 1, (SB,), device=device)
+        left = torch.randint(0, W - P + 1, (SB,), device=device)
+        focal = data["focal"][0].to(device=device)
+        c = data["c"][0].to(device=device) if "c" in data else None
 
-        image_ord = torch.randint(0, NV, (SB, 1)).to(device=device)
-        all_rays = util.batched_index_select_nd(all_rays, image_ord)
-        all_rgb_gt = util.batched_index_select_nd(all_rgb_gt, image_ord).reshape(SB, -1, 3)
+        all_rays = util.gen_patch_rays(
+            self.scene_poses[views], W, H, focal, self.z_near, self.z_far, top, left, P, c=c
+        )  # (SB, P, P, 8)
 
-        all_poses = all_images = None
+        rows = top[:, None] + torch.arange(P, device=device)  # (SB, P)
+        cols = left[:, None] + torch.arange(P, device=device)  # (SB, P)
+        all_rgb_gt = self.scene_images[
+            views[:, None, None], :, rows[:, :, None], cols[:, None, :]
+        ]  # (SB, P, P, 3)
+        all_rgb_gt = all_rgb_gt.reshape(SB, -1, 3) * 0.5 + 0.5
 
-        return all_rays, all_rgb_gt
+        return all_rays.permute(0, 3, 1, 2), all_rgb_gt
 
-    def encode_back_patch(self):
+    def back_patch(self):
         P = self.patch_dim
         back_patch = util.get_random_patch(self.appearance_img, P, P)
-        back_patch = F.interpolate(back_patch, size=self.ssh_dim, mode="area")
-        self.ref_app_crit.encode_targets(back_patch)
+        return F.interpolate(back_patch, size=self.ssh_dim, mode="area")
+
+    def encode_back_patch(self):
+        if self.ref_app_crit.target_bank is not None:
+            self.ref_app_crit.sample_targets()
+        else:
+            self.ref_app_crit.encode_targets(self.back_patch())
+
+    def encode_app(self, app_imgs):
+        # A frozen appearance encoder is only run again when the image changes
+        net.app_encoder.encode(app_imgs, reuse=bool(args.freeze_app_enc))
 
     def reg_pass(self, all_rays):
         return DotMap(render_par(all_rays, want_weights=True, app_pass=False))
 
     def app_pass(self, app_imgs, all_rays):
         # Appearance encoder encoding
-        net.app_encoder.encode(app_imgs)
+        self.encode_app(app_imgs)
         render_dict = DotMap(render_par(all_rays, want_weights=True, app_pass=True))
 
         return render_dict
 
+    def dual_pass(self, app_imgs, all_rays):
+        """
+        Regular and appearance passes sharing ray samples, feature gathering and F1
+        (NeRFRenderer multi_app). Fine samples come from the average of the two
+        branches' coarse weights, so both depths are measured on the same samples.
+        :return reg render dict, app render dict
+        """
+        self.encode_app(app_imgs)
+        render_dict = render_par(
+            all_rays, want_weights=True, app_pass=False, multi_app=True
+        )
+        return util.split_multi_render_dict(render_dict, 2)
+
     def nerf_loss(self, render_dict, all_rgb_gt, loss_dict):
         # Compute our standard PixelNeRF loss
         coarse = render_dict.coarse
@@ -438,12 +438,68 @@ class PixelNeRF_ATrainer(trainlib.Trainer):
         
         return density_app_loss
 
-    def app_loss(self, src_images, subpatch_dicts, loss_dict):
-        SB, _, D, H, W = src_images.shape
+    def render_patch(self, patch_rays):
+        """
+        Appearance render of a whole patch (call after the appearance image is encoded).
+        The rays are rendered in subpatch_factor^2 chunks; when there are several and
+        gradients are needed, each chunk is checkpointed, so only its outputs are kept
+        until backward.
+        Going to assume fine network is here.
+        :param patch_rays (SB, 8, P, P) see patch_rays
+        :return DotMap coarse/fine with rgb (SB, 3, P, P), depth (SB, 1, P, P)
+        """
         P = self.patch_dim
+        rays = util.patch_to_rays(patch_rays)  # (SB, P*P, 8)
+
+        # Encoded tensors read by the render. The pinned torch 1.10 only has the
+        # reentrant checkpoint (use_reentrant=False needs torch >= 1.11), so they are
+        # explicit inputs: captured tensors with autograd history would be
+        # backpropagated into once per chunk
+        encoded = [(net.app_encoder, "app_encoding")]
+        if net.use_encoder:
+            encoded.append((net.encoder, "latent"))
+        if net.use_global_encoder:
+            encoded.append((net.global_encoder, "latent"))
+        inputs = [getattr(module, attr) for module, attr in encoded]
+
+        def render_chunk(rays_chunk, *chunk_inputs):
+            for (module, attr), value in zip(encoded, chunk_inputs):
+                setattr(module, attr, value)
+            render_dict = DotMap(render_par(rays_chunk, app_pass=True))
+            coarse, fine = render_dict.coarse, render_dict.fine
+            return coarse.rgb, coarse.depth, fine.rgb, fine.depth
+
+        use_checkpoint = self.subpatch_factor > 1 and torch.is_grad_enabled()
+        ckpt_inputs = list(inputs)
+        if use_checkpoint and not any(value.requires_grad for value in inputs):
+            # The reentrant checkpoint of torch <= 1.10 only backpropagates when an
+            # input requires grad; the gradient of this detached copy is dropped
+            ckpt_inputs[0] = inputs[0].detach().requires_grad_()
+
+        chunk_size = (rays.shape[1] - 1) // (self.subpatch_factor ** 2) + 1
+        outs = []
+        for rays_chunk in torch.split(rays, chunk_size, dim=1):
+            if use_checkpoint:
+                outs.append(
+                    torch.utils.checkpoint.checkpoint(
+                        render_chunk, rays_chunk, *ckpt_inputs
+                    )
+                )
+            else:
+                outs.append(render_chunk(rays_chunk, *inputs))
+        for (module, attr), value in zip(encoded, inputs):
+            setattr(module, attr, value)
+        coarse_rgb, coarse_depth, fine_rgb, fine_depth = [
+            util.rays_to_patch(torch.cat(vals, dim=1), P) for vals in zip(*outs)
+        ]
+        return DotMap(
+            coarse=DotMap(rgb=coarse_rgb, depth=coarse_depth),
+            fine=DotMap(rgb=fine_rgb, depth=fine_depth),
+        )
 
-        # Going to assume fine network is here. If its an issue, change later.
-        coarse_app_rgb, fine_app_rgb = util.recompose_subpatch_render_dicts_rgb(subpatch_dicts, SB, P, self.subpatch_factor)
+    def app_loss(self, patch_dict, loss_dict):
+        coarse_app_rgb = patch_dict.coarse.rgb
+        fine_app_rgb = patch_dict.fine.rgb
 
         app_rgb_coarse = util.ssh_normalization(coarse_app_rgb)
         app_rgb_coarse = F.interpolate(app_rgb_coarse, size=self.ssh_dim, mode="area")
@@ -460,10 +516,10 @@ class PixelNeRF_ATrainer(trainlib.Trainer):
 
     def calc_losses_no_app(self, data, app_data, is_train=True, global_step=0):
         # Establish the views we'll be using to train
-        src_images, src_poses = self.choose_views(data)
+        image_ord = self.choose_views(data)
 
         # Encode our chosen views
-        self.encode_chosen_views(data, src_images, src_poses)
+        self.encode_chosen_views(data, image_ord)
 
         # Choose our standard randomly-smapled rays for our regular pass
         nerf_rays, nerf_rays_gt = self.rand_rays(data, is_train, global_step)
@@ -483,23 +539,27 @@ class PixelNeRF_ATrainer(trainlib.Trainer):
 
     def calc_losses_app(self, data, app_data, is_train=True, global_step=0):
         # Establish the views we'll be using to train
-        src_images, src_poses = self.choose_views(data)
+        image_ord = self.choose_views(data)
 
         # Encode our chosen views
-        self.encode_chosen_views(data, src_images, src_poses)
+        self.encode_chosen_views(data, image_ord)
 
         # Choose our standard randomly-smapled rays for our regular pass
         nerf_rays, nerf_rays_gt = self.rand_rays(data, is_train, global_step)
 
-        # Render out our scene with our ground truth model
-        reg_render_dict = self.reg_pass(nerf_rays)
+        if args.separate_app_passes:
+            # Render out our scene with our ground truth model
+            reg_render_dict = self.reg_pass(nerf_rays)
+
+            # Render out our scene using appearance encoding and trainable F2
+            app_render_dict = self.app_pass(app_data, nerf_rays)
+        else:
+            # Both at once, sharing samples and F1
+            reg_render_dict, app_render_dict = self.dual_pass(app_data, nerf_rays)
 
         # Encode a random patch from the background image
         self.encode_back_patch()
 
-        # Render out our scene using appearance encoding and trainable F2
-        app_render_dict = self.app_pass(app_data, nerf_rays)
-
         loss_dict = {}
         
         # Compute our standard NeRF losses and losses associated with appearance encoder
@@ -512,19 +572,11 @@ class PixelNeRF_ATrainer(trainlib.Trainer):
         # Choose rays corresponding to an image patch at our disposal
         patch_rays, _ = self.patch_rays(data)
 
-        # Decompose this patch into smaller subpatches
-        subpatch_rays = util.decompose_to_subpatches(patch_rays, self.subpatch_factor)
-
-        # Render out these subpatches
-        subpatch_dicts = []
-        for i in range(self.subpatch_factor):
-            row = []
-            for j in range(self.subpatch_factor):
-                row.append(self.app_pass(app_data, subpatch_rays[i][j]))
-            subpatch_dicts.append(row)
+        # Render out this patch, reusing the appearance encoding from above
+        patch_dict = self.render_patch(patch_rays)
 
-        # Compute our appearance loss using our appearance encoder and these subpatches
-        app_loss = self.app_loss(src_images, subpatch_dicts, loss_dict)
+        # Compute our appearance loss using our appearance encoder and this patch
+        app_loss = self.app_loss(patch_dict, loss_dict)
 
         # Compute our standard NeRF loss
         loss = nerf_loss + depth_loss + app_loss
@@ -593,7 +645,7 @@ class PixelNeRF_ATrainer(trainlib.Trainer):
                 c=c.to(device=device) if c is not None else None,
             )
             if self.app_enc_on:
-                net.app_encoder.encode(app_images)
+                self.encode_app(app_images)
             test_rays = test_rays.reshape(1, H * W, -1)
             render_dict = DotMap(render_par(test_rays, want_weights=True))
             coarse = render_dict.coarse
@@ -0,0 +1,154 @@
+"""
+Bake the encoded source view(s) of one object into a block-sparse voxel grid
+with SH colour (render.BakedGrid) for fast viewing, then compare one novel
+view rendered from the grid against the full NeRF renderer.
+
+python bake_scene.py -n <expname> -c <conf> -D <datadir> -S <subset> -P "<views>" \
+    -O scene.bake --bound 1.0 --resolution 128
+"""
+import sys
+import os
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+import time
+import torch
+import util
+from data import get_split_dataset
+from model import make_model
+from render import NeRFRenderer, BakedGrid
+
+
+def extra_args(parser):
+    parser.add_argument(
+        "--subset", "-S", type=int, default=0, help="Subset in data to use"
+    )
+    parser.add_argument(
+        "--split",
+        type=str,
+        default="test",
+        help="Split of data to use train | val | test",
+    )
+    parser.add_argument(
+        "--source", "-P", type=str, default="64", help="Source view(s) in image"
+    )
+    parser.add_argument(
+        "--output", "-O", type=str, required=True, help="Output baked scene file"
+    )
+    parser.add_argument(
+        "--bound", type=float, default=1.0, help="Half extent of the baked cube"
+    )
+    parser.add_argument(
+        "--center",
+        type=str,
+        default="0 0 0",
+        help="Center of the baked cube (space delimited)",
+    )
+    parser.add_argument(
+        "--resolution", type=int, default=128, help="Voxels per axis"
+    )
+    parser.add_argument("--block_size", type=int, default=8, help="Voxels per block axis")
+    parser.add_argument(
+        "--alpha_thresh",
+        type=float,
+        default=0.01,
+        help="Opacity per voxel below which space is considered empty",
+    )
+    parser.add_argument(
+        "--sh_degree", type=int, default=2, help="SH degree of the colour (0-2)"
+    )
+    parser.add_argument(
+        "--n_dirs", type=int, default=16, help="View directions for the SH fit"
+    )
+    return parser
+
+
+args, conf = util.args.parse_args(extra_args, default_ray_batch_size=50000)
+args.resume = True
+
+device = util.get_cuda(args.gpu_id[0])
+
+dset = get_split_dataset(
+    args.dataset_format, args.datadir, want_split=args.split, training=False
+)
+data = dset[args.subset]
+print("Data instance loaded:", data["path"])
+
+images = data["images"]  # (NV, 3, H, W)
+poses = data["poses"]  # (NV, 4, 4)
+NV, _, H, W = images.shape
+focal = data["focal"]
+if isinstance(focal, float):
+    focal = torch.tensor(focal, dtype=torch.float32)
+focal = focal[None].to(device=device)
+c = data.get("c")
+if c is not None:
+    c = c.to(device=device).unsqueeze(0)
+
+source = torch.tensor(list(map(int, args.source.split())), dtype=torch.long)
+
+net = make_model(conf["model"]).to(device=device).load_weights(args).eval()
+renderer = NeRFRenderer.from_conf(
+    conf["renderer"], lindisp=dset.lindisp, eval_batch_size=args.ray_batch_size
+).to(device=device)
+render_par = renderer.bind_parallel(net, args.gpu_id, simple_output=True).eval()
+
+with torch.no_grad():
+    net.encode(
+        images[source].unsqueeze(0).to(device=device),
+        poses[source].unsqueeze(0).to(device=device),
+        focal,
+        c=c,
+    )
+    t0 = time.perf_counter()
+    grid = BakedGrid.bake(
+        net,
+        bound=args.bound,
+        center=tuple(map(float, args.center.split())),
+        resolution=args.resolution,
+        block_size=args.block_size,
+        alpha_thresh=args.alpha_thresh,
+        sh_degree=args.sh_degree,
+        n_dirs=args.n_dirs,
+        coarse=net.mlp_fine is None,
+        chunk=args.ray_batch_size,
+    )
+    print("Baked in", time.perf_counter() - t0, "s")
+    grid.save(args.output)
+    print("Wrote baked scene to", args.output, os.path.getsize(args.output), "bytes")
+
+    # Compare on the first non-source view
+    target = next(i for i in range(NV) if i not in source.tolist())
+    rays = util.gen_rays(
+        poses[target : target + 1].to(device=device),
+        W,
+        H,
+        focal,
+        dset.z_near,
+        dset.z_far,
+        c=c,
+    ).reshape(-1, 8)
+    gt = (images[target].permute(1, 2, 0) * 0.5 + 0.5).numpy()
+
+    def timed(fn):
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        t0 = time.perf_counter()
+        out = fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        return out, time.perf_counter() - t0
+
+    def render_nerf():
+        rgbs = [render_par(r[None])[0][0] for r in torch.split(rays, args.ray_batch_size)]
+        return torch.cat(rgbs)
+
+    rgb_nerf, t_nerf = timed(render_nerf)
+    (rgb_baked, _depth), t_baked = timed(
+        lambda: grid.render(rays, white_bkgd=renderer.white_bkgd)
+    )
+    for name, rgb, t in [("nerf", rgb_nerf, t_nerf), ("baked", rgb_baked, t_baked)]:
+        rgb = rgb.clamp(0.0, 1.0).reshape(H, W, 3).cpu().numpy()
+        print(name, "ms", t * 1000.0, "psnr", util.psnr(rgb, gt))
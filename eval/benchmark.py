@@ -0,0 +1,299 @@
+"""
+Latency / quality benchmark. Reports encoder latency, rendering throughput (rays/s)
+and PSNR/SSIM of one novel view for the first few objects of a split.
+With --quantize, also reports the PSNR/SSIM delta and rays/s speedup of
+dynamically int8-quantized MLPs against fp32 (CPU only).
+
+python benchmark.py -n <expname> -c <conf> -D <datadir> --num_objs 10 \
+    --backbones "resnet34 mobilenet_v3_large efficientnet_b0"
+
+--backbones times untrained encoder variants (latency only) at the same input size.
+--mlp_confs times the (coarse) point network of untrained config variants, e.g.
+    --mlp_confs "conf/exp/srn.conf conf/exp/srn_hashgrid.conf"
+"""
+import sys
+import os
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+import time
+import copy
+import torch
+import torch.nn.functional as F
+import numpy as np
+import skimage.measure
+import util
+from data import get_split_dataset
+from model import make_model
+from model.encoder import SpatialEncoder
+from render import NeRFRenderer
+from pyhocon import ConfigFactory
+
+
+def extra_args(parser):
+    parser.add_argument(
+        "--split",
+        type=str,
+        default="test",
+        help="Split of data to use train | val | test",
+    )
+    parser.add_argument(
+        "--source", "-P", type=str, default="2", help="Source view(s) for each object"
+    )
+    parser.add_argument(
+        "--num_objs", type=int, default=10, help="Number of objects to evaluate"
+    )
+    parser.add_argument(
+        "--n_iters", type=int, default=20, help="Timed iterations for encoder latency"
+    )
+    parser.add_argument(
+        "--backbones",
+        type=str,
+        default="",
+        help="Space delimited encoder backbones to time (untrained, latency only)",
+    )
+    parser.add_argument(
+        "--mlp_confs",
+        type=str,
+        default="",
+        help="Space delimited configs whose point network to time (untrained, latency only)",
+    )
+    parser.add_argument(
+        "--mlp_points",
+        type=int,
+        default=65536,
+        help="Number of points per timed point network evaluation",
+    )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Compare against dynamic int8 quantized MLPs (CPU only)",
+    )
+    parser.add_argument(
+        "--optimize_encoder",
+        action="store_true",
+        help="Fold BatchNorm and use channels-last memory format in the encoder(s)",
+    )
+    parser.add_argument(
+        "--freeze_encoder",
+        action="store_true",
+        help="With --optimize_encoder, also freeze the encoder(s) with TorchScript",
+    )
+    return parser
+
+
+def timed(fn, device, n_iters=1):
+    """
+    Average wall time of fn() in seconds, synchronizing CUDA if needed
+    """
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    t0 = time.perf_counter()
+    for _ in range(n_iters):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - t0) / n_iters
+
+
+def time_mlp(model, src_images, src_poses, focal, c):
+    """
+    Points per second of model.forward (coarse) after encoding the given views
+    """
+    model.encode(src_images, src_poses, focal, c=c)
+    xyz = torch.rand(1, args.mlp_points, 3, device=device) * 2.0 - 1.0
+    viewdirs = F.normalize(torch.randn_like(xyz), dim=-1)
+    model(xyz, coarse=True, viewdirs=viewdirs)  # Warm up
+    t = timed(lambda: model(xyz, coarse=True, viewdirs=viewdirs), device, args.n_iters)
+    return args.mlp_points / t
+
+
+args, conf = util.args.parse_args(
+    extra_args, default_conf="conf/exp/sn64.conf", default_expname="sn64",
+)
+args.resume = True
+
+device = util.get_cuda(args.gpu_id[0])
+
+dset = get_split_dataset(
+    args.dataset_format, args.datadir, want_split=args.split, training=False
+)
+
+net = make_model(conf["model"]).to(device=device).load_weights(args)
+if args.optimize_encoder:
+    net.optimize_for_inference(freeze=args.freeze_encoder)
+net.eval()
+renderer = NeRFRenderer.from_conf(
+    conf["renderer"], lindisp=dset.lindisp, eval_batch_size=args.ray_batch_size
+).to(device=device)
+render_par = renderer.bind_parallel(net, args.gpu_id, simple_output=True).eval()
+if args.quantize:
+    qnet = copy.deepcopy(net).quantize_mlps()
+    qrender_par = renderer.bind_parallel(qnet, args.gpu_id, simple_output=True).eval()
+
+source = torch.tensor(list(map(int, args.source.split())), dtype=torch.long)
+z_near, z_far = dset.z_near, dset.z_far
+
+
+def render_view(rays, render_par, H, W):
+    """
+    Render rays, return (H, W, 3) rgb and rays/s
+    """
+    all_rgb = []
+
+    def render():
+        all_rgb.clear()
+        for rays_batch in torch.split(rays, args.ray_batch_size, dim=0):
+            rgb, _depth = render_par(rays_batch[None])
+            all_rgb.append(rgb[0])
+
+    rate = rays.shape[0] / timed(render, device)
+    return torch.cat(all_rgb).clamp(0.0, 1.0).reshape(H, W, 3), rate
+
+
+def compare(rgb, rgb_gt):
+    rgb, rgb_gt = rgb.cpu().numpy(), rgb_gt.numpy()
+    psnr = skimage.measure.compare_psnr(rgb, rgb_gt, data_range=1)
+    ssim = skimage.measure.compare_ssim(
+        rgb, rgb_gt, multichannel=True, data_range=1
+    )
+    return psnr, ssim
+
+
+encode_times, ray_rates, psnrs, ssims = [], [], [], []
+q_ray_rates, q_psnrs, q_ssims = [], [], []
+num_objs = min(args.num_objs, len(dset))
+with torch.no_grad():
+    for obj_idx in range(num_objs):
+        data = dset[obj_idx]
+        images = data["images"]  # (NV, 3, H, W)
+        poses = data["poses"]  # (NV, 4, 4)
+        NV, _, H, W = images.shape
+        assert source.max().item() < NV, "Source view out of range, object has {} views".format(NV)
+        focal = data["focal"]
+        if isinstance(focal, float):
+            focal = torch.tensor(focal, dtype=torch.float32)
+        focal = focal[None].to(device=device)
+        c = data.get("c")
+        if c is not None:
+            c = c.to(device=device).unsqueeze(0)
+
+        src_images = images[source].to(device=device).unsqueeze(0)
+        src_poses = poses[source].to(device=device).unsqueeze(0)
+
+        def encode():
+            net.encode(src_images, src_poses, focal, c=c)
+
+        encode()  # Warm up
+        encode_times.append(timed(encode, device, args.n_iters))
+
+        # Render the first non-source view
+        target = next(i for i in range(NV) if i not in source.tolist())
+        rays = util.gen_rays(
+            poses[target : target + 1].to(device=device),
+            W,
+            H,
+            focal,
+            z_near,
+            z_far,
+            c=c,
+        ).reshape(-1, 8)
+        rgb_gt = images[target].permute(1, 2, 0) * 0.5 + 0.5
+
+        rgb, rate = render_view(rays, render_par, H, W)
+        psnr, ssim = compare(rgb, rgb_gt)
+        ray_rates.append(rate)
+        psnrs.append(psnr)
+        ssims.append(ssim)
+        print(
+            "obj",
+            obj_idx,
+            "encode ms",
+            encode_times[-1] * 1000.0,
+            "rays/s",
+            rate,
+            "psnr",
+            psnr,
+            "ssim",
+            ssim,
+        )
+
+        if args.quantize:
+            qnet.encode(src_images, src_poses, focal, c=c)
+            rgb, rate = render_view(rays, qrender_par, H, W)
+            psnr, ssim = compare(rgb, rgb_gt)
+            q_ray_rates.append(rate)
+            q_psnrs.append(psnr)
+            q_ssims.append(ssim)
+            print("  int8 rays/s", rate, "psnr", psnr, "ssim", ssim)
+
+with torch.no_grad():
+    mlp_rate = time_mlp(net, src_images, src_poses, focal, c)
+
+print("backbone", conf.get_string("model.encoder.backbone"))
+print("mean encode ms", np.mean(encode_times) * 1000.0)
+print("point network points/s", mlp_rate)
+print("mean rays/s", np.mean(ray_rates))
+print("mean psnr", np.mean(psnrs), "ssim", np.mean(ssims))
+if args.quantize:
+    print(
+        "int8 mean rays/s",
+        np.mean(q_ray_rates),
+        "speedup",
+        np.mean(q_ray_rates) / np.mean(ray_rates),
+    )
+    print(
+        "int8 psnr delta",
+        np.mean(q_psnrs) - np.mean(psnrs),
+        "ssim delta",
+        np.mean(q_ssims) - np.mean(ssims),
+    )
+
+if len(args.backbones) > 0:
+    print("Encoder latency at input size", tuple(src_images.shape[-2:]))
+    print("(untrained weights: latency only, says nothing about quality)")
+    x = src_images.reshape(-1, *src_images.shape[-3:])
+    for backbone in args.backbones.split():
+        enc_conf = conf["model"]["encoder"]
+        encoder = SpatialEncoder(
+            backbone,
+            pretrained=False,
+            num_layers=enc_conf.get_int("num_layers", 4),
+            use_first_pool=enc_conf.get_bool("use_first_pool", True),
+        ).to(device=device)
+        encoder.eval()
+        if args.optimize_encoder:
+            encoder.optimize_for_inference(freeze=args.freeze_encoder)
+        with torch.no_grad():
+            encoder(x)  # Warm up
+            t = timed(lambda: encoder(x), device, args.n_iters)
+        print(
+            backbone,
+            "latent_size",
+            encoder.latent_size,
+            "encode ms",
+            t * 1000.0,
+        )
+
+if len(args.mlp_confs) > 0:
+    print("Point network throughput,", args.mlp_points, "points per call")
+    print("(untrained weights: throughput only, says nothing about quality)")
+    for conf_path in args.mlp_confs.split():
+        model_conf = ConfigFactory.parse_file(conf_path)["model"]
+        model_conf.put("encoder.pretrained", False)
+        model = make_model(model_conf).to(device=device).eval()
+        with torch.no_grad():
+            rate = time_mlp(model, src_images, src_poses, focal, c)
+        print(
+            conf_path,
+            "code",
+            model_conf.get_string("code.type", "positional"),
+            "d_hidden",
+            model_conf.get_int("mlp_coarse.d_hidden"),
+            "params",
+            util.count_parameters(model),
+            "points/s",
+            rate,
+        )
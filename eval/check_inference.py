@@ -0,0 +1,96 @@
+"""
+Parity and speed check of the scripted / frozen / compiled inference graph
+(model.inference.PixelNeRFInference) against PixelNeRFNet.forward.
+Uses random source images and query points, so no dataset is needed.
+
+python check_inference.py -n <expname> -c <conf> [--compile]
+Exits with an error if any variant differs by more than --tol.
+"""
+import sys
+import os
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+import time
+import torch
+import torch.nn.functional as F
+import util
+from model import make_model
+from model.inference import PixelNeRFInference, scene_inputs, freeze_inference
+
+
+def extra_args(parser):
+    parser.add_argument(
+        "--num_views", "-V", type=int, default=2, help="Number of source views (NS)"
+    )
+    parser.add_argument("--size", type=int, default=128, help="Source image size")
+    parser.add_argument(
+        "--num_points", type=int, default=8192, help="Query points per object"
+    )
+    parser.add_argument("--n_iters", type=int, default=10, help="Timed iterations")
+    parser.add_argument(
+        "--compile", action="store_true", help="Also check torch.compile (PyTorch 2)"
+    )
+    parser.add_argument(
+        "--tol", type=float, default=1e-4, help="Max allowed absolute difference"
+    )
+    return parser
+
+
+args, conf = util.args.parse_args(extra_args)
+args.resume = True
+device = util.get_cuda(args.gpu_id[0])
+
+net = make_model(conf["model"]).to(device=device).load_weights(args).eval()
+
+torch.manual_seed(0)
+NS = args.num_views
+images = torch.rand(1, NS, 3, args.size, args.size, device=device) * 2.0 - 1.0
+poses = torch.eye(4, device=device).repeat(1, NS, 1, 1)
+poses[..., 2, 3] = 1.5
+focal = torch.tensor(args.size * 1.2, device=device)
+xyz = (torch.rand(1, args.num_points, 3, device=device) - 0.5) * 0.8
+viewdirs = F.normalize(torch.randn_like(xyz), dim=-1)
+
+
+def timed(fn):
+    fn()  # Warm up
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    t0 = time.perf_counter()
+    for _ in range(args.n_iters):
+        out = fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return out, (time.perf_counter() - t0) / args.n_iters
+
+
+failed = False
+with torch.no_grad():
+    net.encode(images, poses, focal)
+    inputs = scene_inputs(net)
+    for coarse in [True, False]:
+        if not coarse and net.mlp_fine is None:
+            continue
+        ref, t_ref = timed(lambda: net(xyz, coarse=coarse, viewdirs=viewdirs))
+        variants = {
+            "functional": PixelNeRFInference(net, coarse=coarse).eval(),
+            "scripted": torch.jit.script(PixelNeRFInference(net, coarse=coarse).eval()),
+            "frozen": freeze_inference(net, coarse=coarse),
+        }
+        if args.compile:
+            variants["compiled"] = torch.compile(
+                PixelNeRFInference(net, coarse=coarse).eval()
+            )
+        print("coarse" if coarse else "fine", "eager ms", t_ref * 1000.0)
+        for name, module in variants.items():
+            out, t = timed(lambda: module(xyz, viewdirs, *inputs))
+            err = (out - ref).abs().max().item()
+            failed = failed or err > args.tol
+            print("  {:10} max abs diff {:.3e} ms {:.3f}".format(name, err, t * 1000.0))
+
+if failed:
+    sys.exit("Parity check FAILED (tolerance {})".format(args.tol))
+print("Parity check passed")
@@ -18,6 +18,8 @@ import util
 from data import get_split_dataset
 from model import make_model
 from render import NeRFRenderer
+from render.upsample import render_batched, render_upsampled
+from render.reproject import reproject_source
 import cv2
 import tqdm
 import ipdb
@@ -85,6 +87,27 @@ def extra_args(parser):
         action="store_true",
         help="Set to indicate poses may change between objects. In most of our datasets, the test set has fixed poses.",
     )
+    parser.add_argument(
+        "--optimize_encoder",
+        action="store_true",
+        help="Fold BatchNorm and use channels-last memory format in the encoder(s)",
+    )
+    parser.add_argument(
+        "--freeze_encoder",
+        action="store_true",
+        help="With --optimize_encoder, also freeze the encoder(s) with TorchScript",
+    )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Dynamic int8 quantization of the MLPs (CPU only)",
+    )
+    parser.add_argument(
+        "--upsample",
+        type=int,
+        default=1,
+        help="Render every n-th pixel, upsample guided by depth and the reprojected source view, and re-render pixels at depth edges",
+    )
     return parser
 
 
@@ -133,6 +156,10 @@ if has_output:
 
 
 net = make_model(conf["model"]).to(device=device).load_weights(args)
+if args.optimize_encoder:
+    net.optimize_for_inference(freeze=args.freeze_encoder)
+if args.quantize:
+    net.quantize_mlps()
 renderer = NeRFRenderer.from_conf(
     conf["renderer"], lindisp=dset.lindisp, eval_batch_size=args.ray_batch_size
 ).to(device=device)
@@ -273,12 +300,27 @@ with torch.no_grad():
         )
 
         all_rgb, all_depth = [], []
-        for rays in tqdm.tqdm(rays_spl):
-            rgb, depth = render_par(rays[None])
-            rgb = rgb[0].cpu()
-            depth = depth[0].cpu()
-            all_rgb.append(rgb)
-            all_depth.append(depth)
+        if args.upsample > 1:
+            # Guide with the first source view (unscaled intrinsics)
+            src_image = images[src_view_mask][0].to(device=device) * 0.5 + 0.5
+            for view_rays in tqdm.tqdm(all_rays.reshape(n_gen_views, H, W, 8)):
+                rgb, depth, _ = render_upsampled(
+                    lambda rays: render_batched(render_par, rays, args.ray_batch_size),
+                    view_rays,
+                    args.upsample,
+                    guide_fn=lambda depth: reproject_source(
+                        src_image, src_poses[0], focal, view_rays, depth, c=c
+                    ),
+                )
+                all_rgb.append(rgb.reshape(-1, 3).cpu())
+                all_depth.append(depth.reshape(-1).cpu())
+        else:
+            for rays in tqdm.tqdm(rays_spl):
+                rgb, depth = render_par(rays[None])
+                rgb = rgb[0].cpu()
+                depth = depth[0].cpu()
+                all_rgb.append(rgb)
+                all_depth.append(depth)
 
         all_rgb = torch.cat(all_rgb, dim=0)
         all_depth = torch.cat(all_depth, dim=0)
@@ -12,6 +12,8 @@ import torch
 import numpy as np
 from model import make_model
 from render import NeRFRenderer
+from render.upsample import render_batched, render_upsampled
+from render.reproject import reproject_source
 import torchvision.transforms as T
 import tqdm
 import imageio
@@ -67,6 +69,27 @@ def extra_args(parser):
         action="store_true",
         help="Do not store video (only image frames will be written)",
     )
+    parser.add_argument(
+        "--optimize_encoder",
+        action="store_true",
+        help="Fold BatchNorm and use channels-last memory format in the encoder(s)",
+    )
+    parser.add_argument(
+        "--freeze_encoder",
+        action="store_true",
+        help="With --optimize_encoder, also freeze the encoder(s) with TorchScript",
+    )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Dynamic int8 quantization of the MLPs (CPU only)",
+    )
+    parser.add_argument(
+        "--upsample",
+        type=int,
+        default=1,
+        help="Render every n-th pixel, upsample guided by depth and the reprojected source view, and re-render pixels at depth edges",
+    )
     return parser
 
 
@@ -77,6 +100,10 @@ args.resume = True
 
 device = util.get_cuda(args.gpu_id[0])
 net = make_model(conf["model"]).to(device=device).load_weights(args)
+if args.optimize_encoder:
+    net.optimize_for_inference(freeze=args.freeze_encoder)
+if args.quantize:
+    net.quantize_mlps()
 renderer = NeRFRenderer.from_conf(
     conf["renderer"], eval_batch_size=args.ray_batch_size
 ).to(device=device)
@@ -143,9 +170,21 @@ with torch.no_grad():
         )
         print("Rendering", args.num_views * H * W, "rays")
         all_rgb_fine = []
-        for rays in tqdm.tqdm(torch.split(render_rays.view(-1, 8), 80000, dim=0)):
-            rgb, _depth = render_par(rays[None])
-            all_rgb_fine.append(rgb[0])
+        if args.upsample > 1:
+            for view_rays in tqdm.tqdm(render_rays):
+                rgb, _depth, _ = render_upsampled(
+                    lambda rays: render_batched(render_par, rays, 80000),
+                    view_rays,
+                    args.upsample,
+                    guide_fn=lambda depth: reproject_source(
+                        image * 0.5 + 0.5, cam_pose, focal, view_rays, depth
+                    ),
+                )
+                all_rgb_fine.append(rgb.reshape(-1, 3))
+        else:
+            for rays in tqdm.tqdm(torch.split(render_rays.view(-1, 8), 80000, dim=0)):
+                rgb, _depth = render_par(rays[None])
+                all_rgb_fine.append(rgb[0])
         _depth = None
         rgb_fine = torch.cat(all_rgb_fine)
         frames = (rgb_fine.view(args.num_views, H, W, 3).cpu().numpy() * 255).astype(
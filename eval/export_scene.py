@@ -0,0 +1,95 @@
+"""
+Encode the source view(s) of one object and save the encoded scene to a single file,
+which can later be rendered without the source images or the image encoder
+(e.g. gen_video.py --encoded <file>).
+
+python export_scene.py -n <expname> -c <conf> -D <datadir> -S <subset> -P "<views>" \
+    -O scene.pnrf [--quantize]
+"""
+import sys
+import os
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+import torch
+import util
+from data import get_split_dataset
+from data.AppearanceDataset import AppearanceDataset
+from model import make_model
+
+
+def extra_args(parser):
+    parser.add_argument(
+        "--subset", "-S", type=int, default=0, help="Subset in data to use"
+    )
+    parser.add_argument(
+        "--split",
+        type=str,
+        default="test",
+        help="Split of data to use train | val | test",
+    )
+    parser.add_argument(
+        "--source", "-P", type=str, default="64", help="Source view(s) in image"
+    )
+    parser.add_argument(
+        "--output", "-O", type=str, required=True, help="Output encoded scene file"
+    )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Store the latent as uint8 with per-channel ranges instead of fp16",
+    )
+    parser.add_argument(
+        "--appdir", "-DA", type=str, default=None, help="Appearance Dataset directory"
+    )
+    parser.add_argument(
+        "--app_ind", "-IA", type=int, default=0, help="Index of image to be used for appearance harmonization"
+    )
+    return parser
+
+
+args, conf = util.args.parse_args(extra_args)
+args.resume = True
+
+device = util.get_cuda(args.gpu_id[0])
+
+dset = get_split_dataset(
+    args.dataset_format, args.datadir, want_split=args.split, training=False
+)
+data = dset[args.subset]
+print("Data instance loaded:", data["path"])
+
+images = data["images"]  # (NV, 3, H, W)
+poses = data["poses"]  # (NV, 4, 4)
+focal = data["focal"]
+if isinstance(focal, float):
+    focal = torch.tensor(focal, dtype=torch.float32)
+focal = focal[None].to(device=device)
+c = data.get("c")
+if c is not None:
+    c = c.to(device=device).unsqueeze(0)
+
+source = torch.tensor(list(map(int, args.source.split())), dtype=torch.long)
+
+net = make_model(conf["model"]).to(device=device)
+net.load_weights(args)
+net.eval()
+
+with torch.no_grad():
+    if getattr(net, "app_enc_on", False) and args.appdir is not None:
+        dset_app = AppearanceDataset(
+            args.appdir, "train", image_size=None, img_ind=args.app_ind
+        )
+        app_imgs = dset_app[args.app_ind]["images"].unsqueeze(0).to(device=device)
+        net.app_encoder.encode(app_imgs)
+    net.encode(
+        images[source].unsqueeze(0).to(device=device),
+        poses[source].unsqueeze(0).to(device=device),
+        focal,
+        c=c,
+    )
+    net.export_encoded(args.output, quantize=args.quantize)
+
+print("Wrote encoded scene to", args.output, os.path.getsize(args.output), "bytes")
@@ -13,6 +13,8 @@ import util
 import warnings
 from data import get_split_dataset
 from render import NeRFRenderer
+from render.upsample import render_batched, render_upsampled
+from render.reproject import reproject_source, splat_depth, fill_holes
 from model import make_model
 from scipy.interpolate import CubicSpline
 import tqdm
@@ -71,6 +73,51 @@ def extra_args(parser):
         default=None,
         help="Load an appearance encoder's weights",
     )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Dynamic int8 quantization of the MLPs (CPU only)",
+    )
+    parser.add_argument(
+        "--encoded",
+        type=str,
+        default=None,
+        help="Render from an encoded scene file (eval/export_scene.py) instead of encoding the source view(s)",
+    )
+    parser.add_argument(
+        "--surface",
+        action="store_true",
+        help="Fast preview: shade only the first density crossing (renderer surface mode)",
+    )
+    parser.add_argument(
+        "--upsample",
+        type=int,
+        default=1,
+        help="Render every n-th pixel, upsample guided by depth and the reprojected source view, and re-render pixels at depth edges",
+    )
+    parser.add_argument(
+        "--temporal",
+        action="store_true",
+        help="Reuse the previous frame's depth: pixels it covers are rendered with few samples in a tight near/far range",
+    )
+    parser.add_argument(
+        "--temporal_samples",
+        type=int,
+        default=16,
+        help="Coarse and fine samples per ray for pixels covered by the previous frame",
+    )
+    parser.add_argument(
+        "--temporal_margin",
+        type=float,
+        default=0.05,
+        help="Half width of the tightened near/far range, relative to z_far - z_near",
+    )
+    parser.add_argument(
+        "--keyframe",
+        type=int,
+        default=10,
+        help="With --temporal, fully render every n-th frame to avoid drift",
+    )
     return parser
 
 
@@ -116,10 +163,13 @@ if args.scale != 1.0:
 
 net = make_model(conf["model"]).to(device=device)
 net.load_weights(args)
+if args.quantize:
+    net.quantize_mlps()
 
 renderer = NeRFRenderer.from_conf(
     conf["renderer"], lindisp=dset.lindisp, eval_batch_size=args.ray_batch_size,
 ).to(device=device)
+renderer.surface = renderer.surface or args.surface
 
 render_par = renderer.bind_parallel(net, args.gpu_id, simple_output=True).eval()
 
@@ -136,8 +186,9 @@ print("Generating rays")
 #     app_size = (app_size_h, app_size_w)
 dtu_format = hasattr(dset, "sub_format") and dset.sub_format == "dtu"
 
-dset_app = AppearanceDataset(args.appdir, "train", image_size=None, img_ind=args.app_ind)
-app_imgs = dset_app[args.app_ind]["images"].unsqueeze(0).to(device=device)
+if args.encoded is None:
+    dset_app = AppearanceDataset(args.appdir, "train", image_size=None, img_ind=args.app_ind)
+    app_imgs = dset_app[args.app_ind]["images"].unsqueeze(0).to(device=device)
 
 if dtu_format:
     print("Using DTU camera trajectory")
@@ -216,6 +267,79 @@ if renderer.n_coarse < 64:
     renderer.n_coarse = 64
     renderer.n_fine = 128
 
+assert not (
+    args.temporal and args.upsample > 1
+), "--temporal and --upsample cannot be combined"
+
+if args.temporal:
+    renderer_t = NeRFRenderer.from_conf(
+        conf["renderer"], lindisp=dset.lindisp, eval_batch_size=args.ray_batch_size,
+    ).to(device=device)
+    renderer_t.surface = renderer.surface
+    renderer_t.n_coarse = args.temporal_samples
+    renderer_t.n_fine = args.temporal_samples
+    renderer_t.n_fine_depth = min(renderer_t.n_fine_depth, args.temporal_samples // 2)
+    render_par_t = renderer_t.bind_parallel(net, args.gpu_id, simple_output=True).eval()
+
+
+def render_temporal():
+    """
+    Render the frames in order. Pixels the previous frame's surface points land on
+    are rendered with renderer_t in [depth - margin, depth + margin]; pixels that
+    were background are rendered with renderer_t over the full range, and fully
+    re-rendered if they hit something (disocclusion). Other pixels are fully rendered.
+    :return (V*H*W, 3)
+    """
+    focal_t = focal * args.scale
+    c_t = c * args.scale if c is not None else None
+    margin = args.temporal_margin * (z_far - z_near)
+    all_rgb = []
+    prev_hit = prev_empty = None
+    n_full = 0
+    for k, view_rays in enumerate(tqdm.tqdm(render_rays)):
+        rays = view_rays.reshape(-1, 8)
+        if prev_hit is None or k % args.keyframe == 0:
+            full = torch.ones(rays.shape[0], dtype=torch.bool, device=device)
+            rgb, depth = render_batched(render_par, rays, args.ray_batch_size)
+        else:
+            pose = render_poses[k].to(device=device)
+            surf = fill_holes(splat_depth(prev_hit, pose, focal_t, W, H, c=c_t))
+            empty = splat_depth(prev_empty, pose, focal_t, W, H, c=c_t)
+            surf, empty = surf.reshape(-1), torch.isfinite(empty.reshape(-1))
+            cheap = (torch.isfinite(surf) | empty).nonzero()[:, 0]
+            rays_cheap = rays[cheap].clone()
+            d = surf[cheap]
+            tight = torch.isfinite(d)
+            rays_cheap[tight, 6] = torch.max(d[tight] - margin, rays_cheap[tight, 6])
+            rays_cheap[tight, 7] = torch.min(d[tight] + margin, rays_cheap[tight, 7])
+
+            rgb = torch.zeros(rays.shape[0], 3, device=device)
+            depth = torch.zeros(rays.shape[0], device=device)
+            if cheap.shape[0] > 0:
+                rgb_c, depth_c = render_batched(
+                    render_par_t, rays_cheap, args.ray_batch_size
+                )
+                rgb[cheap], depth[cheap] = rgb_c, depth_c
+            full = torch.ones(rays.shape[0], dtype=torch.bool, device=device)
+            full[cheap] = False
+            if cheap.shape[0] > 0:
+                disoccluded = ~tight & (depth_c > 0.5 * rays_cheap[:, 6])
+                full[cheap[disoccluded]] = True
+            if full.any():
+                rgb[full], depth[full] = render_batched(
+                    render_par, rays[full], args.ray_batch_size
+                )
+        n_full += full.sum().item()
+
+        # Background rays have (near) zero expected depth
+        hit = depth > 0.5 * rays[:, 6]
+        prev_hit = rays[hit, :3] + depth[hit, None] * rays[hit, 3:6]
+        prev_empty = rays[~hit, :3] + rays[~hit, 7:8] * rays[~hit, 3:6]
+        all_rgb.append(rgb)
+    print("Fully rendered rays", n_full / (render_rays.shape[0] * H * W) * 100.0, "%")
+    return torch.cat(all_rgb)
+
+
 with torch.no_grad():
     print("Encoding source view(s)")
     if random_source:
@@ -223,21 +347,49 @@ with torch.no_grad():
     else:
         src_view = source
     
-    net.app_encoder.encode(app_imgs)
-    net.encode(
-        images[src_view].unsqueeze(0),
-        poses[src_view].unsqueeze(0).to(device=device),
-        focal,
-        c=c,
-    )
+    if args.encoded is not None:
+        print("Loading encoded scene", args.encoded)
+        net.load_encoded(args.encoded)
+    else:
+        net.app_encoder.encode(app_imgs)
+        net.encode(
+            images[src_view].unsqueeze(0),
+            poses[src_view].unsqueeze(0).to(device=device),
+            focal,
+            c=c,
+        )
 
     print("Rendering", args.num_views * H * W, "rays")
     all_rgb_fine = []
-    for rays in tqdm.tqdm(
-        torch.split(render_rays.view(-1, 8), args.ray_batch_size, dim=0)
-    ):
-        rgb, _depth = render_par(rays[None])
-        all_rgb_fine.append(rgb[0])
+    if args.temporal:
+        all_rgb_fine.append(render_temporal())
+    elif args.upsample > 1:
+        guide_fn = None
+        for view_rays in tqdm.tqdm(render_rays):
+            if args.encoded is None:
+                # Guide with the first source view
+                src_image = images[src_view[0]].to(device=device) * 0.5 + 0.5
+                guide_fn = lambda depth: reproject_source(
+                    src_image,
+                    poses[src_view[0]].to(device=device),
+                    focal,
+                    view_rays,
+                    depth,
+                    c=c,
+                )
+            rgb, _depth, _ = render_upsampled(
+                lambda rays: render_batched(render_par, rays, args.ray_batch_size),
+                view_rays,
+                args.upsample,
+                guide_fn=guide_fn,
+            )
+            all_rgb_fine.append(rgb.reshape(-1, 3))
+    else:
+        for rays in tqdm.tqdm(
+            torch.split(render_rays.view(-1, 8), args.ray_batch_size, dim=0)
+        ):
+            rgb, _depth = render_par(rays[None])
+            all_rgb_fine.append(rgb[0])
     _depth = None
     rgb_fine = torch.cat(all_rgb_fine)
     # rgb_fine (V*H*W, 3)
@@ -0,0 +1,153 @@
+"""
+Encode every image of an AppearanceDataset (e.g. ETH3D DSLR images) with the
+appearance encoder of a trained PixelNeRF-A and store the encodings as an
+appearance bank (see data.AppearanceBank), optionally product-quantized.
+
+python build_appearance_bank.py -n <expname> -c contrib/conf/pixelnerf_a.conf \
+    -D <appearance datadir> --out <bank dir> [--pq_sub 16]
+
+Then at query time, instead of AppearanceEncoder.encode(imgs):
+    bank = AppearanceBank(<bank dir>, device)
+    encodings, idx, dist = bank.lookup(imgs)  # nearest colour descriptor
+or nearest encodings of given encodings with bank.search / bank.search_pq.
+lookup returns the encoding of a different (bank) image, so --n_heldout images are
+kept out of the bank and the script reports how close their lookup encodings are to
+their true encodings (cosine similarity, relative L2 error), next to a random bank
+entry and the mean bank encoding as baselines.
+Also reports PQ recall@1 against exact search over --n_eval bank entries.
+"""
+import sys
+import os
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+)
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+import time
+import torch
+import torch.nn.functional as F
+import tqdm
+import util
+from data import AppearanceDataset, AppearanceBank
+from model import make_model
+
+
+def extra_args(parser):
+    parser.add_argument(
+        "--out", "-O", type=str, required=True, help="Bank output directory"
+    )
+    parser.add_argument(
+        "--split", type=str, default="train", help="Split to encode train | val | test"
+    )
+    parser.add_argument(
+        "--appcache",
+        type=str,
+        default=None,
+        help="Appearance image cache directory (see preproc_appearance.py)",
+    )
+    parser.add_argument(
+        "--batch_size", "-B", type=int, default=8, help="Images per encoder batch"
+    )
+    parser.add_argument(
+        "--load_app_encoder",
+        action="store_true",
+        help="Use the checkpoint's app_encoder_init weights instead of pixel_nerf_latest",
+    )
+    parser.add_argument(
+        "--pq_sub",
+        type=int,
+        default=0,
+        help="Number of PQ subvectors (0 = no product quantization)",
+    )
+    parser.add_argument(
+        "--pq_centroids", type=int, default=256, help="Centroids per PQ subspace"
+    )
+    parser.add_argument(
+        "--n_eval", type=int, default=256, help="Bank entries used as test queries"
+    )
+    parser.add_argument(
+        "--n_heldout",
+        type=int,
+        default=64,
+        help="Images kept out of the bank to measure lookup against their true encodings",
+    )
+    return parser
+
+
+args, conf = util.args.parse_args(extra_args, default_conf="contrib/conf/pixelnerf_a.conf")
+args.resume = True
+device = util.get_cuda(args.gpu_id[0])
+
+net = make_model(conf["model"]).to(device=device)
+net.load_weights(args)
+net.eval()
+app_encoder = net.app_encoder
+
+app_size = None
+app_size_h = conf.get_int("data.app_data.img_size_h", None)
+app_size_w = conf.get_int("data.app_data.img_size_w", None)
+if app_size_h is not None and app_size_w is not None:
+    app_size = (app_size_h, app_size_w)
+dset = AppearanceDataset(
+    args.datadir, args.split, image_size=app_size, cache_dir=args.appcache
+)
+
+paths = [path for index in range(len(dset)) for path in dset.image_paths(index)]
+print("Encoding", len(paths), "images to", args.out)
+all_enc, all_keys = [], []
+with torch.no_grad():
+    for start in tqdm.trange(0, len(paths), args.batch_size):
+        imgs = torch.stack(
+            [dset.load_image(path) for path in paths[start : start + args.batch_size]]
+        ).to(device=device)
+        app_encoder.encode(imgs)
+        all_enc.append(app_encoder.app_encoding.cpu())
+        all_keys.append(AppearanceBank.descriptor(imgs).cpu())
+all_enc, all_keys = torch.cat(all_enc), torch.cat(all_keys)
+n_heldout = min(args.n_heldout, len(paths) - 1)
+perm = torch.randperm(len(paths))
+heldout, kept = perm[:n_heldout], perm[n_heldout:].sort()[0]
+AppearanceBank.write(
+    args.out,
+    all_enc[kept],
+    all_keys[kept],
+    [paths[i] for i in kept.tolist()],
+    meta={"conf": args.conf, "name": args.name, "image_size": app_size},
+)
+
+bank = AppearanceBank(args.out, device=device)
+
+
+def lookup_error(approx, true):
+    cos = F.cosine_similarity(approx, true, dim=-1).mean().item()
+    rel = ((approx - true).norm(dim=-1) / true.norm(dim=-1)).mean().item()
+    return "cosine {:.4f} rel. L2 error {:.4f}".format(cos, rel)
+
+
+if n_heldout > 0:
+    true_enc = all_enc[heldout].to(device=device)
+    _, idx = bank.search(all_keys[heldout], use_keys=True)
+    print("Held-out lookup vs encoder, over", n_heldout, "images:")
+    print("  lookup     ", lookup_error(bank.encodings_at(idx[:, 0]), true_enc))
+    rand_idx = torch.randint(0, len(bank), (n_heldout,), device=device)
+    print("  random bank", lookup_error(bank.encodings_at(rand_idx), true_enc))
+    mean_enc = all_enc[kept].mean(dim=0, keepdim=True).to(device=device)
+    print("  mean bank  ", lookup_error(mean_enc.expand_as(true_enc), true_enc))
+
+queries = all_enc[kept][torch.randperm(len(bank))[: args.n_eval]]
+queries = queries + 0.01 * queries.std() * torch.randn_like(queries)
+t0 = time.perf_counter()
+_, exact_idx = bank.search(queries)
+print("exact search ms/query", (time.perf_counter() - t0) * 1000.0 / len(queries))
+if args.pq_sub > 0:
+    bank.train_pq(n_sub=args.pq_sub, n_centroids=args.pq_centroids)
+    for rerank in [0, 16]:
+        t0 = time.perf_counter()
+        _, pq_idx = bank.search_pq(queries, rerank=rerank)
+        t = (time.perf_counter() - t0) * 1000.0 / len(queries)
+        recall = (pq_idx[:, 0] == exact_idx[:, 0]).float().mean().item()
+        print("pq rerank", rerank, "ms/query", t, "recall@1", recall)
+print("Done")
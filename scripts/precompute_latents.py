@@ -0,0 +1,121 @@
+"""
+Precompute frozen SpatialEncoder latents for every view of a dataset split,
+for training with train.py --freeze_enc --latent_cache <out>.
+Writes <out>/<split>/manifest.json and memory-mapped .npy shards (see data.LatentCache).
+
+python precompute_latents.py -n <expname> -c <conf> -D <datadir> --out <cache dir> \
+    --splits "train val" [--quantize] [--resume]
+
+Without --resume, the encoder uses the initial (e.g. ImageNet pretrained) weights,
+which is what train.py --freeze_enc trains against from scratch.
+Note the latents are computed without DTU color jitter.
+"""
+import sys
+import os
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+import json
+import torch
+import tqdm
+import util
+from data import get_split_dataset, LatentCache, ColorJitterDataset
+from model import make_model
+
+
+def extra_args(parser):
+    parser.add_argument(
+        "--out", "-O", type=str, required=True, help="Cache output directory"
+    )
+    parser.add_argument(
+        "--splits",
+        type=str,
+        default="train val",
+        help="Space delimited splits to precompute train | val | test",
+    )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Store uint8 latents with per-channel ranges instead of fp16",
+    )
+    parser.add_argument(
+        "--shard_size", type=int, default=512, help="Approx. number of views per shard"
+    )
+    parser.add_argument(
+        "--batch_size", "-B", type=int, default=16, help="Views per encoder batch"
+    )
+    return parser
+
+
+args, conf = util.args.parse_args(extra_args, default_conf="conf/exp/srn.conf")
+device = util.get_cuda(args.gpu_id[0])
+
+net = make_model(conf["model"]).to(device=device)
+net.load_weights(args)
+net.eval()
+encoder = net.encoder
+
+
+def flush(split_dir, shard_idx, buffers):
+    LatentCache.write_shard(
+        split_dir,
+        shard_idx,
+        [torch.cat(level, dim=0) for level in buffers],
+        quantize=args.quantize,
+    )
+
+
+for split in args.splits.split():
+    dset = get_split_dataset(args.dataset_format, args.datadir, want_split=split)
+    if isinstance(dset, ColorJitterDataset):
+        dset = dset.base_dset
+    split_dir = os.path.join(args.out, split)
+    os.makedirs(split_dir, exist_ok=True)
+    print("Precomputing", len(dset), "objects of split", split, "to", split_dir)
+
+    objects = []
+    levels = None
+    shard_idx, shard_rows = 0, 0
+    buffers = None
+    with torch.no_grad():
+        for obj_idx in tqdm.trange(len(dset)):
+            data = dset[obj_idx]
+            assert data["img_id"] == obj_idx
+            images = data["images"]  # (NV, 3, H, W)
+            NV = images.shape[0]
+
+            obj_latents = []
+            for batch in torch.split(images, args.batch_size, dim=0):
+                encoder(batch.to(device=device))
+                obj_latents.append([latent.cpu() for latent in encoder.latents])
+            obj_latents = [torch.cat(level, dim=0) for level in zip(*obj_latents)]
+            if levels is None:
+                levels = [list(latent.shape[1:]) for latent in obj_latents]
+                buffers = [[] for _ in levels]
+
+            for level, latent in enumerate(obj_latents):
+                buffers[level].append(latent)
+            objects.append((shard_idx, shard_rows, NV))
+            shard_rows += NV
+
+            if shard_rows >= args.shard_size:
+                flush(split_dir, shard_idx, buffers)
+                buffers = [[] for _ in levels]
+                shard_idx, shard_rows = shard_idx + 1, 0
+
+    if shard_rows > 0:
+        flush(split_dir, shard_idx, buffers)
+
+    manifest = {
+        "conf": args.conf,
+        "backbone": conf.get_string("model.encoder.backbone"),
+        "split": split,
+        "quantize": args.quantize,
+        "levels": levels,
+        "objects": objects,
+    }
+    with open(os.path.join(split_dir, LatentCache.MANIFEST), "w") as f:
+        json.dump(manifest, f)
+print("Done")
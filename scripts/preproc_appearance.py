@@ -0,0 +1,49 @@
+"""
+Write the cached uint8 image pyramid of an appearance dataset (e.g. ETH3D DSLR
+images), see data.AppearanceDataset.write_cache. Load it with
+AppearanceDataset(..., cache_dir=<out>); images are then memory-mapped from the
+level matching image_size (or resized from the native level).
+
+python preproc_appearance.py -D <appearance datadir> -O <cache dir> \
+    --levels "256x256 300x450" [--no_native]
+"""
+import sys
+import os
+import argparse
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+from data import AppearanceDataset
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--datadir", "-D", type=str, required=True, help="Dataset directory")
+parser.add_argument("--out", "-O", type=str, required=True, help="Cache output directory")
+parser.add_argument(
+    "--levels",
+    type=str,
+    default="256x256 300x450",
+    help="Space delimited HxW sizes of the pre-resized levels",
+)
+parser.add_argument(
+    "--stages",
+    type=str,
+    default="train val test",
+    help="Space delimited stages whose scenes are cached",
+)
+parser.add_argument(
+    "--list_prefix", type=str, default="new_", help="Prefix of the scene lists"
+)
+parser.add_argument(
+    "--no_native", action="store_true", help="Do not store full resolution images"
+)
+args = parser.parse_args()
+
+levels = [tuple(map(int, level.split("x"))) for level in args.levels.split()]
+dsets = [
+    AppearanceDataset(args.datadir, stage, list_prefix=args.list_prefix)
+    for stage in args.stages.split()
+]
+AppearanceDataset.write_cache(dsets, args.out, levels, native=not args.no_native)
+print("Done")
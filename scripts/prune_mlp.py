@@ -0,0 +1,173 @@
+"""
+Structured pruning of the hidden width of the ResnetFC MLPs (mlp_coarse, mlp_fine).
+Ranks hidden units by activation statistics on a calibration set (or by weight norms),
+removes whole units and writes a smaller dense checkpoint plus a matching conf.
+
+python prune_mlp.py -n <expname> -c <conf> -D <datadir> --d_hidden 256 --out_name <new expname>
+
+Writes <checkpoints>/<new expname>/pixel_nerf_init and <checkpoints>/<new expname>/pruned.conf.
+Optionally fine-tune with train.py (without --resume, the init checkpoint is loaded):
+python train/train.py -n <new expname> -c <checkpoints>/<new expname>/pruned.conf -D <datadir> ...
+"""
+import sys
+import os
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+import torch
+import numpy as np
+import tqdm
+import util
+from data import get_split_dataset
+from model import make_model
+from render import NeRFRenderer
+
+
+def extra_args(parser):
+    parser.add_argument(
+        "--d_hidden", type=int, required=True, help="New hidden width of the MLPs"
+    )
+    parser.add_argument(
+        "--out_name", type=str, required=True, help="Experiment name of pruned model"
+    )
+    parser.add_argument(
+        "--criterion",
+        type=str,
+        default="activation",
+        help="Unit ranking activation | weight",
+    )
+    parser.add_argument(
+        "--split", type=str, default="train", help="Calibration split train | val"
+    )
+    parser.add_argument(
+        "--calib_objs", type=int, default=32, help="Number of calibration objects"
+    )
+    parser.add_argument(
+        "--calib_rays", type=int, default=4096, help="Rays rendered per object"
+    )
+    parser.add_argument(
+        "--nviews", "-V", type=int, default=1, help="Source views per object"
+    )
+    return parser
+
+
+args, conf = util.args.parse_args(extra_args, default_ray_batch_size=4096)
+args.resume = True
+device = util.get_cuda(args.gpu_id[0])
+
+net = make_model(conf["model"]).to(device=device).load_weights(args).eval()
+mlps = {"mlp_coarse": net.mlp_coarse, "mlp_fine": net.mlp_fine}
+mlps = {k: v for k, v in mlps.items() if v is not None}
+
+
+class ActivationStats:
+    """
+    Mean absolute activation of the residual stream (block inputs and lin_out input)
+    and of each block's inner layer (fc_1 input) of a ResnetFC
+    """
+
+    def __init__(self, mlp):
+        self.residual = torch.zeros(mlp.d_hidden, device=device)
+        self.n_residual = 0
+        self.inner = [torch.zeros(mlp.d_hidden, device=device) for _ in mlp.blocks]
+        self.n_inner = [0 for _ in mlp.blocks]
+        self.handles = []
+        for block in mlp.blocks:
+            self.handles.append(block.register_forward_pre_hook(self.residual_hook))
+        self.handles.append(mlp.lin_out.register_forward_pre_hook(self.residual_hook))
+        for i, block in enumerate(mlp.blocks):
+            self.handles.append(
+                block.fc_1.register_forward_pre_hook(self.make_inner_hook(i))
+            )
+
+    def residual_hook(self, module, inputs):
+        x = inputs[0].reshape(-1, inputs[0].shape[-1])
+        self.residual += x.abs().sum(dim=0)
+        self.n_residual += x.shape[0]
+
+    def make_inner_hook(self, i):
+        def hook(module, inputs):
+            x = inputs[0].reshape(-1, inputs[0].shape[-1])
+            self.inner[i] += x.abs().sum(dim=0)
+            self.n_inner[i] += x.shape[0]
+
+        return hook
+
+    def scores(self):
+        for handle in self.handles:
+            handle.remove()
+        return (
+            self.residual / max(self.n_residual, 1),
+            [s / max(n, 1) for s, n in zip(self.inner, self.n_inner)],
+        )
+
+
+if args.criterion == "activation":
+    dset = get_split_dataset(args.dataset_format, args.datadir, want_split=args.split)
+    renderer = NeRFRenderer.from_conf(
+        conf["renderer"], lindisp=dset.lindisp, eval_batch_size=args.ray_batch_size
+    ).to(device=device)
+    render_par = renderer.bind_parallel(net, args.gpu_id, simple_output=True).eval()
+
+    stats = {k: ActivationStats(v) for k, v in mlps.items()}
+    objs = np.random.permutation(len(dset))[: args.calib_objs]
+    with torch.no_grad():
+        for obj_idx in tqdm.tqdm(objs):
+            data = dset[obj_idx]
+            images = data["images"]  # (NV, 3, H, W)
+            poses = data["poses"]  # (NV, 4, 4)
+            NV, _, H, W = images.shape
+            focal = data["focal"]
+            if isinstance(focal, float):
+                focal = torch.tensor(focal, dtype=torch.float32)
+            focal = focal[None]
+            c = data.get("c")
+            if c is not None:
+                c = c.unsqueeze(0)
+
+            views = torch.from_numpy(np.random.choice(NV, args.nviews + 1, replace=False))
+            src, target = views[:-1], views[-1:]
+            net.encode(
+                images[src].unsqueeze(0).to(device=device),
+                poses[src].unsqueeze(0).to(device=device),
+                focal.to(device=device),
+                c=c.to(device=device) if c is not None else None,
+            )
+            rays = util.gen_rays(
+                poses[target], W, H, focal, dset.z_near, dset.z_far, c=c
+            ).reshape(-1, 8)
+            rays = rays[torch.randint(0, rays.shape[0], (args.calib_rays,))]
+            render_par(rays[None].to(device=device))
+    scores = {k: v.scores() for k, v in stats.items()}
+elif args.criterion == "weight":
+    with torch.no_grad():
+        scores = {k: v.weight_importance() for k, v in mlps.items()}
+else:
+    raise NotImplementedError("Unsupported criterion " + args.criterion)
+
+n_params = util.count_parameters(net)
+with torch.no_grad():
+    for k, mlp in mlps.items():
+        print("Pruning", k, mlp.d_hidden, "->", args.d_hidden)
+        mlp.prune_hidden(args.d_hidden, *scores[k])
+print("Parameters", n_params, "->", util.count_parameters(net))
+
+out_dir = os.path.join(args.checkpoints_path, args.out_name)
+os.makedirs(out_dir, exist_ok=True)
+ckpt_path = os.path.join(out_dir, "pixel_nerf_init")
+torch.save(net.state_dict(), ckpt_path)
+
+conf_path = os.path.join(out_dir, "pruned.conf")
+with open(conf_path, "w") as f:
+    f.write("# Pruned from {} ({})\n".format(args.name, args.criterion))
+    f.write('include required("{}")\n'.format(os.path.abspath(args.conf)))
+    for k in mlps:
+        f.write("model.{}.d_hidden = {}\n".format(k, args.d_hidden))
+print("Wrote", ckpt_path, "and", conf_path)
+print(
+    "To fine-tune: python train/train.py -n {} -c {} -D {} (without --resume)".format(
+        args.out_name, conf_path, args.datadir
+    )
+)
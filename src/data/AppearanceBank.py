@@ -0,0 +1,216 @@
+import os
+import json
+import torch
+import torch.nn.functional as F
+import numpy as np
+
+
+class AppearanceBank:
+    """
+    AppearanceEncoder encodings of every image of an AppearanceDataset, precomputed
+    by scripts/build_appearance_bank.py and stored as memory-mapped .npy matrices,
+    with exact and (optionally) product-quantized nearest-neighbour search.
+    Files: manifest.json (image paths), encodings.npy (N, D) float32,
+    keys.npy (N, K) float32 colour descriptors of the images (see descriptor),
+    and after train_pq pq_codebooks.npy (M, C, D / M), pq_codes.npy (N, M) uint8.
+    """
+
+    MANIFEST = "manifest.json"
+    DESCRIPTOR_SIZE = (8, 12)
+
+    def __init__(self, path, device="cpu"):
+        """
+        :param path directory written by write
+        :param device device searches run on
+        """
+        self.path = path
+        self.device = device
+        with open(os.path.join(path, self.MANIFEST), "r") as f:
+            self.manifest = json.load(f)
+        self.paths = self.manifest["paths"]
+        self.encodings = np.load(os.path.join(path, "encodings.npy"), mmap_mode="r")
+        self.keys = np.load(os.path.join(path, "keys.npy"), mmap_mode="r")
+        self.codebooks = self.codes = None
+        if os.path.exists(os.path.join(path, "pq_codes.npy")):
+            self.codebooks = torch.from_numpy(
+                np.load(os.path.join(path, "pq_codebooks.npy"))
+            ).to(device=device)
+            self.codes = np.load(os.path.join(path, "pq_codes.npy"), mmap_mode="r")
+        print(
+            "Loaded appearance bank",
+            path,
+            "entries:",
+            len(self),
+            "dim:",
+            self.encodings.shape[1],
+            "pq:",
+            self.codes is not None,
+        )
+
+    def __len__(self):
+        return self.encodings.shape[0]
+
+    @staticmethod
+    def descriptor(imgs):
+        """
+        Cheap colour layout descriptor used as lookup key: the image area-downsampled
+        to DESCRIPTOR_SIZE, flattened
+        :param imgs (N, 3, H, W) in [-1, 1]
+        :return (N, 3 * 8 * 12)
+        """
+        small = F.interpolate(imgs, size=AppearanceBank.DESCRIPTOR_SIZE, mode="area")
+        return small.reshape(imgs.shape[0], -1)
+
+    @staticmethod
+    def write(path, encodings, keys, paths, meta=None):
+        """
+        :param encodings (N, D) float tensor
+        :param keys (N, K) float tensor, see descriptor
+        :param paths list of N image paths
+        :param meta extra JSON-serializable manifest entries
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "encodings.npy"), encodings.float().numpy())
+        np.save(os.path.join(path, "keys.npy"), keys.float().numpy())
+        manifest = dict(meta or {})
+        manifest["paths"] = list(paths)
+        with open(os.path.join(path, AppearanceBank.MANIFEST), "w") as f:
+            json.dump(manifest, f)
+
+    def _rows(self, arr, start, end):
+        return torch.from_numpy(np.asarray(arr[start:end])).to(device=self.device)
+
+    def search(self, queries, k=1, use_keys=False, chunk_size=65536):
+        """
+        Exact L2 nearest neighbours, streamed over the memory-mapped matrix in chunks
+        :param queries (Q, D) encodings (or (Q, K) descriptors if use_keys)
+        :param use_keys search the colour descriptors instead of the encodings
+        :return dist (Q, k) squared distances, idx (Q, k) bank rows
+        """
+        bank = self.keys if use_keys else self.encodings
+        queries = queries.to(device=self.device, dtype=torch.float32)
+        q_sq = (queries ** 2).sum(-1, keepdim=True)  # (Q, 1)
+        best_dist = best_idx = None
+        for start in range(0, len(self), chunk_size):
+            rows = self._rows(bank, start, start + chunk_size)  # (n, D)
+            dist = q_sq - 2.0 * queries @ rows.t() + (rows ** 2).sum(-1)[None]
+            kk = min(k, rows.shape[0])
+            dist, idx = torch.topk(dist, kk, dim=-1, largest=False)
+            idx = idx + start
+            if best_dist is not None:
+                dist = torch.cat((best_dist, dist), dim=-1)
+                idx = torch.cat((best_idx, idx), dim=-1)
+                dist, order = torch.topk(dist, min(k, dist.shape[-1]), largest=False)
+                idx = torch.gather(idx, -1, order)
+            best_dist, best_idx = dist, idx
+        return best_dist.clamp_min(0.0), best_idx
+
+    def encodings_at(self, idx):
+        """
+        :param idx (...) long bank rows
+        :return (..., D) encodings
+        """
+        flat = idx.reshape(-1).cpu().numpy()
+        rows = torch.from_numpy(np.asarray(self.encodings[flat]))
+        return rows.to(device=self.device).reshape(*idx.shape, -1)
+
+    def lookup(self, imgs):
+        """
+        Appearance encodings for reference images without running the encoder:
+        the encoding of the bank image with the nearest colour descriptor. This is
+        another image's encoding, not the query's own; build_appearance_bank.py
+        reports how far it lands from the true encoding on held-out images
+        :param imgs (N, 3, H, W) in [-1, 1]
+        :return encodings (N, D), idx (N) bank rows, dist (N)
+        """
+        dist, idx = self.search(self.descriptor(imgs), k=1, use_keys=True)
+        return self.encodings_at(idx[:, 0]), idx[:, 0], dist[:, 0]
+
+    @staticmethod
+    def _kmeans(x, n_centroids, n_iters):
+        centroids = x[torch.randperm(x.shape[0], device=x.device)[:n_centroids]].clone()
+        for _ in range(n_iters):
+            assign = torch.cdist(x, centroids).argmin(dim=-1)
+            sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+            counts = torch.bincount(assign, minlength=centroids.shape[0])
+            empty = counts == 0
+            centroids = sums / counts.clamp_min(1).unsqueeze(-1).float()
+            # Re-seed empty clusters with random points
+            if empty.any():
+                reseed = torch.randint(0, x.shape[0], (int(empty.sum()),), device=x.device)
+                centroids[empty] = x[reseed]
+        return centroids
+
+    def train_pq(self, n_sub=16, n_centroids=256, n_iters=20, n_train=100000):
+        """
+        Product quantization of the encodings: split into n_sub subvectors,
+        k-means each subspace and store one uint8 code per subvector.
+        Writes pq_codebooks.npy and pq_codes.npy next to the bank.
+        :param n_train number of (random) encodings the codebooks are trained on
+        """
+        N, D = self.encodings.shape
+        assert D % n_sub == 0, "Encoding dim must be divisible by n_sub"
+        assert n_centroids <= 256, "Codes are stored as uint8"
+        n_centroids = min(n_centroids, N)
+        ds = D // n_sub
+        train_idx = np.sort(np.random.permutation(N)[:n_train])
+        x = torch.from_numpy(np.asarray(self.encodings[train_idx])).to(device=self.device)
+        codebooks = torch.stack(
+            [
+                self._kmeans(x[:, m * ds : (m + 1) * ds], n_centroids, n_iters)
+                for m in range(n_sub)
+            ]
+        )  # (M, C, ds)
+
+        codes = np.empty((N, n_sub), dtype=np.uint8)
+        for start in range(0, N, 65536):
+            rows = self._rows(self.encodings, start, start + 65536).reshape(-1, n_sub, ds)
+            for m in range(n_sub):
+                codes[start : start + rows.shape[0], m] = (
+                    torch.cdist(rows[:, m], codebooks[m]).argmin(dim=-1).cpu().numpy()
+                )
+        np.save(os.path.join(self.path, "pq_codebooks.npy"), codebooks.cpu().numpy())
+        np.save(os.path.join(self.path, "pq_codes.npy"), codes)
+        self.codebooks = codebooks
+        self.codes = np.load(os.path.join(self.path, "pq_codes.npy"), mmap_mode="r")
+
+    def search_pq(self, queries, k=1, rerank=0, chunk_size=65536):
+        """
+        Approximate L2 nearest neighbours with asymmetric distances to the PQ codes
+        (one (M, C) lookup table per query, then M gathers per bank entry)
+        :param queries (Q, D)
+        :param rerank if > k, re-rank this many PQ candidates with exact distances
+        :return dist (Q, k), idx (Q, k)
+        """
+        assert self.codes is not None, "Call train_pq first"
+        M, C, ds = self.codebooks.shape
+        queries = queries.to(device=self.device, dtype=torch.float32)
+        Q = queries.shape[0]
+        table = (
+            (queries.reshape(Q, M, 1, ds) - self.codebooks[None]) ** 2
+        ).sum(-1)  # (Q, M, C)
+        n_cand = max(k, rerank)
+        sub = torch.arange(M, device=self.device)
+        best_dist = best_idx = None
+        for start in range(0, len(self), chunk_size):
+            codes = self._rows(self.codes, start, start + chunk_size).long()  # (n, M)
+            dist = table[:, sub[None], codes].sum(-1)  # (Q, n)
+            dist, idx = torch.topk(dist, min(n_cand, codes.shape[0]), largest=False)
+            idx = idx + start
+            if best_dist is not None:
+                dist = torch.cat((best_dist, dist), dim=-1)
+                idx = torch.cat((best_idx, idx), dim=-1)
+                dist, order = torch.topk(
+                    dist, min(n_cand, dist.shape[-1]), largest=False
+                )
+                idx = torch.gather(idx, -1, order)
+            best_dist, best_idx = dist, idx
+
+        if rerank > k:
+            cand = self.encodings_at(best_idx)  # (Q, n_cand, D)
+            exact = ((cand - queries[:, None]) ** 2).sum(-1)
+            best_dist, order = torch.topk(
+                exact, min(k, exact.shape[-1]), largest=False
+            )
+            return best_dist, torch.gather(best_idx, -1, order)
+        return best_dist[:, :k], best_idx[:, :k]
@@ -4,14 +4,21 @@ import torch.nn.functional as F
 import glob
 import imageio
 import random
+import json
+import numpy as np
 from util import get_image_to_tensor_balanced
 
 class AppearanceDataset(torch.utils.data.Dataset):
 
     """
     Dataset consisting of images of a scene taken at different angles 
-    Meant to be used with appearance encoder
+    Meant to be used with appearance encoder.
+    With cache_dir (see write_cache and scripts/preproc_appearance.py), images are
+    read from a memory-mapped uint8 pyramid of pre-resized levels instead of
+    decoding and resizing the full-size images.
     """
+
+    CACHE_MANIFEST = "manifest.json"
     def __init__(
         self,
         path,
@@ -23,7 +30,8 @@ class AppearanceDataset(torch.utils.data.Dataset):
         max_imgs=100000,
         z_near=1.2,
         z_far=4.0,
-        img_ind=None
+        img_ind=None,
+        cache_dir=None,
     ):
         super().__init__()
         self.base_path = path
@@ -71,33 +79,147 @@ class AppearanceDataset(torch.utils.data.Dataset):
         self.max_imgs = max_imgs
         self.lindisp = False
         self.img_ind = img_ind
+
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            with open(os.path.join(cache_dir, self.CACHE_MANIFEST), "r") as f:
+                self.cache_manifest = json.load(f)
+            self.cache_rows = {
+                rel: row for row, rel in enumerate(self.cache_manifest["images"])
+            }
+            self.cache_levels = {}
+            print("Using appearance image cache", cache_dir)
     
     def __len__(self):
         return len(self.all_objs)
 
-    def __getitem__(self, index):
+    def image_paths(self, index):
+        """
+        Sorted paths of all images of scene index
+        """
         cat, root_dir = self.all_objs[index]
-
+        if self.cache_dir is not None:
+            scene = os.path.relpath(root_dir, self.base_path)
+            return [
+                os.path.join(self.base_path, rel)
+                for rel in self.cache_manifest["scenes"][scene]
+            ]
         rgb_paths = [
             x
             for x in glob.glob(os.path.join(root_dir, "images", "dslr_images_undistorted", "*"))
             if (x.endswith(".JPG") or x.endswith(".PNG"))
         ]
-        rgb_paths = sorted(rgb_paths)
-        
-        # Get image from this directory
-        img_ind = self.img_ind if self.img_ind < len(rgb_paths) is not None else 0
-        img = imageio.imread(rgb_paths[img_ind])[..., :3]
-        img_tensor = self.image_to_tensor(img)
+        return sorted(rgb_paths)
 
-        # NOTE: Right now, no intrisic or extrinsic camera information is being used here!
-        # Add it later in necessary! (Refer to DVRDataset)
+    def load_image(self, path):
+        """
+        Load one image, resized to image_size if set
+        :return (3, H, W) in [-1, 1]
+        """
+        if self.cache_dir is not None:
+            img = self._load_cached(os.path.relpath(path, self.base_path))
+            # Same as image_to_tensor
+            img_tensor = torch.from_numpy(img).permute(2, 0, 1).float() / 127.5 - 1.0
+        else:
+            img = imageio.imread(path)[..., :3]
+            img_tensor = self.image_to_tensor(img)
 
         if self.image_size is not None and img_tensor.shape[-2:] != self.image_size:
             img_tensor = torch.unsqueeze(img_tensor, 0)
             img_tensor = F.interpolate(img_tensor, size=self.image_size, mode="area")
             img_tensor = torch.squeeze(img_tensor, 0)
-        
+        return img_tensor
+
+    def _cache_level(self, level):
+        if level not in self.cache_levels:
+            self.cache_levels[level] = np.load(
+                os.path.join(self.cache_dir, "level_{}x{}.npy".format(*level)),
+                mmap_mode="r",
+            )
+        return self.cache_levels[level]
+
+    def _load_cached(self, rel):
+        """
+        Cached uint8 (H, W, 3) image: the level matching image_size if there is one,
+        else the native image (load_image then resizes)
+        """
+        row = self.cache_rows[rel]
+        levels = [tuple(level) for level in self.cache_manifest["levels"] if level]
+        if self.image_size is not None and tuple(self.image_size) in levels:
+            return np.array(self._cache_level(tuple(self.image_size))[row])
+        if self.cache_manifest["native"]:
+            return np.load(
+                os.path.join(self.cache_dir, "native", "{:06}.npy".format(row))
+            )
+        # No native level: resize the largest level
+        level = max(levels, key=lambda level: level[0] * level[1])
+        return np.array(self._cache_level(level)[row])
+
+    @staticmethod
+    def write_cache(dsets, out_dir, levels, native=True):
+        """
+        Write the uint8 image pyramid of every scene of the given datasets
+        (uncached AppearanceDatasets on the same base path) and its manifest
+        :param levels list of (H, W) sizes, each stored as one (N, H, W, 3) array
+        :param native also store each image at full resolution (one file per image)
+        """
+        base_path = dsets[0].base_path
+        scenes = {}
+        for dset in dsets:
+            assert dset.cache_dir is None and dset.base_path == base_path
+            for index, (_, root_dir) in enumerate(dset.all_objs):
+                scene = os.path.relpath(root_dir, base_path)
+                if scene not in scenes:
+                    scenes[scene] = [
+                        os.path.relpath(path, base_path)
+                        for path in dset.image_paths(index)
+                    ]
+        images = [rel for scene in scenes.values() for rel in scene]
+        os.makedirs(out_dir, exist_ok=True)
+        if native:
+            os.makedirs(os.path.join(out_dir, "native"), exist_ok=True)
+        level_arrs = [
+            np.lib.format.open_memmap(
+                os.path.join(out_dir, "level_{}x{}.npy".format(*level)),
+                mode="w+",
+                dtype=np.uint8,
+                shape=(len(images), level[0], level[1], 3),
+            )
+            for level in levels
+        ]
+        print("Caching", len(images), "images of", len(scenes), "scenes to", out_dir)
+        for row, rel in enumerate(images):
+            img = imageio.imread(os.path.join(base_path, rel))[..., :3]
+            if native:
+                np.save(os.path.join(out_dir, "native", "{:06}.npy".format(row)), img)
+            img = torch.from_numpy(np.ascontiguousarray(img)).permute(2, 0, 1)
+            img = img.unsqueeze(0).float()
+            for level, arr in zip(levels, level_arrs):
+                small = F.interpolate(img, size=tuple(level), mode="area")
+                arr[row] = small[0].permute(1, 2, 0).round().clamp(0, 255).byte().numpy()
+        for arr in level_arrs:
+            arr.flush()
+        with open(os.path.join(out_dir, AppearanceDataset.CACHE_MANIFEST), "w") as f:
+            json.dump(
+                {
+                    "levels": [list(level) for level in levels],
+                    "native": native,
+                    "scenes": scenes,
+                    "images": images,
+                },
+                f,
+            )
+
+    def __getitem__(self, index):
+        rgb_paths = self.image_paths(index)
+
+        # Get image from this directory
+        img_ind = self.img_ind if self.img_ind < len(rgb_paths) is not None else 0
+
+        # NOTE: Right now, no intrisic or extrinsic camera information is being used here!
+        # Add it later in necessary! (Refer to DVRDataset)
+        img_tensor = self.load_image(rgb_paths[img_ind])
+
         result = {
             "path": rgb_paths[img_ind],
             "img_id": index,
@@ -0,0 +1,121 @@
+import os
+import json
+import torch
+import numpy as np
+from util import quantize_uint8, dequantize_uint8
+
+
+class LatentCache:
+    """
+    Per-view SpatialEncoder latents precomputed for one dataset split
+    (see scripts/precompute_latents.py), stored as memory-mapped .npy shards.
+    Each encoder level is kept at its native resolution, before upsampling;
+    SpatialEncoder.set_latent does the upsampling when the latents are used.
+    Shards hold either fp16 latents or uint8 latents with per-view,
+    per-channel affine ranges (util.quantize_uint8).
+    """
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self, path):
+        """
+        :param path directory holding manifest.json and the shards
+        """
+        self.path = path
+        with open(os.path.join(path, self.MANIFEST), "r") as f:
+            self.manifest = json.load(f)
+        self.quantize = self.manifest["quantize"]
+        self.num_levels = len(self.manifest["levels"])
+        # img_id -> (shard, first row, number of views)
+        self.objects = self.manifest["objects"]
+        self.shards = {}
+        print(
+            "Loaded latent cache",
+            path,
+            "backbone:",
+            self.manifest["backbone"],
+            "objects:",
+            len(self.objects),
+        )
+
+    @staticmethod
+    def shard_file(path, shard_idx, level, suffix=""):
+        return os.path.join(
+            path, "shard_{:04}_l{}{}.npy".format(shard_idx, level, suffix)
+        )
+
+    @staticmethod
+    def write_shard(path, shard_idx, latents, quantize=False):
+        """
+        Write one shard
+        :param latents list over levels of (N, C_i, H_i, W_i) float tensors,
+        N is the number of views in the shard
+        :param quantize store uint8 + per-channel range instead of fp16
+        """
+        for level, latent in enumerate(latents):
+            if quantize:
+                q, lo, scale = quantize_uint8(latent)
+                np.save(LatentCache.shard_file(path, shard_idx, level), q.numpy())
+                np.save(
+                    LatentCache.shard_file(path, shard_idx, level, "_lo"), lo.numpy()
+                )
+                np.save(
+                    LatentCache.shard_file(path, shard_idx, level, "_scale"),
+                    scale.numpy(),
+                )
+            else:
+                np.save(
+                    LatentCache.shard_file(path, shard_idx, level),
+                    latent.half().numpy(),
+                )
+
+    def _open_shard(self, shard_idx):
+        if shard_idx not in self.shards:
+            arrays = []
+            for level in range(self.num_levels):
+                arr = np.load(
+                    self.shard_file(self.path, shard_idx, level), mmap_mode="r"
+                )
+                if self.quantize:
+                    arr = (
+                        arr,
+                        np.load(self.shard_file(self.path, shard_idx, level, "_lo")),
+                        np.load(
+                            self.shard_file(self.path, shard_idx, level, "_scale")
+                        ),
+                    )
+                arrays.append(arr)
+            self.shards[shard_idx] = arrays
+        return self.shards[shard_idx]
+
+    def get(self, img_ids, view_inds, device="cpu"):
+        """
+        Read the latents of the given source views
+        :param img_ids (SB) dataset indices ("img_id" of each data item)
+        :param view_inds (SB, NS) view indices within each object
+        :return list over levels of (SB*NS, C_i, H_i, W_i) float tensors,
+        to be passed as PixelNeRFNet.encode(..., latents=)
+        """
+        if torch.is_tensor(img_ids):
+            img_ids = img_ids.tolist()
+        if torch.is_tensor(view_inds):
+            view_inds = view_inds.cpu().numpy()
+        view_inds = np.asarray(view_inds).reshape(len(img_ids), -1)
+
+        levels = [[] for _ in range(self.num_levels)]
+        for img_id, views in zip(img_ids, view_inds):
+            shard_idx, start, nviews = self.objects[img_id]
+            assert (views < nviews).all(), "View index out of range of the cache"
+            rows = start + views
+            for level, arr in enumerate(self._open_shard(shard_idx)):
+                if self.quantize:
+                    q, lo, scale = arr
+                    latent = dequantize_uint8(
+                        torch.from_numpy(q[rows]),
+                        torch.from_numpy(lo[rows]),
+                        torch.from_numpy(scale[rows]),
+                    )
+                else:
+                    latent = torch.from_numpy(arr[rows]).float()
+                levels[level].append(latent)
+        return [torch.cat(level, dim=0).to(device=device) for level in levels]
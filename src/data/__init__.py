@@ -3,8 +3,10 @@ import os
 from .MultiObjectDataset import MultiObjectDataset
 from .DVRDataset import DVRDataset
 from .SRNDataset import SRNDataset
-from .data_util import ColorJitterDataset
+from .data_util import ColorJitterDataset, RaySampleDataset
 from .AppearanceDataset import AppearanceDataset
+from .LatentCache import LatentCache
+from .AppearanceBank import AppearanceBank
 
 
 def get_split_dataset(dataset_type, datadir, want_split="all", training=True, **kwargs):
@@ -5,6 +5,7 @@ import torchvision.transforms.functional_tensor as F_t
 import torchvision.transforms.functional as TF
 import numpy as np
 import imageio
+from util import sampler
 
 #  from util import GaussianBlur
 
@@ -52,3 +53,67 @@ class ColorJitterDataset(torch.utils.data.Dataset):
         data = self.base_dset[idx]
         data["images"] = self.apply_color_jitter(data["images"])
         return data
+
+
+class RaySampleDataset(torch.utils.data.Dataset):
+    """
+    Samples the source views, training rays and ground truth colours of each
+    object in the DataLoader workers (see util.sampler), so the full image stack
+    never reaches the training process. Items keep the base keys except images,
+    poses, bbox and masks, and add
+    src_inds (num_views) long, src_images (num_views, 3, H, W),
+    src_poses (num_views, 4, 4), rays (num_rays, 8), rgb_gt (num_rays, 3) in [0, 1].
+    src_inds are in random order, so any prefix is a random subset of the views.
+    """
+
+    def __init__(
+        self, base_dset, num_rays, num_views, use_bbox=True, extra_inherit_attrs=[],
+    ):
+        """
+        :param num_rays rays per object
+        :param num_views source views per object
+        :param use_bbox sample rays inside the bboxes when the base dataset has them;
+        workers copy the dataset at the start of each epoch, so changes apply from
+        the next epoch on
+        """
+        self.num_rays = num_rays
+        self.num_views = num_views
+        self.use_bbox = use_bbox
+        inherit_attrs = ["z_near", "z_far", "lindisp", "base_path", "image_to_tensor"]
+        inherit_attrs.extend(extra_inherit_attrs)
+
+        self.base_dset = base_dset
+        for inherit_attr in inherit_attrs:
+            setattr(self, inherit_attr, getattr(self.base_dset, inherit_attr))
+
+    def __len__(self):
+        return len(self.base_dset)
+
+    def __getitem__(self, idx):
+        data = self.base_dset[idx]
+        images = data.pop("images")  # (NV, 3, H, W)
+        poses = data.pop("poses")  # (NV, 4, 4)
+        bbox = data.pop("bbox", None)  # (NV, 4)
+        data.pop("masks", None)
+        if not self.use_bbox or not torch.is_tensor(bbox):
+            bbox = None
+        focal = torch.as_tensor(data["focal"], dtype=torch.float32)
+        c = data.get("c")
+
+        src_inds = sampler.choose_views(1, images.shape[0], self.num_views)[0]
+        rays, rgb_gt = sampler.sample_rays(
+            images[None],
+            poses[None],
+            focal[None],
+            self.z_near,
+            self.z_far,
+            self.num_rays,
+            c=c[None] if c is not None else None,
+            bboxes=bbox[None] if bbox is not None else None,
+        )
+        data["src_inds"] = src_inds
+        data["src_images"] = images[src_inds]
+        data["src_poses"] = poses[src_inds]
+        data["rays"] = rays[0]
+        data["rgb_gt"] = rgb_gt[0]
+        return data
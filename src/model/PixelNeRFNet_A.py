@@ -2,9 +2,15 @@ import torch
 import os
 import os.path as osp
 import warnings
-from .model_util import make_encoder, make_mlp
+from .model_util import (
+    make_encoder,
+    make_mlp,
+    make_code,
+    quantize_mlp,
+    export_encoded,
+    load_encoded,
+)
 from .encoder import ImageEncoder
-from .code import PositionalEncoding
 from contrib.model.AppearanceEncoder import AppearanceEncoder
 import torch.autograd.profiler as profiler
 from util import repeat_interleave
@@ -51,8 +57,8 @@ class PixelNeRFNet_A(torch.nn.Module):
             # Apply positional encoding to viewdirs
             d_in += 3
         if self.use_code and d_in > 0:
-            # Positional encoding for x,y,z OR view z
-            self.code = PositionalEncoding.from_conf(conf["code"], d_in=d_in)
+            # Positional (or hash grid, xyz only) encoding for x,y,z OR view z
+            self.code = make_code(conf["code"], d_in=d_in)
             d_in = self.code.d_out
         if self.use_viewdirs and not self.use_code_viewdirs:
             # Don't apply positional encoding to viewdirs (concat after encoded)
@@ -103,7 +109,7 @@ class PixelNeRFNet_A(torch.nn.Module):
             self.stop_app_encoder_grad = stop_app_encoder_grad
             self.app_encoder = AppearanceEncoder(conf["app_encoder"])
 
-    def encode(self, images, poses, focal, z_bounds=None, c=None):
+    def encode(self, images, poses, focal, z_bounds=None, c=None, latents=None):
         """
         :param images (NS, 3, H, W)
         NS is number of input (aka source or reference) views
@@ -112,6 +118,8 @@ class PixelNeRFNet_A(torch.nn.Module):
         :param z_bounds ignored argument (used in the past)
         :param c principal point None or () or (2) or (NS) or (NS, 2) [cx, cy],
         default is center of image
+        :param latents optional precomputed per-level encoder latents
+        (list of (SB*NS, C_i, H_i, W_i), see data.LatentCache); skips the backbone
         """
         self.num_objs = images.size(0)
         if len(images.shape) == 5:
@@ -125,7 +133,10 @@ class PixelNeRFNet_A(torch.nn.Module):
         else:
             self.num_views_per_obj = 1
 
-        self.encoder(images)
+        if latents is not None:
+            self.encoder.set_latent(latents)
+        else:
+            self.encoder(images)
         rot = poses[:, :3, :3].transpose(1, 2)  # (B, 3, 3)
         trans = -torch.bmm(rot, poses[:, :3, 3:])  # (B, 3, 1)
         self.poses = torch.cat((rot, trans), dim=-1)  # (B, 3, 4)
@@ -160,11 +171,68 @@ class PixelNeRFNet_A(torch.nn.Module):
         if self.use_global_encoder:
             self.global_encoder(images)
 
-    def forward(self, xyz, coarse=True, viewdirs=None, app_pass=True, far=False):
+    def export_encoded(self, path, quantize=False):
+        """
+        Save the encoded scene (after encode) to a single file,
+        see model_util.export_encoded
+        """
+        export_encoded(self, path, quantize=quantize)
+
+    def load_encoded(self, path):
+        """
+        Restore an encoded scene saved by export_encoded, instead of calling encode
+        """
+        return load_encoded(self, path)
+
+    def optimize_for_inference(self, **kwargs):
+        """
+        Optimize the image encoder(s) for inference, see
+        SpatialEncoder.optimize_for_inference for arguments.
+        Call after load_weights; encoders can no longer be trained afterwards.
+        """
+        self.encoder.optimize_for_inference(**kwargs)
+        if self.use_global_encoder:
+            self.global_encoder.optimize_for_inference(**kwargs)
+        if self.app_enc_on:
+            self.app_encoder.optimize_for_inference(**kwargs)
+        return self
+
+    def quantize_mlps(self):
+        """
+        Replace mlp_coarse/mlp_fine with dynamically int8-quantized copies
+        for CPU inference. Call after load_weights; the MLPs can no longer be trained.
+        """
+        assert self.poses.device.type == "cpu", "Dynamic quantization is CPU only"
+        self.mlp_coarse = quantize_mlp(self.mlp_coarse)
+        self.mlp_fine = quantize_mlp(self.mlp_fine)
+        return self
+
+    def app_branch_encodings(self, app_pass=True, device=None):
+        """
+        F2 branches evaluated by forward with multi_app.
+        :param app_pass if true, one appearance branch per row of
+        app_encoder.app_encoding (each applied to all objects), e.g. to render one scene
+        under N appearance images; if false, the regular F2 and the appearance F2
+        with the full app_encoding, i.e. the app_pass=False and app_pass=True outputs
+        :param device device to move the encodings to
+        :return list of (1 or SB, app_in) encodings, None for the regular F2
+        """
+        app_enc = self.app_encoder.app_encoding.to(device)
+        if self.stop_app_encoder_grad:
+            app_enc = app_enc.detach()
+        if app_pass:
+            return list(torch.split(app_enc, 1, dim=0))
+        return [None, app_enc]
+
+    def forward(
+        self, xyz, coarse=True, viewdirs=None, app_pass=True, far=False, multi_app=False
+    ):
         """
         Predict (r, g, b, sigma) at world space points xyz.
         Please call encode first!
         :param xyz (SB, B, 3)
+        :param multi_app if true, evaluate several F2 branches (see app_branch_encodings)
+        on one F1 pass and return (SB, B, N * 4), branches in order
         SB is batch of objects
         B is batch of points (in rays)
         NS is number of input views
@@ -251,6 +319,19 @@ class PixelNeRFNet_A(torch.nn.Module):
                 global_latent = repeat_interleave(global_latent, num_repeats)
                 mlp_input = torch.cat((global_latent, mlp_input), dim=-1)
             
+            mlp = self.mlp_coarse if coarse or self.mlp_fine is None else self.mlp_fine
+            if multi_app:
+                assert self.app_enc_on, "multi_app requires the appearance encoder"
+                mlp_output = mlp.forward_multi_app(
+                    mlp_input,
+                    self.app_branch_encodings(app_pass, mlp_input.device),
+                    combine_inner_dims=(self.num_views_per_obj, B),
+                )  # (SB, B, N, 4)
+                rgb = mlp_output[..., :3]
+                sigma = mlp_output[..., 3:4]
+                output = torch.cat((torch.sigmoid(rgb), torch.relu(sigma)), dim=-1)
+                return output.reshape(SB, B, -1)
+
             # Added appearance encoder as input to MLP
             app_enc = None
             if self.app_enc_on and app_pass:
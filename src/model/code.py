@@ -1,6 +1,7 @@
 import torch
 import numpy as np
 import torch.autograd.profiler as profiler
+from typing import Tuple
 
 
 class PositionalEncoding(torch.nn.Module):
@@ -50,3 +51,143 @@ class PositionalEncoding(torch.nn.Module):
             conf.get_float("freq_factor", np.pi),
             conf.get_bool("include_input", True),
         )
+
+
+class HashGridEncoding(torch.nn.Module):
+    """
+    Multi-resolution hash grid encoding (Mueller et al. 2022, Instant-NGP),
+    pure PyTorch. Learned features are trilinearly interpolated from a hashed
+    grid at each of n_levels resolutions and concatenated.
+    Only for xyz input (d_in = 3).
+    """
+
+    # Spatial hash primes from the paper
+    PRIMES = (1, 2654435761, 805459861)
+
+    def __init__(
+        self,
+        d_in=3,
+        n_levels=16,
+        n_features=2,
+        log2_hashmap_size=19,
+        base_resolution=16,
+        max_resolution=1024,
+        bound=1.0,
+        include_input=True,
+        lr_factor=1.0,
+    ):
+        """
+        :param n_levels number of grid resolutions
+        :param n_features feature size per level
+        :param log2_hashmap_size log2 of table size T per level
+        :param base_resolution coarsest grid resolution
+        :param max_resolution finest grid resolution
+        :param bound input is assumed to lie in [-bound, bound]^3 (clamped)
+        :param include_input whether to append the raw input
+        :param lr_factor learning rate multiplier for the tables,
+        picked up by the trainer (grids usually want a much higher lr than the MLP)
+        """
+        super().__init__()
+        assert (
+            d_in == 3
+        ), "HashGridEncoding only supports xyz input (use_xyz = True, use_code_viewdirs = False)"
+        self.d_in = d_in
+        self.n_levels = n_levels
+        self.n_features = n_features
+        self.table_size = 2 ** log2_hashmap_size
+        self.bound = bound
+        self.include_input = include_input
+        self.lr_factor = lr_factor
+        self.d_out = n_levels * n_features
+        if include_input:
+            self.d_out += d_in
+
+        scale = np.exp(
+            (np.log(max_resolution) - np.log(base_resolution)) / max(n_levels - 1, 1)
+        )
+        resolutions = [int(np.floor(base_resolution * scale ** l)) for l in range(n_levels)]
+        # Levels whose full grid fits in the table are indexed densely (no collisions)
+        dense = [(r + 1) ** 3 <= self.table_size for r in resolutions]
+        self.register_buffer(
+            "_resolutions", torch.tensor(resolutions, dtype=torch.float32)
+        )
+        self.register_buffer("_dense", torch.tensor(dense))
+        self.register_buffer(
+            "_strides",
+            torch.tensor(
+                [[1, r + 1, (r + 1) ** 2] for r in resolutions], dtype=torch.long
+            ),
+        )
+        self.register_buffer(
+            "_level_offsets",
+            torch.arange(n_levels, dtype=torch.long) * self.table_size,
+        )
+        self.register_buffer("_primes", torch.tensor(self.PRIMES, dtype=torch.long))
+        self.embeddings = torch.nn.Parameter(
+            torch.empty(n_levels * self.table_size, n_features).uniform_(-1e-4, 1e-4)
+        )
+
+    @staticmethod
+    def _corner_split(t) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Split per-axis values at the 2 neighbouring grid lines into 3 tensors that
+        broadcast to the (2, 2, 2) cell corners
+        :param t (batch, L, 3, 2)
+        :return 3 tensors broadcastable to (batch, L, 2, 2, 2)
+        """
+        return (
+            t[:, :, 0, :, None, None],
+            t[:, :, 1, None, :, None],
+            t[:, :, 2, None, None, :],
+        )
+
+    def forward(self, x):
+        """
+        :param x (batch, 3)
+        :return (batch, self.d_out)
+        """
+        with profiler.record_function("hash_grid_enc"):
+            x01 = ((x / self.bound + 1.0) * 0.5).clamp(0.0, 1.0)
+            # (batch, L, 3) positions in grid units per level
+            res = self._resolutions.view(1, -1, 1)
+            pos = x01.unsqueeze(1) * res
+            # Keep the upper corner inside the grid at x01 = 1
+            pos_floor = torch.min(pos.floor(), res - 1.0)
+            frac = pos - pos_floor
+            # (batch, L, 3, 2) integer coordinates of the lower/upper grid lines
+            lines = pos_floor.long().unsqueeze(-1) + torch.arange(2, device=x.device)
+
+            tx, ty, tz = self._corner_split(lines * self._strides.view(1, -1, 3, 1))
+            dense_idx = (tx + ty + tz).flatten(2)
+            tx, ty, tz = self._corner_split(lines * self._primes.view(1, 1, 3, 1))
+            hash_idx = (tx ^ ty ^ tz).flatten(2) & (self.table_size - 1)
+            idx = torch.where(self._dense.view(1, -1, 1), dense_idx, hash_idx)
+            idx = idx + self._level_offsets.view(1, -1, 1)  # (batch, L, 8)
+
+            # Trilinear weights (batch, L, 8)
+            tx, ty, tz = self._corner_split(torch.stack((1.0 - frac, frac), dim=-1))
+            w = (tx * ty * tz).flatten(2)
+
+            feats = self.embeddings[idx.view(-1)].view(
+                idx.shape[0], self.n_levels, 8, self.n_features
+            )
+            embed = (feats * w.unsqueeze(-1)).sum(2)  # (batch, L, F)
+            embed = embed.view(x.shape[0], -1)
+            if self.include_input:
+                embed = torch.cat((x, embed), dim=-1)
+            return embed
+
+    @classmethod
+    def from_conf(cls, conf, d_in=3):
+        # PyHocon construction
+        return cls(
+            d_in,
+            n_levels=conf.get_int("n_levels", 16),
+            n_features=conf.get_int("n_features", 2),
+            log2_hashmap_size=conf.get_int("log2_hashmap_size", 19),
+            base_resolution=conf.get_int("base_resolution", 16),
+            max_resolution=conf.get_int("max_resolution", 1024),
+            bound=conf.get_float("bound", 1.0),
+            include_input=conf.get_bool("include_input", True),
+            lr_factor=conf.get_float("lr_factor", 1.0),
+        )
@@ -1,7 +1,9 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torchvision
 import util
+from typing import List
 
 
 class ConvEncoder(nn.Module):
@@ -92,3 +94,51 @@ class ConvEncoder(nn.Module):
         x = self.deconv_last(x)
         x = util.same_unpad_deconv2d(x, layer=self.deconv_last)
         return x
+
+
+class FeaturePyramidEncoder(nn.Module):
+    """
+    Multi-level encoder over a lightweight torchvision backbone exposing a
+    'features' Sequential, e.g. mobilenet_v3_small/large, efficientnet_b0.
+    Returns the output of the last block at each of the first num_layers
+    resolution levels (stride 2, 4, 8, ...), mirroring the ResNet layers
+    used by SpatialEncoder. Deeper blocks are dropped.
+    """
+
+    def __init__(self, backbone="mobilenet_v3_large", pretrained=True, num_layers=4):
+        super().__init__()
+        features = getattr(torchvision.models, backbone)(pretrained=pretrained).features
+
+        # Probe output shapes to find where the resolution changes
+        features.eval()
+        shapes = []
+        with torch.no_grad():
+            x = torch.zeros(1, 3, 64, 64)
+            for block in features:
+                x = block(x)
+                shapes.append(x.shape)
+        features.train()
+
+        stages = []
+        self.dims = []
+        start = 0
+        for i in range(len(features)):
+            last_of_level = (
+                i == len(features) - 1 or shapes[i + 1][-1] != shapes[i][-1]
+            )
+            if last_of_level:
+                stages.append(nn.Sequential(*features[start : i + 1]))
+                self.dims.append(shapes[i][1])
+                start = i + 1
+                if len(stages) == num_layers:
+                    break
+        assert len(stages) == num_layers, "Backbone has only %d levels" % len(stages)
+        self.stages = nn.ModuleList(stages)
+        self.latent_size = sum(self.dims)
+
+    def forward(self, x) -> List[torch.Tensor]:
+        latents = []
+        for stage in self.stages:
+            x = stage(x)
+            latents.append(x)
+        return latents
@@ -6,8 +6,37 @@ from torch import nn
 import torch.nn.functional as F
 import torchvision
 import util
-from model.custom_encoder import ConvEncoder
+from model.custom_encoder import ConvEncoder, FeaturePyramidEncoder
 import torch.autograd.profiler as profiler
+from typing import List
+
+
+class _ResnetLatents(nn.Module):
+    """
+    Scriptable ResNet trunk returning the feature maps used by SpatialEncoder.
+    Only built by SpatialEncoder.optimize_for_inference.
+    """
+
+    def __init__(self, model, num_layers, use_first_pool):
+        super().__init__()
+        self.conv1 = model.conv1
+        self.bn1 = model.bn1
+        self.relu = model.relu
+        self.maxpool = model.maxpool
+        self.layers = nn.ModuleList(
+            [model.layer1, model.layer2, model.layer3, model.layer4][: num_layers - 1]
+        )
+        self.use_first_pool = use_first_pool and num_layers > 1
+
+    def forward(self, x) -> List[torch.Tensor]:
+        x = self.relu(self.bn1(self.conv1(x)))
+        latents = [x]
+        if self.use_first_pool:
+            x = self.maxpool(x)
+        for layer in self.layers:
+            x = layer(x)
+            latents.append(x)
+        return latents
 
 
 class SpatialEncoder(nn.Module):
@@ -30,8 +59,10 @@ class SpatialEncoder(nn.Module):
         """
         :param backbone Backbone network. Either custom, in which case
         model.custom_encoder.ConvEncoder is used OR resnet18/resnet34, in which case the relevant
-        model from torchvision is used
-        :param num_layers number of resnet layers to use, 1-5
+        model from torchvision is used OR a lightweight torchvision model with a 'features'
+        trunk (mobilenet_v3_small/large, efficientnet_b0, ...), in which case
+        model.custom_encoder.FeaturePyramidEncoder is used
+        :param num_layers number of resnet layers (or resolution levels) to use, 1-5
         :param pretrained Whether to use model weights pretrained on ImageNet
         :param index_interp Interpolation to use for indexing
         :param index_padding Padding mode to use for indexing, border | zeros | reflection
@@ -39,7 +70,7 @@ class SpatialEncoder(nn.Module):
         :param feature_scale factor to scale all latent by. Useful (<1) if image
         is extremely large, to fit in memory.
         :param use_first_pool if false, skips first maxpool layer to avoid downscaling image
-        features too much (ResNet only)
+        features too much (ResNet only; lightweight backbones have no separate pool)
         :param norm_type norm type to applied; pretrained model must use batch
         """
         super().__init__()
@@ -48,6 +79,9 @@ class SpatialEncoder(nn.Module):
             assert not pretrained
 
         self.use_custom_resnet = backbone == "custom"
+        self.use_feature_pyramid = not self.use_custom_resnet and not backbone.startswith(
+            "resnet"
+        )
         self.feature_scale = feature_scale
         self.use_first_pool = use_first_pool
         norm_layer = util.get_norm_layer(norm_type)
@@ -57,6 +91,12 @@ class SpatialEncoder(nn.Module):
             print("Using simple convolutional encoder")
             self.model = ConvEncoder(3, norm_layer=norm_layer)
             self.latent_size = self.model.dims[-1]
+        elif self.use_feature_pyramid:
+            print("Using torchvision", backbone, "feature pyramid encoder")
+            self.model = FeaturePyramidEncoder(
+                backbone, pretrained=pretrained, num_layers=num_layers
+            )
+            self.latent_size = self.model.latent_size
         else:
             print("Using torchvision", backbone, "encoder")
             self.model = getattr(torchvision.models, backbone)(
@@ -77,6 +117,10 @@ class SpatialEncoder(nn.Module):
         )
         # self.latent (B, L, H, W)
 
+        # Set by optimize_for_inference
+        self.channels_last = False
+        self.frozen_model = None
+
     def index(self, uv, cam_z=None, image_size=(), z_bounds=None):
         """
         Get pixel-aligned image features at 2D image coordinates
@@ -123,9 +167,15 @@ class SpatialEncoder(nn.Module):
                 recompute_scale_factor=True,
             )
         x = x.to(device=self.latent.device)
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
 
         if self.use_custom_resnet:
-            self.latent = self.model(x)
+            latents = [self.model(x)]
+        elif self.frozen_model is not None:
+            latents = self.frozen_model(x)
+        elif self.use_feature_pyramid:
+            latents = self.model(x)
         else:
             x = self.model.conv1(x)
             x = self.model.bn1(x)
@@ -147,22 +197,60 @@ class SpatialEncoder(nn.Module):
                 x = self.model.layer4(x)
                 latents.append(x)
 
-            self.latents = latents
-            align_corners = None if self.index_interp == "nearest " else True
-            latent_sz = latents[0].shape[-2:]
-            for i in range(len(latents)):
-                latents[i] = F.interpolate(
-                    latents[i],
+        return self.set_latent(latents)
+
+    def set_latent(self, latents):
+        """
+        Set the latent used by index() from per-level feature maps,
+        e.g. precomputed offline (see scripts/precompute_latents.py).
+        :param latents list of (B, C_i, H_i, W_i), finest level first,
+        as stored in self.latents by forward()
+        :return latent (B, latent_size, H, W)
+        """
+        latents = [latent.to(device=self.latent.device) for latent in latents]
+        self.latents = latents
+        align_corners = None if self.index_interp == "nearest " else True
+        latent_sz = latents[0].shape[-2:]
+        self.latent = torch.cat(
+            [
+                F.interpolate(
+                    latent,
                     latent_sz,
                     mode=self.upsample_interp,
                     align_corners=align_corners,
                 )
-            self.latent = torch.cat(latents, dim=1)
+                for latent in latents
+            ],
+            dim=1,
+        )
         self.latent_scaling[0] = self.latent.shape[-1]
         self.latent_scaling[1] = self.latent.shape[-2]
         self.latent_scaling = self.latent_scaling / (self.latent_scaling - 1) * 2.0
         return self.latent
 
+    def optimize_for_inference(self, fold_bn=True, channels_last=True, freeze=False):
+        """
+        Speed up forward() for inference; output is unchanged up to float error.
+        Call after loading weights and moving to the target device.
+        The encoder can no longer be trained afterwards.
+        :param fold_bn fold BatchNorm layers into the preceding convolutions
+        :param channels_last run the backbone in channels-last memory format
+        :param freeze script and freeze the ResNet trunk with TorchScript
+        (ignored for the custom encoder)
+        """
+        self.eval()
+        if fold_bn:
+            util.fold_batch_norm(self.model)
+        if channels_last:
+            self.model.to(memory_format=torch.channels_last)
+            self.channels_last = True
+        if freeze and self.use_feature_pyramid:
+            self.frozen_model = torch.jit.freeze(torch.jit.script(self.model))
+        elif freeze and not self.use_custom_resnet:
+            trunk = _ResnetLatents(self.model, self.num_layers, self.use_first_pool)
+            self.frozen_model = torch.jit.freeze(torch.jit.script(trunk.eval()))
+        return self
+
     @classmethod
     def from_conf(cls, conf):
         return cls(
@@ -198,6 +286,10 @@ class ImageEncoder(nn.Module):
         if latent_size != 512:
             self.fc = nn.Linear(512, latent_size)
 
+        # Set by optimize_for_inference
+        self.channels_last = False
+        self.frozen_model = None
+
     def index(self, uv, cam_z=None, image_size=(), z_bounds=()):
         """
         Params ignored (compatibility)
@@ -213,18 +305,25 @@ class ImageEncoder(nn.Module):
         :return latent (B, latent_size)
         """
         x = x.to(device=self.latent.device)
-        x = self.model.conv1(x)
-        x = self.model.bn1(x)
-        x = self.model.relu(x)
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+
+        if self.frozen_model is not None:
+            # Scripted torchvision forward, fc is empty
+            x = self.frozen_model(x)
+        else:
+            x = self.model.conv1(x)
+            x = self.model.bn1(x)
+            x = self.model.relu(x)
 
-        x = self.model.maxpool(x)
-        x = self.model.layer1(x)
-        x = self.model.layer2(x)
-        x = self.model.layer3(x)
-        x = self.model.layer4(x)
+            x = self.model.maxpool(x)
+            x = self.model.layer1(x)
+            x = self.model.layer2(x)
+            x = self.model.layer3(x)
+            x = self.model.layer4(x)
 
-        x = self.model.avgpool(x)
-        x = torch.flatten(x, 1)
+            x = self.model.avgpool(x)
+            x = torch.flatten(x, 1)
 
         if self.latent_size != 512:
             x = self.fc(x)
@@ -232,6 +331,20 @@ class ImageEncoder(nn.Module):
         self.latent = x  # (B, latent_size)
         return self.latent
 
+    def optimize_for_inference(self, fold_bn=True, channels_last=True, freeze=False):
+        """
+        Speed up forward() for inference, see SpatialEncoder.optimize_for_inference
+        """
+        self.eval()
+        if fold_bn:
+            util.fold_batch_norm(self.model)
+        if channels_last:
+            self.model.to(memory_format=torch.channels_last)
+            self.channels_last = True
+        if freeze:
+            self.frozen_model = torch.jit.freeze(torch.jit.script(self.model))
+        return self
+
     @classmethod
     def from_conf(cls, conf):
         return cls(
@@ -0,0 +1,270 @@
+"""
+Functional, TorchScript / torch.compile friendly inference graph for PixelNeRFNet.
+The encoded scene (what PixelNeRFNet.encode stores in buffers) is passed in
+explicitly and config flags are fixed at construction, so the per-point network
+has no Python-side state or branching.
+
+Usage:
+    net.encode(...)
+    point_net = freeze_inference(net)  # or torch.compile(PixelNeRFInference(net))
+    out = point_net(xyz, viewdirs, *scene_inputs(net))
+"""
+import torch
+from torch import nn
+import torch.nn.functional as F
+from typing import Optional, Tuple
+from .resnetfc import ResnetFC
+
+
+class _LatentResBlock(nn.Module):
+    """
+    ResnetBlockFC preceded by the latent injection (lin_z / scale_z) of ResnetFC
+    """
+
+    use_latent: torch.jit.Final[bool]
+    use_spade: torch.jit.Final[bool]
+
+    def __init__(self, block, lin_z=None, scale_z=None):
+        super().__init__()
+        self.block = block
+        self.use_latent = lin_z is not None
+        self.use_spade = scale_z is not None
+        self.lin_z = lin_z if lin_z is not None else nn.Identity()
+        self.scale_z = scale_z if scale_z is not None else nn.Identity()
+
+    def forward(self, x, z):
+        if self.use_latent:
+            tz = self.lin_z(z)
+            if self.use_spade:
+                x = self.scale_z(z) * x + tz
+            else:
+                x = x + tz
+        return self.block(x)
+
+
+class ResnetFCInference(nn.Module):
+    """
+    Inference-only ResnetFC, sharing the weights of the given module.
+    Blocks before combine_layer take the latent, view features are
+    combined at combine_layer, and the remaining blocks run on the combined features.
+    """
+
+    d_latent: torch.jit.Final[int]
+    d_hidden: torch.jit.Final[int]
+    has_input: torch.jit.Final[bool]
+    do_combine: torch.jit.Final[bool]
+    combine_max: torch.jit.Final[bool]
+
+    def __init__(self, mlp):
+        """
+        :param mlp ResnetFC
+        """
+        super().__init__()
+        assert type(mlp) is ResnetFC, "Only ResnetFC is supported"
+        assert mlp.combine_type in ("average", "max")
+        self.d_latent = mlp.d_latent
+        self.d_hidden = mlp.d_hidden
+        self.has_input = mlp.d_in > 0
+        self.lin_in = mlp.lin_in if self.has_input else nn.Identity()
+        self.lin_out = mlp.lin_out
+        self.activation = mlp.activation
+
+        n_pre = min(mlp.combine_layer, mlp.n_blocks)
+        self.do_combine = mlp.combine_layer < mlp.n_blocks
+        self.combine_max = mlp.combine_type == "max"
+        self.pre_blocks = nn.ModuleList(
+            [
+                _LatentResBlock(
+                    mlp.blocks[i],
+                    mlp.lin_z[i] if mlp.d_latent > 0 else None,
+                    mlp.scale_z[i] if mlp.d_latent > 0 and mlp.use_spade else None,
+                )
+                for i in range(n_pre)
+            ]
+        )
+        self.post_blocks = nn.ModuleList(mlp.blocks[n_pre:])
+
+    def forward(self, zx, num_views: int, num_points: int):
+        """
+        :param zx (SB * NS * B, d_latent + d_in)
+        :param num_views NS, views combined at combine_layer
+        :param num_points B
+        :return (SB * B, d_out) if combined else (SB * NS * B, d_out)
+        """
+        z = zx[..., : self.d_latent]
+        if self.has_input:
+            x = self.lin_in(zx[..., self.d_latent :])
+        else:
+            x = torch.zeros(self.d_hidden, device=zx.device)
+
+        for block in self.pre_blocks:
+            x = block(x, z)
+        if self.do_combine:
+            x = x.reshape(-1, num_views, num_points, x.shape[-1])
+            if self.combine_max:
+                x = torch.max(x, dim=1)[0]
+            else:
+                x = torch.mean(x, dim=1)
+        for block in self.post_blocks:
+            x = block(x)
+        return self.lin_out(self.activation(x))
+
+
+class PixelNeRFInference(nn.Module):
+    """
+    Functional equivalent of PixelNeRFNet.forward for one of its MLPs
+    """
+
+    use_xyz: torch.jit.Final[bool]
+    normalize_z: torch.jit.Final[bool]
+    use_code: torch.jit.Final[bool]
+    use_code_viewdirs: torch.jit.Final[bool]
+    use_viewdirs: torch.jit.Final[bool]
+    use_encoder: torch.jit.Final[bool]
+    use_global_encoder: torch.jit.Final[bool]
+    has_d_in: torch.jit.Final[bool]
+    d_out: torch.jit.Final[int]
+    latent_size: torch.jit.Final[int]
+    index_interp: torch.jit.Final[str]
+    index_padding: torch.jit.Final[str]
+
+    def __init__(self, net, coarse=True):
+        """
+        :param net PixelNeRFNet, weights are shared
+        :param coarse use the coarse MLP (else the fine MLP if present)
+        """
+        super().__init__()
+        self.use_xyz = net.use_xyz
+        self.normalize_z = net.normalize_z
+        self.use_code = net.use_code
+        self.use_code_viewdirs = net.use_code_viewdirs
+        self.use_viewdirs = net.use_viewdirs
+        self.use_encoder = net.use_encoder
+        self.use_global_encoder = net.use_global_encoder
+        self.has_d_in = net.d_in > 0
+        self.d_out = net.d_out
+        self.latent_size = net.latent_size
+        self.index_interp = net.encoder.index_interp.strip()
+        self.index_padding = net.encoder.index_padding
+        self.code = net.code if self.use_code else nn.Identity()
+        mlp = net.mlp_coarse if coarse or net.mlp_fine is None else net.mlp_fine
+        self.mlp = ResnetFCInference(mlp)
+
+    def forward(
+        self,
+        xyz,
+        viewdirs: Optional[torch.Tensor],
+        poses,
+        focal,
+        c,
+        image_shape,
+        latent,
+        latent_scaling,
+        global_latent: Optional[torch.Tensor] = None,
+    ):
+        """
+        :param xyz (SB, B, 3) world space points
+        :param viewdirs (SB, B, 3) or None if not use_viewdirs
+        :param poses (SB*NS, 3, 4) world -> camera, as PixelNeRFNet.poses
+        :param focal, c, image_shape as PixelNeRFNet buffers after encode
+        :param latent (SB*NS, L, H, W) SpatialEncoder.latent
+        :param latent_scaling (2) SpatialEncoder.latent_scaling
+        :param global_latent (SB*NS, G) ImageEncoder.latent if use_global_encoder
+        :return (SB, B, 4) r g b sigma
+        """
+        SB, B, _ = xyz.shape
+        NS = poses.shape[0] // SB
+
+        xyz = torch.repeat_interleave(xyz, NS, dim=0)  # (SB*NS, B, 3)
+        xyz_rot = torch.matmul(poses[:, None, :3, :3], xyz.unsqueeze(-1))[..., 0]
+        xyz = xyz_rot + poses[:, None, :3, 3]
+
+        mlp_input = torch.empty(0, device=xyz.device)
+        z_feature = torch.empty(0, device=xyz.device)
+        if self.has_d_in:
+            if self.use_xyz:
+                if self.normalize_z:
+                    z_feature = xyz_rot.reshape(-1, 3)
+                else:
+                    z_feature = xyz.reshape(-1, 3)
+            else:
+                if self.normalize_z:
+                    z_feature = -xyz_rot[..., 2].reshape(-1, 1)
+                else:
+                    z_feature = -xyz[..., 2].reshape(-1, 1)
+
+            if self.use_code and not self.use_code_viewdirs:
+                z_feature = self.code(z_feature)
+
+            if self.use_viewdirs:
+                assert viewdirs is not None
+                dirs = torch.repeat_interleave(viewdirs.reshape(SB, B, 3, 1), NS, dim=0)
+                dirs = torch.matmul(poses[:, None, :3, :3], dirs).reshape(-1, 3)
+                z_feature = torch.cat((z_feature, dirs), dim=1)
+
+            if self.use_code and self.use_code_viewdirs:
+                z_feature = self.code(z_feature)
+
+            mlp_input = z_feature
+
+        if self.use_encoder:
+            uv = -xyz[:, :, :2] / xyz[:, :, 2:]  # (SB*NS, B, 2)
+            uv = uv * torch.repeat_interleave(
+                focal.unsqueeze(1), NS if focal.shape[0] > 1 else 1, dim=0
+            )
+            uv = uv + torch.repeat_interleave(
+                c.unsqueeze(1), NS if c.shape[0] > 1 else 1, dim=0
+            )
+            uv = uv * (latent_scaling / image_shape) - 1.0
+            latent_feat = F.grid_sample(
+                latent,
+                uv.unsqueeze(2),
+                align_corners=True,
+                mode=self.index_interp,
+                padding_mode=self.index_padding,
+            )[:, :, :, 0]  # (SB*NS, L, B)
+            latent_feat = latent_feat.transpose(1, 2).reshape(-1, self.latent_size)
+            if self.has_d_in:
+                mlp_input = torch.cat((latent_feat, z_feature), dim=-1)
+            else:
+                mlp_input = latent_feat
+
+        if self.use_global_encoder:
+            assert global_latent is not None
+            num_repeats = mlp_input.shape[0] // global_latent.shape[0]
+            mlp_input = torch.cat(
+                (torch.repeat_interleave(global_latent, num_repeats, dim=0), mlp_input),
+                dim=-1,
+            )
+
+        mlp_output = self.mlp(mlp_input, NS, B).reshape(-1, B, self.d_out)
+        rgb = torch.sigmoid(mlp_output[..., :3])
+        sigma = torch.relu(mlp_output[..., 3:4])
+        return torch.cat((rgb, sigma), dim=-1).reshape(SB, B, -1)
+
+
+def scene_inputs(net):
+    """
+    Encoded scene tensors of a PixelNeRFNet (after encode), in the argument
+    order of PixelNeRFInference.forward after xyz, viewdirs
+    """
+    global_latent = net.global_encoder.latent if net.use_global_encoder else None
+    return (
+        net.poses,
+        net.focal,
+        net.c,
+        net.image_shape,
+        net.encoder.latent,
+        net.encoder.latent_scaling,
+        global_latent,
+    )
+
+
+def freeze_inference(net, coarse=True):
+    """
+    Script and freeze PixelNeRFInference for deployment.
+    :param net PixelNeRFNet with loaded weights
+    :return frozen ScriptModule with the signature of PixelNeRFInference.forward
+    """
+    module = PixelNeRFInference(net, coarse=coarse).eval()
+    return torch.jit.freeze(torch.jit.script(module))
@@ -50,6 +50,51 @@ def get_alpha_loss(conf):
     )
 
 
+class ProposalLoss(torch.nn.Module):
+    """
+    Proposal (interlevel) loss of mip-NeRF 360: the proposal weights, summed over
+    all proposal intervals overlapping a fine interval, should bound the (detached)
+    fine weight of that interval. Only the proposal MLP receives gradients
+    (PixelNeRFNet detaches its input on the proposal path).
+    """
+
+    def __init__(self, eps=1e-7):
+        super().__init__()
+        self.eps = eps
+
+    @staticmethod
+    def outer(z_edges, z_edges_env, weights_env):
+        """
+        Sum of the envelope weights over envelope intervals overlapping each interval
+        :param z_edges (..., K+1)
+        :param z_edges_env (..., Ke+1), weights_env (..., Ke)
+        :return (..., K)
+        """
+        cw = torch.cat(
+            (torch.zeros_like(weights_env[..., :1]), torch.cumsum(weights_env, -1)), -1
+        )  # (..., Ke+1)
+        last = z_edges_env.shape[-1] - 1
+        z_edges = z_edges.contiguous()
+        z_edges_env = z_edges_env.contiguous()
+        idx_hi = torch.searchsorted(z_edges_env, z_edges, right=True)
+        idx_lo = torch.clamp(idx_hi - 1, 0, last)
+        idx_hi = torch.clamp(idx_hi, 0, last)
+        cw_lo = torch.gather(cw, -1, idx_lo)
+        cw_hi = torch.gather(cw, -1, idx_hi)
+        return cw_hi[..., 1:] - cw_lo[..., :-1]
+
+    def forward(self, z_edges, weights, z_edges_prop, weights_prop):
+        """
+        :param z_edges, weights fine NeRF sample intervals (..., K+1) and weights (..., K)
+        :param z_edges_prop, weights_prop proposal intervals and weights
+        :return scalar, mean over rays
+        """
+        weights = weights.detach()
+        bound = self.outer(z_edges.detach(), z_edges_prop.detach(), weights_prop)
+        loss = torch.clamp_min(weights - bound, 0.0) ** 2 / (weights + self.eps)
+        return loss.sum(dim=-1).mean()
+
+
 class RGBWithUncertainty(torch.nn.Module):
     """Implement the uncertainty loss from Kendall '17"""
 
@@ -106,6 +151,7 @@ class ReferenceColorLoss(torch.nn.Module):
             param.requires_grad = False
         
         self.target_app_encodings = None
+        self.target_bank = None
         self.avg_pool = nn.AdaptiveAvgPool2d((1, 1))
         self.ref_loss = torch.torch.nn.MSELoss()
     
@@ -113,7 +159,28 @@ class ReferenceColorLoss(torch.nn.Module):
         self.target_app_encodings = self.ref_encoder(imgs)
         self.target_app_encodings = self.avg_pool(self.target_app_encodings)
         self.target_app_encodings = self.target_app_encodings.detach()
-    
+
+    def build_target_bank(self, imgs, batch_size=16):
+        """
+        Precompute target encodings of a bank of images, see sample_targets
+        :param imgs (N, 3, H, W)
+        """
+        with torch.no_grad():
+            bank = []
+            for batch in torch.split(imgs, batch_size):
+                self.encode_targets(batch)
+                bank.append(self.target_app_encodings)
+        self.target_bank = torch.cat(bank)  # (N, C, 1, 1)
+
+    def sample_targets(self, n=1):
+        """
+        Use n random encodings from the bank as targets instead of encode_targets
+        """
+        inds = torch.randint(
+            0, self.target_bank.shape[0], (n,), device=self.target_bank.device
+        )
+        self.target_app_encodings = self.target_bank[inds]
+
     def forward(self, outputs):
         outputs_encodings = self.ref_encoder(outputs)
         outputs_encodings = self.avg_pool(outputs_encodings)
@@ -1,5 +1,9 @@
+import torch
+from torch import nn
+import util
 from .encoder import SpatialEncoder, ImageEncoder
 from .resnetfc import ResnetFC, ResnetFC_App
+from .code import PositionalEncoding, HashGridEncoding
 
 
 def make_mlp(conf, d_in, d_latent=0, allow_empty=False, **kwargs):
@@ -26,3 +30,104 @@ def make_encoder(conf, **kwargs):
     else:
         raise NotImplementedError("Unsupported encoder type")
     return net
+
+
+def make_code(conf, d_in, **kwargs):
+    code_type = conf.get_string("type", "positional")  # positional | hash_grid
+    if code_type == "positional":
+        net = PositionalEncoding.from_conf(conf, d_in=d_in, **kwargs)
+    elif code_type == "hash_grid":
+        net = HashGridEncoding.from_conf(conf, d_in=d_in, **kwargs)
+    else:
+        raise NotImplementedError("Unsupported code type")
+    return net
+
+
+def quantize_mlp(mlp):
+    """
+    Dynamic int8 quantization of the nn.Linear layers of a point MLP
+    (weights int8, activations quantized on the fly). CPU only.
+    :param mlp ResnetFC / ResnetFC_App or None
+    :return quantized copy of mlp
+    """
+    if mlp is None:
+        return None
+    return torch.quantization.quantize_dynamic(mlp.eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+def export_encoded(net, path, quantize=False):
+    """
+    Save the state produced by net.encode() (and app_encoder.encode(), if any)
+    to a single memory-mappable file, see util.save_packed.
+    The file can be rendered from with load_encoded, without the source images
+    or a forward pass of the image encoder(s).
+    :param net PixelNeRFNet or PixelNeRFNet_A, after encode
+    :param path output file
+    :param quantize store the spatial latent as uint8 with per-channel ranges
+    instead of fp16
+    """
+    latent = net.encoder.latent.detach().cpu()
+    arrays = {
+        "poses": net.poses.detach().cpu().numpy(),
+        "focal": net.focal.detach().cpu().numpy(),
+        "c": net.c.detach().cpu().numpy(),
+        "image_shape": net.image_shape.detach().cpu().numpy(),
+    }
+    if hasattr(net.encoder, "latent_scaling"):
+        arrays["latent_scaling"] = net.encoder.latent_scaling.detach().cpu().numpy()
+    if quantize:
+        q, lo, scale = util.quantize_uint8(latent)
+        arrays["latent"] = q.numpy()
+        arrays["latent_lo"] = lo.numpy()
+        arrays["latent_scale"] = scale.numpy()
+    else:
+        arrays["latent"] = latent.half().numpy()
+    if net.use_global_encoder:
+        arrays["global_latent"] = net.global_encoder.latent.detach().cpu().numpy()
+    if getattr(net, "app_enc_on", False) and net.app_encoder.app_encoding is not None:
+        arrays["app_encoding"] = net.app_encoder.app_encoding.detach().cpu().numpy()
+    meta = {
+        "num_objs": net.num_objs,
+        "num_views_per_obj": net.num_views_per_obj,
+        "quantize": quantize,
+    }
+    util.save_packed(path, arrays, meta)
+
+
+def load_encoded(net, path, device=None):
+    """
+    Restore the encoded state saved by export_encoded into net,
+    in place of calling net.encode()
+    :param net PixelNeRFNet or PixelNeRFNet_A with a compatible config
+    :param path file written by export_encoded
+    :param device device to load to, default is the device of net
+    """
+    if device is None:
+        device = net.poses.device
+    arrays, meta = util.load_packed(path)
+
+    def tensor(name):
+        return torch.tensor(arrays[name], device=device)
+
+    if meta["quantize"]:
+        latent = util.dequantize_uint8(
+            tensor("latent"), tensor("latent_lo"), tensor("latent_scale")
+        )
+    else:
+        latent = tensor("latent").float()
+    assert latent.shape[1] == net.encoder.latent_size, "Latent size mismatch"
+    net.encoder.latent = latent
+    if "latent_scaling" in arrays:
+        net.encoder.latent_scaling = tensor("latent_scaling")
+
+    net.poses = tensor("poses")
+    net.focal = tensor("focal")
+    net.c = tensor("c")
+    net.image_shape = tensor("image_shape")
+    net.num_objs = meta["num_objs"]
+    net.num_views_per_obj = meta["num_views_per_obj"]
+    if net.use_global_encoder:
+        net.global_encoder.latent = tensor("global_latent")
+    if "app_encoding" in arrays and getattr(net, "app_enc_on", False):
+        net.app_encoder.app_encoding = tensor("app_encoding")
+    return net
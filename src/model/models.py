@@ -3,8 +3,14 @@ Main model implementation
 """
 import torch
 from .encoder import ImageEncoder
-from .code import PositionalEncoding
-from .model_util import make_encoder, make_mlp
+from .model_util import (
+    make_encoder,
+    make_mlp,
+    make_code,
+    quantize_mlp,
+    export_encoded,
+    load_encoded,
+)
 import torch.autograd.profiler as profiler
 from util import repeat_interleave
 import os
@@ -52,8 +58,8 @@ class PixelNeRFNet(torch.nn.Module):
             # Apply positional encoding to viewdirs
             d_in += 3
         if self.use_code and d_in > 0:
-            # Positional encoding for x,y,z OR view z
-            self.code = PositionalEncoding.from_conf(conf["code"], d_in=d_in)
+            # Positional (or hash grid, xyz only) encoding for x,y,z OR view z
+            self.code = make_code(conf["code"], d_in=d_in)
             d_in = self.code.d_out
         if self.use_viewdirs and not self.use_code_viewdirs:
             # Don't apply positional encoding to viewdirs (concat after encoded)
@@ -72,6 +78,12 @@ class PixelNeRFNet(torch.nn.Module):
         self.mlp_fine = make_mlp(
             conf["mlp_fine"], d_in, d_latent, d_out=d_out, allow_empty=True
         )
+        # Optional density-only MLP for cheap importance sampling (renderer use_proposal)
+        self.mlp_proposal = None
+        if "mlp_proposal" in conf:
+            self.mlp_proposal = make_mlp(
+                conf["mlp_proposal"], d_in, d_latent, d_out=1, allow_empty=True
+            )
         # Note: this is world -> camera, and bottom row is omitted
         self.register_buffer("poses", torch.empty(1, 3, 4), persistent=False)
         self.register_buffer("image_shape", torch.empty(2), persistent=False)
@@ -86,7 +98,7 @@ class PixelNeRFNet(torch.nn.Module):
         self.num_objs = 0
         self.num_views_per_obj = 1
 
-    def encode(self, images, poses, focal, z_bounds=None, c=None):
+    def encode(self, images, poses, focal, z_bounds=None, c=None, latents=None):
         """
         :param images (NS, 3, H, W)
         NS is number of input (aka source or reference) views
@@ -95,6 +107,8 @@ class PixelNeRFNet(torch.nn.Module):
         :param z_bounds ignored argument (used in the past)
         :param c principal point None or () or (2) or (NS) or (NS, 2) [cx, cy],
         default is center of image
+        :param latents optional precomputed per-level encoder latents
+        (list of (SB*NS, C_i, H_i, W_i), see data.LatentCache); skips the backbone
         """
         self.num_objs = images.size(0)
         if len(images.shape) == 5:
@@ -108,7 +122,10 @@ class PixelNeRFNet(torch.nn.Module):
         else:
             self.num_views_per_obj = 1
 
-        self.encoder(images)
+        if latents is not None:
+            self.encoder.set_latent(latents)
+        else:
+            self.encoder(images)
         rot = poses[:, :3, :3].transpose(1, 2)  # (B, 3, 3)
         trans = -torch.bmm(rot, poses[:, :3, 3:])  # (B, 3, 1)
         self.poses = torch.cat((rot, trans), dim=-1)  # (B, 3, 4)
@@ -143,11 +160,50 @@ class PixelNeRFNet(torch.nn.Module):
         if self.use_global_encoder:
             self.global_encoder(images)
 
-    def forward(self, xyz, coarse=True, viewdirs=None, far=False):
+    def export_encoded(self, path, quantize=False):
+        """
+        Save the encoded scene (after encode) to a single file,
+        see model_util.export_encoded
+        """
+        export_encoded(self, path, quantize=quantize)
+
+    def load_encoded(self, path):
+        """
+        Restore an encoded scene saved by export_encoded, instead of calling encode
+        """
+        return load_encoded(self, path)
+
+    def optimize_for_inference(self, **kwargs):
+        """
+        Optimize the image encoder(s) for inference, see
+        SpatialEncoder.optimize_for_inference for arguments.
+        Call after load_weights; encoders can no longer be trained afterwards.
+        """
+        self.encoder.optimize_for_inference(**kwargs)
+        if self.use_global_encoder:
+            self.global_encoder.optimize_for_inference(**kwargs)
+        return self
+
+    def quantize_mlps(self):
+        """
+        Replace mlp_coarse/mlp_fine with dynamically int8-quantized copies
+        for CPU inference. Call after load_weights; the MLPs can no longer be trained.
+        """
+        assert self.poses.device.type == "cpu", "Dynamic quantization is CPU only"
+        self.mlp_coarse = quantize_mlp(self.mlp_coarse)
+        self.mlp_fine = quantize_mlp(self.mlp_fine)
+        self.mlp_proposal = quantize_mlp(self.mlp_proposal)
+        return self
+
+    def forward(
+        self, xyz, coarse=True, viewdirs=None, far=False, app_pass=True, proposal=False
+    ):
         """
         Predict (r, g, b, sigma) at world space points xyz.
         Please call encode first!
         :param xyz (SB, B, 3)
+        :param app_pass ignored (compatibility with NeRFRenderer)
+        :param proposal if true, evaluate mlp_proposal and return only sigma (SB, B, 1)
         SB is batch of objects
         B is batch of points (in rays)
         NS is number of input views
@@ -238,6 +294,15 @@ class PixelNeRFNet(torch.nn.Module):
             combine_index = None
             dim_size = None
 
+            if proposal:
+                assert self.mlp_proposal is not None, "No mlp_proposal in config"
+                # Detached so the proposal loss only trains mlp_proposal, not the
+                # shared encoders (as in mip-NeRF 360, where nothing is shared)
+                sigma = self.mlp_proposal(
+                    mlp_input.detach(), combine_inner_dims=(self.num_views_per_obj, B),
+                )
+                return torch.relu(sigma).reshape(SB, B, 1)
+
             # Run main NeRF network
             if coarse or self.mlp_fine is None:
                 mlp_output = self.mlp_coarse(
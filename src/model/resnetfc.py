@@ -1,11 +1,30 @@
 from torch import nn
 import torch
+import torch.nn.functional as F
 
 #  import torch_scatter
 import torch.autograd.profiler as profiler
 import util
 
 
+def _slice_linear(lin, rows=None, cols=None):
+    """
+    Copy of nn.Linear keeping only the given output (rows) / input (cols) units
+    """
+    weight, bias = lin.weight.data, lin.bias.data if lin.bias is not None else None
+    if rows is not None:
+        weight = weight[rows]
+        bias = bias[rows] if bias is not None else None
+    if cols is not None:
+        weight = weight[:, cols]
+    new_lin = nn.Linear(weight.shape[1], weight.shape[0], bias=bias is not None)
+    new_lin = new_lin.to(device=weight.device, dtype=weight.dtype)
+    new_lin.weight.data.copy_(weight)
+    if bias is not None:
+        new_lin.bias.data.copy_(bias)
+    return new_lin
+
+
 # Resnet Blocks
 class ResnetBlockFC(nn.Module):
     """
@@ -61,6 +80,23 @@ class ResnetBlockFC(nn.Module):
                 x_s = x
             return x_s + dx
 
+    def prune_hidden(self, keep_in, keep_h, keep_out=None):
+        """
+        Remove hidden units in place, for structured pruning
+        :param keep_in indices of input units to keep
+        :param keep_h indices of inner (fc_0 output) units to keep
+        :param keep_out indices of output units to keep, default keep_in
+        (must equal keep_in without a shortcut layer)
+        """
+        if keep_out is None:
+            keep_out = keep_in
+        self.fc_0 = _slice_linear(self.fc_0, rows=keep_h, cols=keep_in)
+        self.fc_1 = _slice_linear(self.fc_1, rows=keep_out, cols=keep_h)
+        if self.shortcut is not None:
+            self.shortcut = _slice_linear(self.shortcut, rows=keep_out, cols=keep_in)
+        self.size_in, self.size_h, self.size_out = len(keep_in), len(keep_h), len(keep_out)
+
+
 class ResnetFC(nn.Module):
     def __init__(
         self,
@@ -182,6 +218,52 @@ class ResnetFC(nn.Module):
             out = self.lin_out(self.activation(x))
             return out
 
+    def weight_importance(self):
+        """
+        Weight-based importance of hidden units for prune_hidden:
+        L2 norm of all weights reading from / writing to each unit
+        :return residual stream scores (d_hidden), list of per-block inner scores
+        """
+        residual = self.lin_out.weight.norm(dim=0) ** 2
+        if self.d_in > 0:
+            residual = residual + self.lin_in.weight.norm(dim=1) ** 2
+        if self.d_latent > 0:
+            for lin_z in self.lin_z:
+                residual = residual + lin_z.weight.norm(dim=1) ** 2
+        inner = []
+        for block in self.blocks:
+            residual = residual + block.fc_0.weight.norm(dim=0) ** 2
+            residual = residual + block.fc_1.weight.norm(dim=1) ** 2
+            inner.append(
+                block.fc_0.weight.norm(dim=1) * block.fc_1.weight.norm(dim=0)
+            )
+        return residual.sqrt(), inner
+
+    def prune_hidden(self, d_hidden, residual_scores, inner_scores):
+        """
+        Structured pruning: keep the d_hidden highest scoring units of the residual
+        stream (consistently across lin_in, lin_z, scale_z, every block and lin_out)
+        and of each block's inner layer, in place. Output is a dense, narrower ResnetFC
+        equivalent to ResnetFC(..., d_hidden=d_hidden).
+        :param d_hidden new hidden size
+        :param residual_scores (self.d_hidden) importance of residual stream units
+        :param inner_scores list of (self.d_hidden) importance of inner units, per block
+        """
+        assert d_hidden <= self.d_hidden
+        keep = residual_scores.topk(d_hidden)[1].sort()[0]
+        if self.d_in > 0:
+            self.lin_in = _slice_linear(self.lin_in, rows=keep)
+        if self.d_latent > 0:
+            for i in range(len(self.lin_z)):
+                self.lin_z[i] = _slice_linear(self.lin_z[i], rows=keep)
+                if self.use_spade:
+                    self.scale_z[i] = _slice_linear(self.scale_z[i], rows=keep)
+        for block, scores in zip(self.blocks, inner_scores):
+            block.prune_hidden(keep, scores.topk(d_hidden)[1].sort()[0])
+        self.lin_out = _slice_linear(self.lin_out, cols=keep)
+        self.d_hidden = d_hidden
+        return self
+
     @classmethod
     def from_conf(cls, conf, d_in, **kwargs):
         # PyHocon construction
@@ -234,70 +316,135 @@ class ResnetFC_App(ResnetFC):
             )
 
     
+    def prune_hidden(self, d_hidden, residual_scores, inner_scores):
+        if self.app_enc_on:
+            raise NotImplementedError("Pruning with appearance blocks is not supported")
+        return super().prune_hidden(d_hidden, residual_scores, inner_scores)
+
+    def forward_f1(self, zx, combine_inner_dims=(1,)):
+        """
+        F1 blocks up to combine_layer and the multi-view combine,
+        which do not depend on the appearance encoding
+        :param zx (..., d_latent + d_in)
+        :param combine_inner_dims Combining dimensions for use with multiview inputs.
+        Tensor will be reshaped to (-1, combine_inner_dims, ...) and reduced using combine_type
+        on dim 1, at combine_layer
+        :return combined features (SB, B, d_hidden)
+        """
+        assert zx.size(-1) == self.d_latent + self.d_in
+        if self.d_latent > 0:
+            z = zx[..., : self.d_latent]
+            x = zx[..., self.d_latent :]
+        else:
+            x = zx
+        if self.d_in > 0:
+            x = self.lin_in(x)
+        else:
+            x = torch.zeros(self.d_hidden, device=zx.device)
+
+        # Run through the first F1 layers
+        for blkid in range(self.combine_layer):
+            if self.d_latent > 0 and blkid < self.combine_layer:
+                tz = self.lin_z[blkid](z)
+                if self.use_spade:
+                    sz = self.scale_z[blkid](z)
+                    x = sz * x + tz
+                else:
+                    x = x + tz
+
+            x = self.blocks[blkid](x)
+
+        # Combine the output given by the first F1 layers
+        x = util.combine_interleaved(x, combine_inner_dims, self.combine_type)
+        if self.stop_f1_grad:
+            x = x.detach()
+        return x
+
+    def forward_f2(self, x, app_enc=None):
+        """
+        Rest of the network after forward_f1: the regular pixelNeRF F2 if app_enc
+        is None, else the F2 for PixelNeRF-A
+        :param x (SB, B, d_hidden) output of forward_f1
+        :param app_enc (SB or 1, app_in) appearance encoding or None
+        :return (SB, B, d_out)
+        """
+        if app_enc is None:
+            for blkid in range(self.combine_layer, self.n_blocks):
+                x = self.blocks[blkid](x)
+        else:
+            B, D = app_enc.shape
+            _, C, _ = x.shape
+            x = torch.cat((app_enc.expand(B, C, D), x), dim=-1)
+            x = self.app_trans_block(x) # Use transition block to move to lower dim used by blocks
+            for blk in self.app_blocks:
+                x = blk(x)
+
+        # Final linear layer
+        return self.lin_out(self.activation(x))
+
     def forward(self, zx, app_enc, combine_inner_dims=(1,), combine_index=None, dim_size=None):
         """
         :param zx (..., d_latent + d_in)
+        :param app_enc (SB or 1, app_in) appearance encoding, or None for the regular F2
         :param combine_inner_dims Combining dimensions for use with multiview inputs.
         Tensor will be reshaped to (-1, combine_inner_dims, ...) and reduced using combine_type
         on dim 1, at combine_layer
         """
         with profiler.record_function("resnetfc_infer"):
-            assert zx.size(-1) == self.d_latent + self.d_in
-            if self.d_latent > 0:
-                z = zx[..., : self.d_latent]
-                x = zx[..., self.d_latent :]
-            else:
-                x = zx
-            if self.d_in > 0:
-                x = self.lin_in(x)
-            else:
-                x = torch.zeros(self.d_hidden, device=zx.device)
+            return self.forward_f2(self.forward_f1(zx, combine_inner_dims), app_enc)
 
-            # Run through the first F1 layers
-            blocks = self.blocks
-            for blkid in range(self.combine_layer):
-                if self.d_latent > 0 and blkid < self.combine_layer:
-                    tz = self.lin_z[blkid](z)
-                    if self.use_spade:
-                        sz = self.scale_z[blkid](z)
-                        x = sz * x + tz
-                    else:
-                        x = x + tz
-
-                x = blocks[blkid](x)
-            
-            # Combine the output given by the first F1 layers
-            x = util.combine_interleaved(
-                x, combine_inner_dims, self.combine_type
+    def _app_transition(self, x, app_enc, shared=None):
+        """
+        app_trans_block(cat(app_enc, x)) with the products of x computed once
+        and reused across appearance encodings (fc_0 and shortcut are split by columns);
+        quantized blocks are evaluated on the concatenation instead
+        :param x (SB, B, d_hidden)
+        :param app_enc (SB or 1, app_in)
+        :param shared value returned by a previous call with the same x, or None
+        :return (SB, B, d_hidden), shared
+        """
+        blk = self.app_trans_block
+        if not torch.is_tensor(getattr(blk.fc_0, "weight", None)) or not torch.is_tensor(
+            getattr(blk.shortcut, "weight", None)
+        ):
+            # Quantized layers (see PixelNeRFNet_A.quantize_mlps) cannot be split
+            a = app_enc.unsqueeze(1).expand(x.shape[0], x.shape[1], -1)
+            return blk(torch.cat((a, x), dim=-1)), None
+        D = app_enc.shape[-1]
+        if shared is None:
+            shared = (
+                F.linear(blk.activation(x), blk.fc_0.weight[:, D:]),
+                F.linear(x, blk.shortcut.weight[:, D:]),
             )
-            if self.stop_f1_grad:
-                x = x.detach()
-            
-            # Choose whether to continue using the rest of the regular pixelNeRF F2
-            # or use the F2 for PixelNeRF-A
-            cont_ind = self.combine_layer
-            end_ind = self.n_blocks
-            if app_enc is None:
-                cont_ind = self.combine_layer
-                end_ind = self.n_blocks
-            else:
-                blocks = self.app_blocks
-                cont_ind = 0
-                end_ind = len(self.app_blocks)
-
-                B, D = app_enc.shape
-                _, C, _ = x.shape
-                x = torch.cat((app_enc.expand(B, C, D), x), dim=-1)
-                x = self.app_trans_block(x) # Use transition block to move to lower dim used by blocks
-            
-            
-            # Continue rendering our pass through the network
-            for blkid in range(cont_ind, end_ind):
-                x = blocks[blkid](x)
-            
-            # Final linear layer
-            out = self.lin_out(self.activation(x))
-            return out
+        a = app_enc.unsqueeze(1)  # (SB or 1, 1, app_in)
+        net = shared[0] + F.linear(blk.activation(a), blk.fc_0.weight[:, :D], blk.fc_0.bias)
+        dx = blk.fc_1(blk.activation(net))
+        x_s = shared[1] + F.linear(a, blk.shortcut.weight[:, :D], blk.shortcut.bias)
+        return x_s + dx, shared
+
+    def forward_multi_app(self, zx, app_encs, combine_inner_dims=(1,)):
+        """
+        Evaluate several F2 branches on one F1 pass: F1, the combine and the
+        appearance-independent half of the transition block run once, so the cost
+        is about F1 + N * F2 instead of N * (F1 + F2)
+        :param zx (..., d_latent + d_in)
+        :param app_encs list of N appearance encodings (SB or 1, app_in),
+        or None entries for the regular F2
+        :return (SB, B, N, d_out)
+        """
+        with profiler.record_function("resnetfc_infer_multi"):
+            x = self.forward_f1(zx, combine_inner_dims)
+            shared = None
+            outs = []
+            for app_enc in app_encs:
+                if app_enc is None:
+                    outs.append(self.forward_f2(x))
+                    continue
+                h, shared = self._app_transition(x, app_enc, shared)
+                for blk in self.app_blocks:
+                    h = blk(h)
+                outs.append(self.lin_out(self.activation(h)))
+            return torch.stack(outs, dim=2)
 
     @classmethod
     def from_conf(cls, conf, d_in, **kwargs):
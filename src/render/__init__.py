@@ -1 +1,2 @@
 from .nerf import NeRFRenderer
+from .baked import BakedGrid
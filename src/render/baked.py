@@ -0,0 +1,302 @@
+"""
+Baked block-sparse voxel grid of an encoded PixelNeRF scene, for fast viewing.
+Density and colour are evaluated once on a grid of block_size^3 voxel blocks;
+blocks without any visible density are dropped, and per-voxel colour is stored
+as spherical harmonic coefficients fitted from several view directions
+(as in PlenOctrees). Rendering is then a grid lookup per sample instead of
+an MLP evaluation.
+
+Usage:
+    net.encode(...)
+    grid = BakedGrid.bake(net, bound=1.0)
+    grid.save("scene.bake")
+    rgb, depth = BakedGrid.load("scene.bake", device).render(rays)
+"""
+import math
+import numpy as np
+import torch
+import util
+
+SH_C0 = 0.28209479177387814
+SH_C1 = 0.4886025119029199
+SH_C2 = (
+    1.0925484305920792,
+    -1.0925484305920792,
+    0.31539156525252005,
+    -1.0925484305920792,
+    0.5462742152960396,
+)
+
+
+def eval_sh_basis(dirs, degree):
+    """
+    Real spherical harmonic basis
+    :param dirs (..., 3) unit directions
+    :param degree 0, 1 or 2
+    :return (..., (degree + 1) ** 2)
+    """
+    assert 0 <= degree <= 2, "SH degree must be 0, 1 or 2"
+    x, y, z = dirs.unbind(-1)
+    basis = [torch.full_like(x, SH_C0)]
+    if degree >= 1:
+        basis += [-SH_C1 * y, SH_C1 * z, -SH_C1 * x]
+    if degree >= 2:
+        basis += [
+            SH_C2[0] * x * y,
+            SH_C2[1] * y * z,
+            SH_C2[2] * (2.0 * z * z - x * x - y * y),
+            SH_C2[3] * x * z,
+            SH_C2[4] * (x * x - y * y),
+        ]
+    return torch.stack(basis, dim=-1)
+
+
+def fibonacci_sphere(n, device="cpu"):
+    """
+    n roughly uniformly spread unit directions (n, 3)
+    """
+    i = torch.arange(n, dtype=torch.float32, device=device) + 0.5
+    z = 1.0 - 2.0 * i / n
+    r = torch.sqrt(torch.clamp_min(1.0 - z * z, 0.0))
+    phi = math.pi * (3.0 - math.sqrt(5.0)) * i
+    return torch.stack((r * torch.cos(phi), r * torch.sin(phi), z), dim=-1)
+
+
+class BakedGrid(torch.nn.Module):
+    """
+    Block-sparse voxel grid with per-voxel density and SH colour
+    :param bound_lo, bound_hi (3) world space box covered by the grid
+    :param block_index (Rb, Rb, Rb) long, block id or -1 if empty
+    :param sigma (NB, bs^3) density per voxel
+    :param sh (NB, bs^3, 3, (sh_degree + 1) ** 2) SH coefficients of rgb
+    """
+
+    def __init__(self, bound_lo, bound_hi, block_index, sigma, sh, sh_degree):
+        super().__init__()
+        self.register_buffer("bound_lo", bound_lo.float())
+        self.register_buffer("bound_hi", bound_hi.float())
+        self.register_buffer("block_index", block_index.long())
+        self.register_buffer("sigma", sigma)
+        self.register_buffer("sh", sh)
+        self.sh_degree = sh_degree
+        self.num_blocks_axis = block_index.shape[0]
+        self.block_size = round(sigma.shape[1] ** (1.0 / 3.0))
+        self.resolution = self.num_blocks_axis * self.block_size
+
+    @property
+    def voxel_size(self):
+        return (self.bound_hi - self.bound_lo) / self.resolution  # (3)
+
+    @staticmethod
+    def _query(net, xyz, dirs, coarse, chunk):
+        """
+        Evaluate net at (N, 3) points with (N, 3) view directions, in chunks
+        :return (N, 4) rgb sigma
+        """
+        out = []
+        for pts, d in zip(torch.split(xyz, chunk), torch.split(dirs, chunk)):
+            out.append(net(pts[None], coarse=coarse, viewdirs=d[None])[0])
+        return torch.cat(out)
+
+    @classmethod
+    def bake(
+        cls,
+        net,
+        bound=1.0,
+        center=(0.0, 0.0, 0.0),
+        resolution=128,
+        block_size=8,
+        alpha_thresh=0.01,
+        sh_degree=2,
+        n_dirs=16,
+        n_probe=4,
+        coarse=False,
+        chunk=65536,
+    ):
+        """
+        Bake the scene currently encoded in net (one object).
+        :param net PixelNeRFNet after encode()
+        :param bound half extent of the baked cube around center
+        :param resolution voxels per axis, multiple of block_size
+        :param alpha_thresh blocks / voxels whose opacity over one voxel
+        stays below this are considered empty
+        :param n_dirs view directions used to fit SH colour (>= (sh_degree + 1) ** 2)
+        :param n_probe density probes per block axis used to find occupied blocks
+        :param coarse bake the coarse instead of the fine MLP
+        :return BakedGrid
+        """
+        assert resolution % block_size == 0, "resolution must be a multiple of block_size"
+        assert net.num_objs == 1, "Encode a single object before baking"
+        n_sh = (sh_degree + 1) ** 2
+        assert n_dirs >= n_sh, "Need at least as many directions as SH coefficients"
+        device = net.poses.device
+        center = torch.tensor(center, dtype=torch.float32, device=device)
+        bound_lo, bound_hi = center - bound, center + bound
+        Rb = resolution // block_size
+        voxel = 2.0 * bound / resolution
+        sigma_thresh = -math.log(1.0 - alpha_thresh) / voxel
+
+        def grid_points(n, origin, spacing):
+            """ Cell centers of an n^3 grid (n^3, 3) """
+            r = (torch.arange(n, dtype=torch.float32, device=device) + 0.5) * spacing
+            g = torch.stack(torch.meshgrid(r, r, r), dim=-1).reshape(-1, 3)
+            return origin + g
+
+        # 1. Find occupied blocks from density probes (random view directions)
+        probes = grid_points(Rb * n_probe, bound_lo, 2.0 * bound / (Rb * n_probe))
+        dirs = torch.nn.functional.normalize(torch.randn_like(probes), dim=-1)
+        sigma = cls._query(net, probes, dirs, coarse, chunk)[:, 3]
+        sigma = sigma.reshape(Rb, n_probe, Rb, n_probe, Rb, n_probe)
+        occupied = sigma.amax(dim=(1, 3, 5)) > sigma_thresh  # (Rb, Rb, Rb)
+        # Dilate by one block so thin structures between probes are kept
+        occupied = (
+            torch.nn.functional.max_pool3d(
+                occupied[None, None].float(), 3, stride=1, padding=1
+            )[0, 0]
+            > 0
+        )
+        block_coords = occupied.nonzero()  # (NB, 3)
+        NB = block_coords.shape[0]
+        print("Occupied blocks", NB, "/", Rb ** 3)
+
+        # 2. Dense evaluation of occupied blocks
+        local = grid_points(block_size, torch.zeros(3, device=device), voxel)
+        xyz = (
+            bound_lo + block_coords.float()[:, None] * (block_size * voxel) + local[None]
+        ).reshape(-1, 3)  # (NB * bs^3, 3)
+        sh_dirs = fibonacci_sphere(n_dirs, device=device)  # (D, 3)
+        basis = eval_sh_basis(sh_dirs, sh_degree)  # (D, n_sh)
+        fit = torch.pinverse(basis)  # (n_sh, D)
+        sigma = torch.zeros(xyz.shape[0], device=device)
+        sh = torch.zeros(xyz.shape[0], 3, n_sh, device=device)
+        for d in range(n_dirs):
+            out = cls._query(net, xyz, sh_dirs[d].expand_as(xyz), coarse, chunk)
+            sigma += out[:, 3] / n_dirs
+            sh += out[:, :3, None] * fit[None, None, :, d]
+        sigma = sigma.reshape(NB, -1)
+        sh = sh.reshape(NB, -1, 3, n_sh)
+
+        # 3. Drop blocks that turned out empty
+        keep = sigma.amax(dim=1) > sigma_thresh
+        sigma, sh, block_coords = sigma[keep], sh[keep], block_coords[keep]
+        sigma = torch.where(sigma > sigma_thresh, sigma, torch.zeros_like(sigma))
+        block_index = torch.full((Rb, Rb, Rb), -1, dtype=torch.long, device=device)
+        block_index[block_coords.unbind(-1)] = torch.arange(
+            block_coords.shape[0], device=device
+        )
+        print("Kept blocks", block_coords.shape[0])
+        return cls(bound_lo, bound_hi, block_index, sigma.half(), sh.half(), sh_degree)
+
+    def save(self, path):
+        """
+        Save to a single memory-mappable file (util.save_packed)
+        """
+        util.save_packed(
+            path,
+            {
+                "block_index": self.block_index.int().cpu().numpy(),
+                "sigma": self.sigma.cpu().numpy(),
+                "sh": self.sh.cpu().numpy(),
+            },
+            meta={
+                "bound_lo": self.bound_lo.tolist(),
+                "bound_hi": self.bound_hi.tolist(),
+                "sh_degree": self.sh_degree,
+            },
+        )
+
+    @classmethod
+    def load(cls, path, device="cpu"):
+        arrays, meta = util.load_packed(path, mmap=False)
+        return cls(
+            torch.tensor(meta["bound_lo"]),
+            torch.tensor(meta["bound_hi"]),
+            torch.from_numpy(arrays["block_index"].astype(np.int64)),
+            torch.from_numpy(arrays["sigma"].copy()),
+            torch.from_numpy(arrays["sh"].copy()),
+            meta["sh_degree"],
+        ).to(device=device)
+
+    def lookup(self, points, dirs):
+        """
+        Nearest-voxel density and colour
+        :param points (N, 3) world space
+        :param dirs (N, 3) unit view directions
+        :return sigma (N), rgb (N, 3)
+        """
+        vox = torch.floor((points - self.bound_lo) / self.voxel_size).long()
+        inside = ((vox >= 0) & (vox < self.resolution)).all(dim=-1)
+        vox = vox.clamp(0, self.resolution - 1)
+        bs = self.block_size
+        blk = vox // bs
+        bid = self.block_index[blk[:, 0], blk[:, 1], blk[:, 2]]
+        hit = (inside & (bid >= 0)).nonzero()[:, 0]
+
+        sigma = torch.zeros(points.shape[0], device=points.device)
+        rgb = torch.zeros(points.shape[0], 3, device=points.device)
+        if hit.shape[0] > 0:
+            loc = vox[hit] % bs
+            loc = (loc[:, 0] * bs + loc[:, 1]) * bs + loc[:, 2]
+            sigma[hit] = self.sigma[bid[hit], loc].float()
+            coef = self.sh[bid[hit], loc].float()  # (M, 3, n_sh)
+            basis = eval_sh_basis(dirs[hit], self.sh_degree)  # (M, n_sh)
+            rgb[hit] = torch.clamp((coef * basis[:, None]).sum(-1), 0.0, 1.0)
+        return sigma, rgb
+
+    def render(self, rays, white_bkgd=False, step_scale=1.0, seg_steps=64, t_thresh=1e-3):
+        """
+        Volume render rays through the grid with one sample per voxel step.
+        Rays are marched in segments and dropped once they are opaque.
+        :param rays [origins (3), directions (3), near (1), far (1)] (N, 8)
+        :param step_scale sample step relative to the voxel size
+        :param seg_steps samples per ray processed per segment
+        :param t_thresh transmittance below which a ray is terminated
+        :return rgb (N, 3), depth (N)
+        """
+        N = rays.shape[0]
+        device = rays.device
+        origins, dirs = rays[:, :3], rays[:, 3:6]
+        near, far = rays[:, 6], rays[:, 7]
+
+        # Clip to the grid box (slab test)
+        inv = 1.0 / torch.where(dirs.abs() < 1e-9, torch.full_like(dirs, 1e-9), dirs)
+        t0 = (self.bound_lo - origins) * inv
+        t1 = (self.bound_hi - origins) * inv
+        t_enter = torch.max(torch.min(t0, t1).amax(-1), near)
+        t_exit = torch.min(torch.max(t0, t1).amin(-1), far)
+
+        step = self.voxel_size.min().item() * step_scale
+        n_steps = int(math.ceil((t_exit - t_enter).clamp_min(0.0).max().item() / step))
+
+        rgb = torch.zeros(N, 3, device=device)
+        depth = torch.zeros(N, device=device)
+        trans = torch.ones(N, device=device)
+        active = (t_exit > t_enter).nonzero()[:, 0]
+        for s in range(0, n_steps, seg_steps):
+            if active.shape[0] == 0:
+                break
+            K = min(seg_steps, n_steps - s)
+            t = (
+                t_enter[active, None]
+                + (torch.arange(K, device=device, dtype=torch.float32) + s + 0.5) * step
+            )  # (A, K)
+            valid = t < t_exit[active, None]
+            points = origins[active, None] + t[..., None] * dirs[active, None]
+            d = dirs[active, None].expand(-1, K, -1)
+            sigma, color = self.lookup(points.reshape(-1, 3), d.reshape(-1, 3))
+            sigma = sigma.reshape(-1, K) * valid
+            color = color.reshape(-1, K, 3)
+
+            alpha = 1.0 - torch.exp(-sigma * step)  # (A, K)
+            T = torch.cumprod(
+                torch.cat((torch.ones_like(alpha[:, :1]), 1.0 - alpha + 1e-10), -1), -1
+            )
+            weights = alpha * T[:, :-1] * trans[active, None]  # (A, K)
+            rgb[active] += (weights[..., None] * color).sum(1)
+            depth[active] += (weights * t).sum(1)
+            trans[active] = trans[active] * T[:, -1]
+            active = active[trans[active] > t_thresh]
+
+        if white_bkgd:
+            rgb = rgb + trans[:, None]
+        return rgb, depth
@@ -19,7 +19,7 @@ class _RenderWrapper(torch.nn.Module):
         self.renderer = renderer
         self.simple_output = simple_output
 
-    def forward(self, rays, want_weights=False, app_pass=True):
+    def forward(self, rays, want_weights=False, app_pass=True, multi_app=False):
         if rays.shape[0] == 0:
             return (
                 torch.zeros(0, 3, device=rays.device),
@@ -27,16 +27,20 @@ class _RenderWrapper(torch.nn.Module):
             )
 
         outputs = self.renderer(
-            self.net, rays, want_weights=want_weights and not self.simple_output, app_pass=app_pass
+            self.net,
+            rays,
+            want_weights=want_weights and not self.simple_output,
+            app_pass=app_pass,
+            multi_app=multi_app,
         )
         if self.simple_output:
-            if self.renderer.using_fine:
-                rgb = outputs.fine.rgb
-                depth = outputs.fine.depth
+            if "surface" in outputs:
+                final = outputs.surface
+            elif "fine" in outputs:
+                final = outputs.fine
             else:
-                rgb = outputs.coarse.rgb
-                depth = outputs.coarse.depth
-            return rgb, depth
+                final = outputs.coarse
+            return final.rgb, final.depth
         else:
             # Make DotMap to dict to support DataParallel
             return outputs.toDict()
@@ -57,6 +61,15 @@ class NeRFRenderer(torch.nn.Module):
     sched[0] is list of iteration numbers,
     sched[1] is list of coarse sample numbers,
     sched[2] is list of fine sample numbers
+    :param use_proposal if true, the n_coarse samples are evaluated with the model's
+    density-only proposal MLP (forward(..., proposal=True)) instead of the coarse NeRF,
+    and the fine NeRF only runs on the n_fine importance samples.
+    Outputs then have 'proposal' (weights, depth) and 'fine' but no 'coarse'.
+    :param surface if true, render only at the first density crossing along each ray
+    (see render_surface); outputs then only have 'surface' (rgb, depth, hit)
+    :param surface_steps number of density samples of the surface march
+    :param surface_bisect number of bisection steps refining the crossing
+    :param surface_sigma density threshold defining the surface
     """
 
     def __init__(
@@ -70,6 +83,11 @@ class NeRFRenderer(torch.nn.Module):
         white_bkgd=False,
         lindisp=False,
         sched=None,  # ray sampling schedule for coarse and fine rays
+        use_proposal=False,
+        surface=False,
+        surface_steps=16,
+        surface_bisect=6,
+        surface_sigma=10.0,
     ):
         super().__init__()
         self.n_coarse = n_coarse
@@ -85,6 +103,13 @@ class NeRFRenderer(torch.nn.Module):
         if lindisp:
             print("Using linear displacement rays")
         self.using_fine = n_fine > 0
+        self.use_proposal = use_proposal
+        if use_proposal:
+            assert self.using_fine, "use_proposal requires n_fine > 0"
+        self.surface = surface
+        self.surface_steps = surface_steps
+        self.surface_bisect = surface_bisect
+        self.surface_sigma = surface_sigma
         self.sched = sched
         if sched is not None and len(sched) == 0:
             self.sched = None
@@ -160,7 +185,17 @@ class NeRFRenderer(torch.nn.Module):
         z_samp = torch.max(torch.min(z_samp, rays[:, -1:]), rays[:, -2:-1])
         return z_samp
 
-    def composite(self, model, rays, z_samp, coarse=True, app_pass=True, sb=0):
+    def composite(
+        self,
+        model,
+        rays,
+        z_samp,
+        coarse=True,
+        app_pass=True,
+        sb=0,
+        proposal=False,
+        multi_app=False,
+    ):
         """
         Render RGB and depth for each ray using NeRF alpha-compositing formula,
         given sampled positions along each ray (see sample_*)
@@ -170,7 +205,12 @@ class NeRFRenderer(torch.nn.Module):
         :param z_samp z positions sampled for each ray (B, K)
         :param coarse whether to evaluate using coarse NeRF
         :param sb super-batch dimension; 0 = disable
-        :return weights (B, K), rgb (B, 3), depth (B)
+        :param proposal evaluate the model's proposal MLP (B, (sigma)); rgb is None
+        :param multi_app evaluate N appearance branches on one trunk pass, the model
+        returning (B, N * 4) (see PixelNeRFNet_A.forward); each branch is composited
+        separately
+        :return weights (B, K), rgb (B, 3), depth (B);
+        with multi_app weights (B, N, K), rgb (B, N, 3), depth (B, N)
         """
         with profiler.record_function("renderer_composite"):
             B, K = z_samp.shape
@@ -187,6 +227,12 @@ class NeRFRenderer(torch.nn.Module):
 
             use_viewdirs = hasattr(model, "use_viewdirs") and model.use_viewdirs
 
+            model_kwargs = {"coarse": coarse, "app_pass": app_pass}
+            if proposal:
+                model_kwargs["proposal"] = True
+            if multi_app:
+                model_kwargs["multi_app"] = True
+
             val_all = []
             if sb > 0:
                 points = points.reshape(
@@ -210,18 +256,29 @@ class NeRFRenderer(torch.nn.Module):
                     viewdirs, eval_batch_size, dim=eval_batch_dim
                 )
                 for pnts, dirs in zip(split_points, split_viewdirs):
-                    val_all.append(model(pnts, coarse=coarse, viewdirs=dirs, app_pass=app_pass))
+                    val_all.append(model(pnts, viewdirs=dirs, **model_kwargs))
             else:
                 for pnts in split_points:
-                    val_all.append(model(pnts, coarse=coarse, app_pass=app_pass))
+                    val_all.append(model(pnts, **model_kwargs))
             points = None
             viewdirs = None
             # (B*K, 4) OR (SB, B'*K, 4)
             out = torch.cat(val_all, dim=eval_batch_dim)
             out = out.reshape(B, K, -1)  # (B, K, 4 or 5)
 
-            rgbs = out[..., :3]  # (B, K, 3)
-            sigmas = out[..., 3]  # (B, K)
+            if proposal:
+                rgbs = None
+                sigmas = out[..., 0]  # (B, K)
+            elif multi_app:
+                # Composite the N branches independently, branch dim before K
+                out = out.reshape(B, K, -1, 4).transpose(1, 2)  # (B, N, K, 4)
+                rgbs = out[..., :3]  # (B, N, K, 3)
+                sigmas = out[..., 3]  # (B, N, K)
+                deltas = deltas.unsqueeze(1)  # (B, 1, K)
+                z_samp = z_samp.unsqueeze(1)  # (B, 1, K)
+            else:
+                rgbs = out[..., :3]  # (B, K, 3)
+                sigmas = out[..., 3]  # (B, K)
             if self.training and self.noise_std > 0.0:
                 sigmas = sigmas + torch.randn_like(sigmas) * self.noise_std
 
@@ -229,18 +286,20 @@ class NeRFRenderer(torch.nn.Module):
             deltas = None
             sigmas = None
             alphas_shifted = torch.cat(
-                [torch.ones_like(alphas[:, :1]), 1 - alphas + 1e-10], -1
+                [torch.ones_like(alphas[..., :1]), 1 - alphas + 1e-10], -1
             )  # (B, K+1) = [1, a1, a2, ...]
             T = torch.cumprod(alphas_shifted, -1)  # (B)
-            weights = alphas * T[:, :-1]  # (B, K)
+            weights = alphas * T[..., :-1]  # (B, K)
             alphas = None
             alphas_shifted = None
 
-            rgb_final = torch.sum(weights.unsqueeze(-1) * rgbs, -2)  # (B, 3)
             depth_final = torch.sum(weights * z_samp, -1)  # (B)
+            if proposal:
+                return weights, None, depth_final
+            rgb_final = torch.sum(weights.unsqueeze(-1) * rgbs, -2)  # (B, 3)
             if self.white_bkgd:
                 # White background
-                pix_alpha = weights.sum(dim=1)  # (B), pixel alpha
+                pix_alpha = weights.sum(dim=-1)  # (B), pixel alpha
                 rgb_final = rgb_final + 1 - pix_alpha.unsqueeze(-1)  # (B, 3)
             return (
                 weights,
@@ -249,7 +308,7 @@ class NeRFRenderer(torch.nn.Module):
             )
 
     def forward(
-        self, model, rays, app_pass=True, want_weights=False,
+        self, model, rays, app_pass=True, want_weights=False, multi_app=False,
     ):
         """
         :model nerf model, should return (SB, B, (r, g, b, sigma))
@@ -259,6 +318,11 @@ class NeRFRenderer(torch.nn.Module):
         Should also support 'coarse' boolean argument for coarse NeRF.
         :param rays ray spec [origins (3), directions (3), near (1), far (1)] (SB, B, 8)
         :param want_weights if true, returns compositing weights (SB, B, K)
+        and sample interval edges z_edges (SB, B, K+1)
+        :param multi_app render N appearance branches sharing one trunk pass per sample
+        (see composite); outputs get a branch dim after B, e.g. rgb (SB, B, N, 3).
+        Fine samples are drawn from the branch-averaged coarse weights.
+        Split the result with util.split_multi_render_dict.
         :return render dict
         """
         with profiler.record_function("renderer_forward"):
@@ -270,9 +334,30 @@ class NeRFRenderer(torch.nn.Module):
             superbatch_size = rays.shape[0]
             rays = rays.reshape(-1, 8)  # (SB * B, 8)
 
+            if multi_app:
+                assert (
+                    not self.surface and not self.use_proposal
+                ), "multi_app only supports regular coarse/fine rendering"
+            if self.surface:
+                return DotMap(
+                    surface=self.render_surface(
+                        model, rays, sb=superbatch_size, app_pass=app_pass
+                    )
+                )
+            if self.use_proposal:
+                return self._forward_proposal(
+                    model, rays, superbatch_size, app_pass, want_weights
+                )
+
             z_coarse = self.sample_coarse(rays)  # (B, Kc)
             coarse_composite = self.composite(
-                model, rays, z_coarse, coarse=True, app_pass=app_pass, sb=superbatch_size,
+                model,
+                rays,
+                z_coarse,
+                coarse=True,
+                app_pass=app_pass,
+                sb=superbatch_size,
+                multi_app=multi_app,
             )
 
             outputs = DotMap(
@@ -282,19 +367,29 @@ class NeRFRenderer(torch.nn.Module):
             )
 
             if self.using_fine:
+                coarse_weights, coarse_depth = coarse_composite[0], coarse_composite[2]
+                if multi_app:
+                    coarse_weights = coarse_weights.mean(dim=1)
+                    coarse_depth = coarse_depth.mean(dim=1)
                 all_samps = [z_coarse]
                 if self.n_fine - self.n_fine_depth > 0:
                     all_samps.append(
-                        self.sample_fine(rays, coarse_composite[0].detach())
+                        self.sample_fine(rays, coarse_weights.detach())
                     )  # (B, Kf - Kfd)
                 if self.n_fine_depth > 0:
                     all_samps.append(
-                        self.sample_fine_depth(rays, coarse_composite[2])
+                        self.sample_fine_depth(rays, coarse_depth)
                     )  # (B, Kfd)
                 z_combine = torch.cat(all_samps, dim=-1)  # (B, Kc + Kf)
                 z_combine_sorted, argsort = torch.sort(z_combine, dim=-1)
                 fine_composite = self.composite(
-                    model, rays, z_combine_sorted, coarse=False, app_pass=app_pass, sb=superbatch_size,
+                    model,
+                    rays,
+                    z_combine_sorted,
+                    coarse=False,
+                    app_pass=app_pass,
+                    sb=superbatch_size,
+                    multi_app=multi_app,
                 )
                 outputs.fine = self._format_outputs(
                     fine_composite, superbatch_size, want_weights=want_weights,
@@ -302,17 +397,151 @@ class NeRFRenderer(torch.nn.Module):
 
             return outputs
 
+    def _forward_proposal(self, model, rays, superbatch_size, app_pass, want_weights):
+        """
+        Proposal sampling: the proposal MLP's weights on the n_coarse stratified
+        samples drive importance sampling, and the fine NeRF runs only on the
+        resulting n_fine samples
+        :param rays (SB * B, 8)
+        """
+        z_prop = self.sample_coarse(rays)  # (B, Kc)
+        prop_composite = self.composite(
+            model, rays, z_prop, sb=superbatch_size, proposal=True
+        )
+        outputs = DotMap(
+            proposal=self._format_outputs(
+                prop_composite, superbatch_size, want_weights, rays, z_prop
+            ),
+        )
+
+        all_samps = []
+        if self.n_fine - self.n_fine_depth > 0:
+            all_samps.append(
+                self.sample_fine(rays, prop_composite[0].detach())
+            )  # (B, Kf - Kfd)
+        if self.n_fine_depth > 0:
+            all_samps.append(
+                self.sample_fine_depth(rays, prop_composite[2].detach())
+            )  # (B, Kfd)
+        z_fine, _ = torch.sort(torch.cat(all_samps, dim=-1), dim=-1)  # (B, Kf)
+        fine_composite = self.composite(
+            model, rays, z_fine, coarse=False, app_pass=app_pass, sb=superbatch_size,
+        )
+        outputs.fine = self._format_outputs(
+            fine_composite, superbatch_size, want_weights, rays, z_fine
+        )
+        return outputs
+
+    def _query(self, model, rays, z_samp, coarse=True, app_pass=True, sb=0):
+        """
+        Evaluate the model at the given depths along each ray, in batches
+        :param rays (B, 8)
+        :param z_samp (B, K)
+        :return (B, K, 4) r g b sigma
+        """
+        B, K = z_samp.shape
+        points = rays[:, None, :3] + z_samp.unsqueeze(2) * rays[:, None, 3:6]
+        viewdirs = rays[:, None, 3:6].expand(-1, K, -1)
+        if sb > 0:
+            points = points.reshape(sb, -1, 3)
+            viewdirs = viewdirs.reshape(sb, -1, 3)
+            eval_batch_size = (self.eval_batch_size - 1) // sb + 1
+            eval_batch_dim = 1
+        else:
+            points = points.reshape(-1, 3)
+            viewdirs = viewdirs.reshape(-1, 3)
+            eval_batch_size = self.eval_batch_size
+            eval_batch_dim = 0
+        use_viewdirs = hasattr(model, "use_viewdirs") and model.use_viewdirs
+        val_all = []
+        for pnts, dirs in zip(
+            torch.split(points, eval_batch_size, dim=eval_batch_dim),
+            torch.split(viewdirs, eval_batch_size, dim=eval_batch_dim),
+        ):
+            val_all.append(
+                model(
+                    pnts,
+                    coarse=coarse,
+                    viewdirs=dirs if use_viewdirs else None,
+                    app_pass=app_pass,
+                )
+            )
+        return torch.cat(val_all, dim=eval_batch_dim).reshape(B, K, -1)
+
+    def render_surface(self, model, rays, sb=0, app_pass=True):
+        """
+        Surface rendering for previews: march surface_steps queries of the coarse
+        network to the first sample with sigma > surface_sigma and refine the crossing
+        by bisection. The colour is the one the coarse network returned at the refined
+        crossing, so there is no extra colour query and no volume compositing.
+        The defaults (16 + 6 queries) cost about a third of the n_coarse = 64 coarse pass.
+        :param rays (B, 8)
+        :param sb super-batch dimension; 0 = disable
+        :return DotMap rgb (SB, B', 3), depth (SB, B'), hit (SB, B') bool;
+        rays without a crossing get the background colour and depth 0
+        """
+        with profiler.record_function("renderer_surface"):
+            B = rays.shape[0]
+            near, far = rays[:, -2:-1], rays[:, -1:]  # (B, 1)
+            steps = (
+                torch.arange(self.surface_steps, device=rays.device, dtype=torch.float32)
+                + 0.5
+            ) / self.surface_steps
+            steps = steps.unsqueeze(0)  # (1, K)
+            if not self.lindisp:
+                z_samp = near * (1 - steps) + far * steps  # (B, K)
+            else:
+                z_samp = 1 / (1 / near * (1 - steps) + 1 / far * steps)  # (B, K)
+
+            out = self._query(model, rays, z_samp, app_pass=app_pass, sb=sb)  # (B, K, 4)
+            inside = out[..., 3] > self.surface_sigma  # (B, K)
+            hit = inside.any(dim=-1)  # (B)
+            idx = torch.argmax(inside.float(), dim=-1, keepdim=True)  # First crossing
+            z_hi = torch.gather(z_samp, -1, idx)  # (B, 1)
+            rgb = torch.gather(out[..., :3], 1, idx.unsqueeze(-1).expand(-1, -1, 3))
+            rgb = rgb[:, 0]  # (B, 3) colour at z_hi
+            out = None
+            z_lo = torch.where(
+                idx > 0, torch.gather(z_samp, -1, torch.clamp_min(idx - 1, 0)), near
+            )
+
+            for _ in range(self.surface_bisect):
+                z_mid = 0.5 * (z_lo + z_hi)
+                out = self._query(model, rays, z_mid, app_pass=app_pass, sb=sb)[:, 0]
+                mid_inside = out[:, 3:] > self.surface_sigma  # (B, 1)
+                z_hi = torch.where(mid_inside, z_mid, z_hi)
+                z_lo = torch.where(mid_inside, z_lo, z_mid)
+                rgb = torch.where(mid_inside, out[:, :3], rgb)
+
+            bg = 1.0 if self.white_bkgd else 0.0
+            rgb = torch.where(hit.unsqueeze(-1), rgb, torch.full_like(rgb, bg))
+            depth = torch.where(hit, z_hi[:, 0], torch.zeros_like(z_hi[:, 0]))
+            if sb > 0:
+                rgb = rgb.reshape(sb, -1, 3)
+                depth = depth.reshape(sb, -1)
+                hit = hit.reshape(sb, -1)
+            return DotMap(rgb=rgb, depth=depth, hit=hit)
+
     def _format_outputs(
-        self, rendered_outputs, superbatch_size, want_weights=False,
+        self, rendered_outputs, superbatch_size, want_weights=False, rays=None, z_samp=None
     ):
         weights, rgb, depth = rendered_outputs
         if superbatch_size > 0:
-            rgb = rgb.reshape(superbatch_size, -1, 3)
-            depth = depth.reshape(superbatch_size, -1)
-            weights = weights.reshape(superbatch_size, -1, weights.shape[-1])
-        ret_dict = DotMap(rgb=rgb, depth=depth)
+            if rgb is not None:
+                rgb = rgb.reshape(superbatch_size, -1, *rgb.shape[1:])
+            depth = depth.reshape(superbatch_size, -1, *depth.shape[1:])
+            weights = weights.reshape(superbatch_size, -1, *weights.shape[1:])
+        ret_dict = DotMap(depth=depth)
+        if rgb is not None:
+            ret_dict.rgb = rgb
         if want_weights:
             ret_dict.weights = weights
+            if z_samp is not None:
+                # Sample i covers [z_i, z_i+1], the last one [z_K, far] (see composite)
+                z_edges = torch.cat((z_samp, rays[:, -1:]), dim=-1)  # (B, K+1)
+                if superbatch_size > 0:
+                    z_edges = z_edges.reshape(superbatch_size, -1, z_edges.shape[-1])
+                ret_dict.z_edges = z_edges
         return ret_dict
 
     def sched_step(self, steps=1):
@@ -349,6 +578,11 @@ class NeRFRenderer(torch.nn.Module):
             lindisp=lindisp,
             eval_batch_size=conf.get_int("eval_batch_size", eval_batch_size),
             sched=conf.get_list("sched", None),
+            use_proposal=conf.get_bool("use_proposal", False),
+            surface=conf.get_bool("surface", False),
+            surface_steps=conf.get_int("surface_steps", 16),
+            surface_bisect=conf.get_int("surface_bisect", 6),
+            surface_sigma=conf.get_float("surface_sigma", 10.0),
         )
 
     def bind_parallel(self, net, gpus=None, simple_output=False):
@@ -0,0 +1,104 @@
+"""
+Reprojection of a source view into a target view through rendered depth,
+used as the guide image for depth-guided upsampling (see upsample.py).
+Cameras follow util.gen_rays: poses are camera -> world, the camera looks down -z.
+"""
+import torch
+import torch.nn.functional as F
+
+
+def project(points, pose, focal, c=None, image_size=None):
+    """
+    Project world space points into a camera
+    :param points (..., 3)
+    :param pose (4, 4) camera -> world
+    :param focal () or (1) or (2) [fx, fy]
+    :param c None or () or (2) principal point, default center of image_size
+    :param image_size (W, H), needed if c is None
+    :return pixel coordinates (..., 2) [x, y], in front of camera mask (...)
+    """
+    rot = pose[:3, :3]
+    cam = torch.matmul(points - pose[:3, 3], rot)  # R^T (p - t)
+    focal = torch.as_tensor(focal, dtype=cam.dtype, device=cam.device).reshape(-1)
+    focal = focal.expand(2)
+    if c is None:
+        c = torch.tensor(image_size, dtype=cam.dtype, device=cam.device) * 0.5
+    c = torch.as_tensor(c, dtype=cam.dtype, device=cam.device).reshape(-1).expand(2)
+    z = cam[..., 2]
+    in_front = z < -1e-6
+    z = torch.where(in_front, z, torch.full_like(z, -1e-6))
+    x = c[0] - focal[0] * cam[..., 0] / z
+    y = c[1] + focal[1] * cam[..., 1] / z
+    return torch.stack((x, y), dim=-1), in_front
+
+
+def reproject_source(image, pose, focal, rays, depth, c=None):
+    """
+    Warp a source image into the target view using target depth.
+    Occlusions in the source view are not detected.
+    :param image (3, Hs, Ws) source image
+    :param pose (4, 4) source camera -> world
+    :param focal, c source intrinsics as in project
+    :param rays (H, W, 8) target rays (util.gen_rays)
+    :param depth (H, W) target depth along the rays
+    :return warped (H, W, 3), valid (H, W) bool
+    """
+    _, Hs, Ws = image.shape
+    points = rays[..., :3] + depth.unsqueeze(-1) * rays[..., 3:6]
+    uv, valid = project(points, pose, focal, c=c, image_size=(Ws, Hs))
+    valid = (
+        valid
+        & (uv[..., 0] >= 0)
+        & (uv[..., 0] <= Ws - 1)
+        & (uv[..., 1] >= 0)
+        & (uv[..., 1] <= Hs - 1)
+    )
+    scale = torch.tensor([2.0 / (Ws - 1), 2.0 / (Hs - 1)], device=uv.device)
+    grid = uv * scale - 1.0
+    warped = F.grid_sample(
+        image[None], grid[None], mode="bilinear", align_corners=True
+    )  # (1, 3, H, W)
+    return warped[0].permute(1, 2, 0), valid
+
+
+def splat_depth(points, pose, focal, width, height, c=None):
+    """
+    Forward-warp world space points into a camera with a z-buffer
+    :param points (N, 3)
+    :param pose (4, 4) camera -> world
+    :param focal, c intrinsics as in project
+    :return (H, W) distance from the camera center of the nearest point per pixel,
+    inf where no point lands
+    """
+    uv, in_front = project(points, pose, focal, c=c, image_size=(width, height))
+    px = torch.round(uv).long()
+    valid = (
+        in_front
+        & (px[:, 0] >= 0)
+        & (px[:, 0] < width)
+        & (px[:, 1] >= 0)
+        & (px[:, 1] < height)
+    )
+    dist = torch.norm(points - pose[:3, 3], dim=-1)
+    idx = px[valid, 1] * width + px[valid, 0]
+    dist = dist[valid]
+    # Z-buffer: sort by distance, then stably by pixel, and keep the first per pixel
+    order = torch.argsort(dist)
+    idx, pix_order = torch.sort(idx[order], stable=True)
+    dist = dist[order][pix_order]
+    first = torch.ones_like(idx, dtype=torch.bool)
+    first[1:] = idx[1:] != idx[:-1]
+    depth = torch.full((height * width,), float("inf"), device=points.device)
+    depth[idx[first]] = dist[first]
+    return depth.reshape(height, width)
+
+
+def fill_holes(depth, iters=1):
+    """
+    Fill one-pixel cracks of a splatted depth map with the nearest neighbour depth
+    :param depth (H, W), inf where empty
+    """
+    for _ in range(iters):
+        neighbor = -F.max_pool2d(-depth[None, None], 3, stride=1, padding=1)[0, 0]
+        depth = torch.where(torch.isinf(depth), neighbor, depth)
+    return depth
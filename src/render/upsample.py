@@ -0,0 +1,121 @@
+"""
+Low-resolution rendering with depth-guided joint bilateral upsampling
+(Kopf et al. 2007). Every factor-th pixel is rendered, the result is
+upsampled with weights from the rendered depth and an optional full-resolution
+guide image (e.g. the source view reprojected by reproject.reproject_source),
+and pixels near depth discontinuities are re-rendered at full resolution.
+"""
+import torch
+
+
+def render_batched(render_par, rays, batch_size):
+    """
+    Render (N, 8) rays with a simple_output render wrapper in batches
+    :return rgb (N, 3), depth (N)
+    """
+    all_rgb, all_depth = [], []
+    for rays_batch in torch.split(rays, batch_size, dim=0):
+        rgb, depth = render_par(rays_batch[None])
+        all_rgb.append(rgb[0])
+        all_depth.append(depth[0])
+    return torch.cat(all_rgb), torch.cat(all_depth)
+
+
+def render_upsampled(
+    render_fn,
+    rays,
+    factor,
+    guide_fn=None,
+    radius=1,
+    sigma_spatial=1.0,
+    sigma_color=0.1,
+    sigma_depth=0.02,
+    depth_thresh=0.05,
+):
+    """
+    :param render_fn (N, 8) rays -> rgb (N, 3), depth (N), see render_batched
+    :param rays (H, W, 8) full resolution rays
+    :param factor render every factor-th pixel in each direction
+    :param guide_fn optional callable depth (H, W) -> guide (H, W, 3), valid (H, W)
+    :param radius low-resolution neighbourhood radius of the filter
+    :param sigma_spatial filter width in low-resolution pixels
+    :param sigma_color guide colour difference scale
+    :param sigma_depth, depth_thresh depth difference scale and the local
+    depth range above which pixels are re-rendered, relative to far - near
+    :return rgb (H, W, 3), depth (H, W), rerendered (H, W) bool
+    """
+    H, W, _ = rays.shape
+    device = rays.device
+    off = factor // 2
+    rays_lo = rays[off::factor, off::factor]  # Exact rays at low-res pixel centers
+    h, w, _ = rays_lo.shape
+    rgb_lo, depth_lo = render_fn(rays_lo.reshape(-1, 8))
+    rgb_lo = rgb_lo.reshape(h, w, 3)
+    depth_lo = depth_lo.reshape(h, w)
+    depth_scale = (rays[..., 7] - rays[..., 6]).mean()
+
+    # Nearest low-res pixel of each full-res pixel
+    li = torch.clamp(
+        torch.round((torch.arange(H, device=device) - off).float() / factor).long(),
+        0,
+        h - 1,
+    )
+    lj = torch.clamp(
+        torch.round((torch.arange(W, device=device) - off).float() / factor).long(),
+        0,
+        w - 1,
+    )
+    LI, LJ = li[:, None].expand(H, W), lj[None, :].expand(H, W)
+    ii = torch.arange(H, device=device, dtype=torch.float32)[:, None].expand(H, W)
+    jj = torch.arange(W, device=device, dtype=torch.float32)[None, :].expand(H, W)
+
+    # Full-res depth estimate from the nearest low-res sample
+    depth_up = depth_lo[LI, LJ]
+    guide = valid = None
+    if guide_fn is not None:
+        guide, valid = guide_fn(depth_up)
+
+    rgb_sum = torch.zeros(H, W, 3, device=device)
+    w_sum = torch.zeros(H, W, device=device)
+    d_min = torch.full((H, W), float("inf"), device=device)
+    d_max = torch.full((H, W), -float("inf"), device=device)
+    for di in range(-radius, radius + 1):
+        for dj in range(-radius, radius + 1):
+            qi = torch.clamp(LI + di, 0, h - 1)
+            qj = torch.clamp(LJ + dj, 0, w - 1)
+            d_q = depth_lo[qi, qj]
+            d_min = torch.min(d_min, d_q)
+            d_max = torch.max(d_max, d_q)
+            # Full-res location of the low-res sample
+            pi, pj = qi * factor + off, qj * factor + off
+            dist2 = (ii - pi.float()) ** 2 + (jj - pj.float()) ** 2
+            weight = torch.exp(-dist2 / (2.0 * (sigma_spatial * factor) ** 2))
+            weight = weight * torch.exp(
+                -((depth_up - d_q) / (sigma_depth * depth_scale)) ** 2 / 2.0
+            )
+            if guide is not None:
+                pi = torch.clamp(pi, max=H - 1)
+                pj = torch.clamp(pj, max=W - 1)
+                diff = ((guide - guide[pi, pj]) ** 2).sum(-1)
+                use = valid & valid[pi, pj]
+                weight = weight * torch.where(
+                    use, torch.exp(-diff / (2.0 * sigma_color ** 2)), torch.ones_like(diff)
+                )
+            rgb_sum += weight.unsqueeze(-1) * rgb_lo[qi, qj]
+            w_sum += weight
+    rgb = rgb_sum / torch.clamp_min(w_sum, 1e-8).unsqueeze(-1)
+    depth = depth_up
+
+    # Re-render pixels at depth discontinuities or without support
+    rerender = ((d_max - d_min) > depth_thresh * depth_scale) | (w_sum < 1e-4)
+    # Low-res samples are exact, keep them
+    exact = torch.zeros(H, W, dtype=torch.bool, device=device)
+    exact[off::factor, off::factor] = True
+    rgb[exact] = rgb_lo.reshape(-1, 3)
+    depth[exact] = depth_lo.reshape(-1)
+    rerender = rerender & ~exact
+    if rerender.any():
+        rgb_hi, depth_hi = render_fn(rays[rerender])
+        rgb[rerender] = rgb_hi
+        depth[rerender] = depth_hi
+    return rgb, depth, rerender
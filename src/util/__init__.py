@@ -1,4 +1,5 @@
 from .util import *
 from . import args
+from . import sampler
 
 #  from . import recon
@@ -0,0 +1,71 @@
+"""
+Batched training-time sampling shared by train/train.py and contrib/train_app.py:
+source view selection, ray pixel selection and gathering of rays and ground truth
+for a whole object batch at once, without a Python loop over the objects.
+"""
+import torch
+from .util import bbox_sample_batched, gen_rays_at
+
+
+def choose_views(SB, NV, num_views, device="cpu"):
+    """
+    Pick num_views distinct source views per object
+    :return (SB, num_views) long
+    """
+    if num_views == 1:
+        return torch.randint(0, NV, (SB, 1), device=device)
+    return torch.rand(SB, NV, device=device).argsort(dim=-1)[:, :num_views]
+
+
+def sample_pixels(SB, NV, H, W, num_pix, bboxes=None, device="cpu"):
+    """
+    Pick ray pixels per object, uniformly over all views or inside the bboxes
+    :param bboxes optional (SB, NV, 4) cmin rmin cmax rmax
+    :return (SB, num_pix, 3) long view, row, col
+    """
+    if bboxes is not None:
+        return bbox_sample_batched(bboxes.to(device=device), num_pix)
+    pix_inds = torch.randint(0, NV * H * W, (SB, num_pix), device=device)
+    return torch.stack(
+        (pix_inds // (H * W), pix_inds // W % H, pix_inds % W), dim=-1
+    )
+
+
+def gather_pixels(images, pix):
+    """
+    :param images (SB, NV, C, H, W)
+    :param pix (SB, R, 3) see sample_pixels
+    :return (SB, R, C)
+    """
+    obj_inds = torch.arange(images.shape[0], device=images.device)[:, None]
+    pix = pix.to(device=images.device)
+    return images[obj_inds, pix[..., 0], :, pix[..., 1], pix[..., 2]]
+
+
+def sample_rays(
+    images, poses, focal, z_near, z_far, num_pix, c=None, bboxes=None
+):
+    """
+    Random training rays and their ground truth colours for an object batch
+    :param images (SB, NV, 3, H, W) in [-1, 1]
+    :param poses (SB, NV, 4, 4)
+    :param focal (SB) or (SB, 2)
+    :param c optional (SB, 2)
+    :param bboxes optional (SB, NV, 4), see sample_pixels
+    :return rays (SB, num_pix, 8), rgb_gt (SB, num_pix, 3) in [0, 1]
+    """
+    SB, NV, _, H, W = images.shape
+    device = poses.device
+    pix = sample_pixels(SB, NV, H, W, num_pix, bboxes=bboxes, device=device)
+    rays = gen_rays_at(
+        poses,
+        pix,
+        W,
+        H,
+        focal.to(device=device),
+        z_near,
+        z_far,
+        c=c.to(device=device) if c is not None else None,
+    )
+    rgb_gt = gather_pixels(images, pix) * 0.5 + 0.5
+    return rays, rgb_gt
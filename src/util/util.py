@@ -7,10 +7,12 @@ from torch import nn
 from torch.nn import init
 import torch.nn.functional as F
 import functools
+import json
 import math
 import warnings
 from random import randint
 from torchvision.transforms.functional_tensor import crop
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 from dotmap import DotMap
 from math import pi
 
@@ -239,6 +241,67 @@ def bbox_sample(bboxes, num_pix):
     return pix
 
 
+def bbox_sample_batched(bboxes, num_pix):
+    """
+    bbox_sample for a batch of objects at once, on the device of bboxes
+    :param bboxes (SB, NV, 4) cmin rmin cmax rmax
+    :return (SB, num_pix, 3) view, row, col
+    """
+    SB, NV, _ = bboxes.shape
+    device = bboxes.device
+    image_ids = torch.randint(0, NV, (SB, num_pix), device=device)
+    pix_bboxes = torch.gather(
+        bboxes, 1, image_ids.unsqueeze(-1).expand(-1, -1, 4)
+    )  # (SB, num_pix, 4)
+    x = (
+        torch.rand(SB, num_pix, device=device)
+        * (pix_bboxes[..., 2] + 1 - pix_bboxes[..., 0])
+        + pix_bboxes[..., 0]
+    ).long()
+    y = (
+        torch.rand(SB, num_pix, device=device)
+        * (pix_bboxes[..., 3] + 1 - pix_bboxes[..., 1])
+        + pix_bboxes[..., 1]
+    ).long()
+    return torch.stack((image_ids, y, x), dim=-1)
+
+
+def gen_rays_at(poses, pix, width, height, focal, z_near, z_far, c=None):
+    """
+    Generate the camera rays of given pixels only; same rays as
+    gen_rays(poses[b], ...)[pix[b, :, 0], pix[b, :, 1], pix[b, :, 2]]
+    :param poses (SB, NV, 4, 4)
+    :param pix (SB, R, 3) long view, row, col
+    :param focal () or (SB) or (SB, 2) [fx, fy]
+    :param c principal point None or (2) or (SB, 2) [cx, cy], default is center of image
+    :return (SB, R, 8)
+    """
+    SB = poses.shape[0]
+    device = poses.device
+    focal = torch.as_tensor(focal, dtype=torch.float32, device=device)
+    if focal.dim() < 2:
+        focal = focal.reshape(-1, 1).expand(-1, 2)
+    focal = focal.reshape(-1, 1, 2).expand(SB, 1, 2)
+    if c is None:
+        c = torch.tensor([width * 0.5, height * 0.5], device=device)
+    c = torch.as_tensor(c, dtype=torch.float32, device=device)
+    c = c.reshape(-1, 1, 2).expand(SB, 1, 2)
+
+    X = (pix[..., 2].float() - c[..., 0]) / focal[..., 0]  # (SB, R)
+    Y = (pix[..., 1].float() - c[..., 1]) / focal[..., 1]
+    unproj = torch.stack((X, -Y, -torch.ones_like(X)), dim=-1)
+    unproj = unproj / torch.norm(unproj, dim=-1, keepdim=True)  # (SB, R, 3)
+
+    pix_poses = torch.gather(
+        poses, 1, pix[..., :1, None].expand(-1, -1, 4, 4)
+    )  # (SB, R, 4, 4)
+    cam_raydir = torch.matmul(pix_poses[..., :3, :3], unproj.unsqueeze(-1))[..., 0]
+    cam_centers = pix_poses[..., :3, 3]
+    cam_nears = torch.full_like(cam_raydir[..., :1], z_near)
+    cam_fars = torch.full_like(cam_raydir[..., :1], z_far)
+    return torch.cat((cam_centers, cam_raydir, cam_nears, cam_fars), dim=-1)
+
+
 def gen_rays(poses, width, height, focal, z_near, z_far, c=None, ndc=False):
     """
     Generate camera rays
@@ -280,6 +343,54 @@ def gen_rays(poses, width, height, focal, z_near, z_far, c=None, ndc=False):
     )  # (B, H, W, 8)
 
 
+def gen_patch_rays(
+    poses, width, height, focal, z_near, z_far, top, left, patch_h, patch_w=None, c=None
+):
+    """
+    Generate camera rays of a window of each image only, without the full ray set
+    :param poses (B, 4, 4)
+    :param top, left window corner (pixels), int or (B) long tensor (one per pose)
+    :param patch_h, patch_w window size; patch_w defaults to patch_h
+    :return (B, patch_h, patch_w, 8), equal to
+    gen_rays(...)[b, top[b]:top[b] + patch_h, left[b]:left[b] + patch_w]
+    """
+    if patch_w is None:
+        patch_w = patch_h
+    num_images = poses.shape[0]
+    device = poses.device
+    if c is None:
+        c = [width * 0.5, height * 0.5]
+    else:
+        c = c.squeeze()
+    if isinstance(focal, float):
+        focal = [focal, focal]
+    else:
+        focal = focal.squeeze()
+        if len(focal.shape) == 0:
+            focal = focal[None].expand(2)
+
+    top = torch.as_tensor(top, device=device).reshape(-1, 1).expand(num_images, 1)
+    left = torch.as_tensor(left, device=device).reshape(-1, 1).expand(num_images, 1)
+    rows = top + torch.arange(patch_h, device=device)  # (B, Ph)
+    cols = left + torch.arange(patch_w, device=device)  # (B, Pw)
+    X = (cols.float() - float(c[0])) / float(focal[0])
+    Y = (rows.float() - float(c[1])) / float(focal[1])
+    X = X[:, None, :].expand(-1, patch_h, -1)
+    Y = Y[:, :, None].expand(-1, -1, patch_w)
+    unproj = torch.stack((X, -Y, -torch.ones_like(X)), dim=-1)  # (B, Ph, Pw, 3)
+    unproj = unproj / torch.norm(unproj, dim=-1, keepdim=True)
+
+    cam_centers = poses[:, None, None, :3, 3].expand(-1, patch_h, patch_w, -1)
+    cam_raydir = torch.matmul(poses[:, None, None, :3, :3], unproj.unsqueeze(-1))[
+        ..., 0
+    ]
+    cam_nears = torch.full_like(cam_raydir[..., :1], z_near)
+    cam_fars = torch.full_like(cam_raydir[..., :1], z_far)
+    return torch.cat(
+        (cam_centers, cam_raydir, cam_nears, cam_fars), dim=-1
+    )  # (B, Ph, Pw, 8)
+
+
 def trans_t(t):
     return torch.tensor(
         [[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, t], [0, 0, 0, 1],], dtype=torch.float32,
@@ -355,6 +466,43 @@ def get_norm_layer(norm_type="instance", group_norm_groups=32):
     return norm_layer
 
 
+def fold_batch_norm(module):
+    """
+    Fold BatchNorm2d layers into the convolution feeding them, in place.
+    Handles (conv, bn) runs inside nn.Sequential (e.g. ResNet downsample,
+    ConvEncoder) and the convN/bnN attribute pairs of torchvision ResNets.
+    Folded norms are replaced by nn.Identity, so the module must be in eval mode
+    and should not be trained afterwards.
+    :param module network to modify
+    :return number of BatchNorm layers folded
+    """
+    assert not module.training, "BatchNorm folding requires eval mode"
+
+    def fuse(conv, bn):
+        return fuse_conv_bn_eval(
+            conv, bn, transpose=isinstance(conv, nn.ConvTranspose2d)
+        )
+
+    n_folded = 0
+    for sub in list(module.modules()):
+        if isinstance(sub, nn.Sequential):
+            for i in range(len(sub) - 1):
+                if isinstance(sub[i], (nn.Conv2d, nn.ConvTranspose2d)) and isinstance(
+                    sub[i + 1], nn.BatchNorm2d
+                ):
+                    sub[i] = fuse(sub[i], sub[i + 1])
+                    sub[i + 1] = nn.Identity()
+                    n_folded += 1
+        for i in range(1, 4):
+            conv = getattr(sub, "conv" + str(i), None)
+            bn = getattr(sub, "bn" + str(i), None)
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                setattr(sub, "conv" + str(i), fuse(conv, bn))
+                setattr(sub, "bn" + str(i), nn.Identity())
+                n_folded += 1
+    return n_folded
+
+
 def make_conv_2d(
     dim_in,
     dim_out,
@@ -485,6 +633,100 @@ def psnr(pred, target):
     return psnr
 
 
+def quantize_uint8(t):
+    """
+    Quantize a feature map to uint8 with a per-channel affine range
+    :param t (N, C, ...) float tensor
+    :return q (N, C, ...) uint8, lo (N, C) float, scale (N, C) float
+    such that t ~= q * scale + lo
+    """
+    flat = t.reshape(*t.shape[:2], -1).float()
+    lo = flat.min(dim=-1)[0]
+    scale = (flat.max(dim=-1)[0] - lo).clamp_min(1e-8) / 255.0
+    view_shape = (*t.shape[:2],) + (1,) * (t.dim() - 2)
+    q = ((t.float() - lo.view(view_shape)) / scale.view(view_shape)).round()
+    return q.clamp_(0, 255).to(torch.uint8), lo, scale
+
+
+def dequantize_uint8(q, lo, scale):
+    """
+    Inverse of quantize_uint8
+    :param q (N, C, ...) uint8
+    :param lo (N, C)
+    :param scale (N, C)
+    :return (N, C, ...) float
+    """
+    view_shape = (*q.shape[:2],) + (1,) * (q.dim() - 2)
+    return q.float() * scale.view(view_shape) + lo.view(view_shape)
+
+
+PACKED_MAGIC = b"PNRFPAK1"
+PACKED_ALIGN = 64
+
+
+def save_packed(path, arrays, meta=None):
+    """
+    Write several numpy arrays to a single memory-mappable file:
+    magic, header length (uint64), JSON header, then the raw arrays,
+    each aligned to PACKED_ALIGN bytes
+    :param arrays dict name -> numpy array
+    :param meta JSON-serializable dict stored in the header
+    """
+    arrays = {k: np.ascontiguousarray(v) for k, v in arrays.items()}
+
+    def align(n):
+        return (n + PACKED_ALIGN - 1) // PACKED_ALIGN * PACKED_ALIGN
+
+    # Offsets depend on the header size, so lay out with a bounded header first
+    entries = {
+        k: {"dtype": v.dtype.str, "shape": list(v.shape), "offset": 0}
+        for k, v in arrays.items()
+    }
+    header_len = len(json.dumps({"arrays": entries, "meta": meta or {}}).encode())
+    header_len += 32 * len(arrays) + 64  # Room for offset digits
+    offset = align(len(PACKED_MAGIC) + 8 + header_len)
+    for k, v in arrays.items():
+        entries[k]["offset"] = offset
+        offset = align(offset + v.nbytes)
+    header = json.dumps({"arrays": entries, "meta": meta or {}}).encode()
+    assert len(header) <= header_len
+    header = header.ljust(header_len)
+
+    with open(path, "wb") as f:
+        f.write(PACKED_MAGIC)
+        f.write(np.uint64(header_len).tobytes())
+        f.write(header)
+        for k, v in arrays.items():
+            f.seek(entries[k]["offset"])
+            f.write(v.tobytes())
+        f.truncate(offset)
+
+
+def load_packed(path, mmap=True):
+    """
+    Read a file written by save_packed
+    :param mmap if true, arrays are read-only memory maps of the file
+    :return dict name -> numpy array, meta dict
+    """
+    with open(path, "rb") as f:
+        assert f.read(len(PACKED_MAGIC)) == PACKED_MAGIC, "Not a packed file: " + path
+        header_len = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(header_len).decode())
+    if mmap:
+        buf = np.memmap(path, dtype=np.uint8, mode="r")
+    else:
+        with open(path, "rb") as f:
+            buf = np.frombuffer(f.read(), dtype=np.uint8)
+    arrays = {}
+    for k, entry in header["arrays"].items():
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"]))
+        arrays[k] = np.frombuffer(
+            buf, dtype=dtype, count=count, offset=entry["offset"]
+        ).reshape(entry["shape"])
+    return arrays, header["meta"]
+
+
 def quat_to_rot(q):
     """
     Quaternion to rotation matrix
@@ -541,6 +783,24 @@ def get_module(net):
     else:
         return net
 
+def split_multi_render_dict(render_dict, n):
+    """
+    Split the output of a multi_app render (see NeRFRenderer.forward) into
+    one render dict per appearance branch
+    :param render_dict render dict (dict or DotMap) whose tensors have the branch dim
+    after the ray dim, e.g. rgb (SB, B, N, 3)
+    :param n number of branches N
+    :return list of N DotMaps, e.g. rgb (SB, B, 3)
+    """
+    render_dict = DotMap(dict(render_dict))
+    out = []
+    for i in range(n):
+        branch = DotMap()
+        for level, vals in render_dict.items():
+            branch[level] = DotMap({k: v[:, :, i] for k, v in vals.items()})
+        out.append(branch)
+    return out
+
 def ssh_normalization(img_tensor):
     return (img_tensor * 2.0) - 1.0 # normalization used for SSH encoder
 
@@ -551,76 +811,24 @@ def get_random_patch(t, Hp, Wp):
 
     return crop(t, i, j, Hp, Wp)
 
-def decompose_to_subpatches(patch, sub_factor):
-    SB = patch.shape[0]
-    HWp = patch.shape[-1] // sub_factor
-
-    subpatches = []
-    for i in range(sub_factor):
-        row = []
-        for j in range(sub_factor):
-            row.append(crop(patch, HWp * i, HWp * j, HWp, HWp).permute(0, 1, 3, 4, 2).reshape(SB, -1, 8))
-        subpatches.append(row)
-    
-    return subpatches
-
-def recompose_subpatch_render_dicts_depth(render_dicts, SB, P, sub_factor):
-    HWp = P // sub_factor
-    coarse = []
-    fine = []
-    for i in range(len(render_dicts[i])):
-        for j in range(len(render_dicts[i])):
-            coarse.append(render_dicts[i][j].coarse.depth.permute(0, 2, 1).reshape(SB, 3, HWp, HWp))
-            fine.append(render_dicts[i][j].fine.depth.permute(0, 2, 1).reshape(SB, 3, HWp, HWp))
-
-    patch_coarse_depth = torch.hstack(coarse)
-    patch_fine_depth = torch.hstack(fine)
-    
-    for i in range(len(1, render_dicts)):
-        coarse = []
-        fine = []
-        for j in range(len(render_dicts[i])):
-            coarse.append(render_dicts[i][j].coarse.depth.permute(0, 2, 1).reshape(SB, 3, HWp, HWp))
-            fine.append(render_dicts[i][j].fine.depth.permute(0, 2, 1).reshape(SB, 3, HWp, HWp))
-
-        patch_coarse_depth = torch.vstack([
-            patch_coarse_depth,
-            torch.hstack(coarse)
-        ])
-        patch_fine_depth = torch.vstack([
-            patch_fine_depth,
-            torch.hstack(coarse)
-        ])
-    
-    return patch_coarse_depth, patch_fine_depth
-
-def recompose_subpatch_render_dicts_rgb(render_dicts, SB, P, sub_factor):
-    HWp = P // sub_factor
-    coarse = []
-    fine = []
-
-    for j in range(len(render_dicts[0])):
-        coarse.append(render_dicts[0][j].coarse.rgb.permute(0, 2, 1).reshape(SB, 3, HWp, HWp))
-        fine.append(render_dicts[0][j].fine.rgb.permute(0, 2, 1).reshape(SB, 3, HWp, HWp))
-
-    patch_coarse_rgb = torch.cat(coarse, dim=3)
-    patch_fine_rgb = torch.cat(fine, dim=3)
-    
-    for i in range(1, len(render_dicts)):
-        coarse = []
-        fine = []
-        for j in range(len(render_dicts[i])):
-            coarse.append(render_dicts[i][j].coarse.rgb.permute(0, 2, 1).reshape(SB, 3, HWp, HWp))
-            fine.append(render_dicts[i][j].fine.rgb.permute(0, 2, 1).reshape(SB, 3, HWp, HWp))
-
-        patch_coarse_rgb = torch.cat(
-            [patch_coarse_rgb, torch.cat(coarse, dim=3)],
-            dim=2)
-        patch_fine_rgb = torch.cat(
-            [patch_fine_rgb, torch.cat(fine, dim=3)],
-            dim=2)
-    
-    return patch_coarse_rgb, patch_fine_rgb
+def patch_to_rays(patch_rays):
+    """
+    Flatten a ray patch to a ray batch in row-major pixel order
+    :param patch_rays (SB, [1,] 8, P, P)
+    :return (SB, P * P, 8)
+    """
+    SB, C = patch_rays.shape[0], patch_rays.shape[-3]
+    return patch_rays.reshape(SB, C, -1).permute(0, 2, 1)
+
+
+def rays_to_patch(t, P):
+    """
+    Inverse of patch_to_rays for rendered values
+    :param t (SB, P * P, C) or (SB, P * P)
+    :return (SB, C, P, P), C = 1 for (SB, P * P) input
+    """
+    SB = t.shape[0]
+    return t.reshape(SB, P, P, -1).permute(0, 3, 1, 2)
 
 def unit_sphere_intersection(rays):
     cam_pos = rays[:, [0, 1, 2]]
@@ -0,0 +1,233 @@
+# Teacher-student distillation of a trained PixelNeRF into a smaller MLP.
+# The student shares the teacher's (frozen) encoder and is trained to match the
+# teacher's per-point (rgb, sigma) at points sampled by NeRFRenderer; no rendering loss.
+#
+# python train/distill.py -n <student expname> -c conf/exp/sn64_student.conf \
+#     --teacher_name sn64 --teacher_conf conf/exp/sn64.conf -D <datadir>
+# Evaluate the student with eval/eval.py -n <student expname> -c <student conf>.
+# tensorboard logs available in logs/<expname>
+
+import sys
+import os
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+import trainlib
+from model import make_model
+from render import NeRFRenderer
+from data import get_split_dataset
+import util
+import numpy as np
+import torch.nn.functional as F
+import torch
+from pyhocon import ConfigFactory
+
+
+def extra_args(parser):
+    parser.add_argument(
+        "--batch_size", "-B", type=int, default=4, help="Object batch size ('SB')"
+    )
+    parser.add_argument(
+        "--nviews",
+        "-V",
+        type=str,
+        default="1",
+        help="Number of source views (multiview); put multiple (space delim) to pick randomly per batch ('NV')",
+    )
+    parser.add_argument(
+        "--teacher_name", type=str, required=True, help="Teacher experiment name"
+    )
+    parser.add_argument(
+        "--teacher_conf", type=str, required=True, help="Teacher config file"
+    )
+    parser.add_argument(
+        "--lambda_sigma",
+        type=float,
+        default=0.1,
+        help="Weight of the sigma loss (on log(1 + sigma)) relative to the rgb loss",
+    )
+    return parser
+
+
+args, conf = util.args.parse_args(extra_args, training=True, default_ray_batch_size=128)
+device = util.get_cuda(args.gpu_id[0])
+
+dset, val_dset, _ = get_split_dataset(args.dataset_format, args.datadir)
+
+teacher_conf = ConfigFactory.parse_file(args.teacher_conf)
+teacher = make_model(teacher_conf["model"]).to(device=device)
+teacher_path = "%s/%s/pixel_nerf_latest" % (args.checkpoints_path, args.teacher_name)
+print("Load teacher", teacher_path)
+teacher.load_state_dict(torch.load(teacher_path, map_location=device))
+teacher.eval()
+for param in teacher.parameters():
+    param.requires_grad_(False)
+
+# Student reuses the teacher's encoder(s), which stay frozen
+net = make_model(conf["model"], stop_encoder_grad=True).to(device=device)
+assert (
+    net.d_latent == teacher.d_latent
+), "Student and teacher must use the same encoder config"
+net.encoder = teacher.encoder
+if net.use_global_encoder:
+    net.global_encoder = teacher.global_encoder
+
+# Teacher's renderer settings decide where points are sampled
+renderer = NeRFRenderer.from_conf(teacher_conf["renderer"], lindisp=dset.lindisp,).to(
+    device=device
+)
+
+nviews = list(map(int, args.nviews.split()))
+
+
+class DistillTrainer(trainlib.Trainer):
+    def __init__(self):
+        super().__init__(net, dset, val_dset, args, conf["train"], device=device)
+        self.z_near = dset.z_near
+        self.z_far = dset.z_far
+
+    def encode(self, src_images, src_poses, focal, c):
+        """
+        Encode with the teacher, then hand the same latents to the student
+        """
+        teacher.eval()
+        teacher.encode(src_images, src_poses, focal, c=c)
+        net.encode(src_images, src_poses, focal, c=c, latents=teacher.encoder.latents)
+
+    def sample_points(self, rays):
+        """
+        Points NeRFRenderer would evaluate for the coarse and fine networks
+        :param rays (SB, B, 8)
+        :return list of (coarse, points (SB, B*K, 3), viewdirs (SB, B*K, 3))
+        """
+        SB = rays.shape[0]
+        rays = rays.reshape(-1, 8)
+        z_coarse = renderer.sample_coarse(rays)  # (SB*B, Kc)
+        z_samps = [(True, z_coarse)]
+        if renderer.using_fine:
+            with torch.no_grad():
+                weights = renderer.composite(teacher, rays, z_coarse, coarse=True, sb=SB)[0]
+            all_samps = [z_coarse]
+            if renderer.n_fine - renderer.n_fine_depth > 0:
+                all_samps.append(renderer.sample_fine(rays, weights))
+            if renderer.n_fine_depth > 0:
+                depth = torch.sum(weights * z_coarse, -1)
+                all_samps.append(renderer.sample_fine_depth(rays, depth))
+            z_samps.append((False, torch.cat(all_samps, dim=-1)))
+
+        samples = []
+        for coarse, z_samp in z_samps:
+            K = z_samp.shape[1]
+            points = rays[:, None, :3] + z_samp.unsqueeze(2) * rays[:, None, 3:6]
+            viewdirs = rays[:, None, 3:6].expand(-1, K, -1)
+            samples.append(
+                (coarse, points.reshape(SB, -1, 3), viewdirs.reshape(SB, -1, 3))
+            )
+        return samples
+
+    def calc_losses(self, data, is_train=True, global_step=0):
+        if "images" not in data:
+            return {}
+        all_images = data["images"].to(device=device)  # (SB, NV, 3, H, W)
+
+        SB, NV, _, H, W = all_images.shape
+        all_poses = data["poses"].to(device=device)  # (SB, NV, 4, 4)
+        all_focals = data["focal"]  # (SB)
+        all_c = data.get("c")  # (SB)
+
+        all_rays = []
+        curr_nviews = nviews[torch.randint(0, len(nviews), ()).item()]
+        image_ord = torch.empty((SB, curr_nviews), dtype=torch.long)
+        for obj_idx in range(SB):
+            poses = all_poses[obj_idx]  # (NV, 4, 4)
+            focal = all_focals[obj_idx]
+            c = None
+            if "c" in data:
+                c = data["c"][obj_idx]
+            image_ord[obj_idx] = torch.from_numpy(
+                np.random.choice(NV, curr_nviews, replace=False)
+            )
+            cam_rays = util.gen_rays(
+                poses, W, H, focal, self.z_near, self.z_far, c=c
+            )  # (NV, H, W, 8)
+            pix_inds = torch.randint(0, NV * H * W, (args.ray_batch_size,))
+            all_rays.append(cam_rays.view(-1, cam_rays.shape[-1])[pix_inds])
+        all_rays = torch.stack(all_rays).to(device=device)  # (SB, ray_batch_size, 8)
+
+        image_ord = image_ord.to(device)
+        src_images = util.batched_index_select_nd(all_images, image_ord)
+        src_poses = util.batched_index_select_nd(all_poses, image_ord)
+        self.encode(
+            src_images,
+            src_poses,
+            all_focals.to(device=device),
+            all_c.to(device=device) if all_c is not None else None,
+        )
+
+        loss_dict = {}
+        loss = 0.0
+        for coarse, points, viewdirs in self.sample_points(all_rays):
+            with torch.no_grad():
+                target = teacher(points, coarse=coarse, viewdirs=viewdirs)
+            out = net(points, coarse=coarse, viewdirs=viewdirs)
+            rgb_loss = F.mse_loss(out[..., :3], target[..., :3])
+            sigma_loss = F.mse_loss(
+                torch.log1p(out[..., 3]), torch.log1p(target[..., 3])
+            )
+            prefix = "c" if coarse else "f"
+            loss_dict[prefix + "rgb"] = rgb_loss.item()
+            loss_dict[prefix + "sigma"] = sigma_loss.item()
+            loss = loss + rgb_loss + args.lambda_sigma * sigma_loss
+
+        if is_train:
+            loss.backward()
+        loss_dict["t"] = loss.item()
+        return loss_dict
+
+    def train_step(self, data, global_step):
+        return self.calc_losses(data, is_train=True, global_step=global_step)
+
+    def eval_step(self, data, global_step):
+        renderer.eval()
+        losses = self.calc_losses(data, is_train=False, global_step=global_step)
+        renderer.train()
+        return losses
+
+    def vis_step(self, data, global_step):
+        if "images" not in data:
+            return {}
+        batch_idx = np.random.randint(0, data["images"].shape[0])
+        images = data["images"][batch_idx].to(device=device)  # (NV, 3, H, W)
+        poses = data["poses"][batch_idx].to(device=device)  # (NV, 4, 4)
+        focal = data["focal"][batch_idx : batch_idx + 1].to(device=device)  # (1)
+        c = data.get("c")
+        if c is not None:
+            c = c[batch_idx : batch_idx + 1].to(device=device)  # (1)
+        NV, _, H, W = images.shape
+
+        views = np.random.choice(NV, nviews[0] + 1, replace=False)
+        views_src, view_dest = torch.from_numpy(views[:-1]), views[-1]
+        renderer.eval()
+        with torch.no_grad():
+            self.encode(
+                images[views_src].unsqueeze(0), poses[views_src].unsqueeze(0), focal, c
+            )
+            rays = util.gen_rays(
+                poses[view_dest : view_dest + 1], W, H, focal, self.z_near, self.z_far, c=c
+            ).reshape(1, H * W, -1)
+            vis_list = [images[view_dest].permute(1, 2, 0).cpu().numpy() * 0.5 + 0.5]
+            vals = {}
+            for name, model in [("teacher", teacher), ("student", net)]:
+                rgb, _depth = renderer.bind_parallel(model, simple_output=True)(rays)
+                rgb = rgb[0].clamp(0.0, 1.0).cpu().numpy().reshape(H, W, 3)
+                vals["psnr_" + name] = util.psnr(rgb, vis_list[0])
+                vis_list.append(rgb)
+        print("psnr teacher {} student {}".format(vals["psnr_teacher"], vals["psnr_student"]))
+        renderer.train()
+        return np.hstack(vis_list), vals
+
+
+trainer = DistillTrainer()
+trainer.start()
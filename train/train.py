@@ -12,7 +12,7 @@ import warnings
 import trainlib
 from model import make_model, loss
 from render import NeRFRenderer
-from data import get_split_dataset
+from data import get_split_dataset, LatentCache, RaySampleDataset
 import util
 import numpy as np
 import torch.nn.functional as F
@@ -44,6 +44,18 @@ def extra_args(parser):
         default=100000,
         help="Step to stop using bbox sampling",
     )
+    parser.add_argument(
+        "--latent_cache",
+        type=str,
+        default=None,
+        help="Directory of precomputed encoder latents (scripts/precompute_latents.py); requires --freeze_enc",
+    )
+    parser.add_argument(
+        "--worker_rays",
+        action="store_true",
+        default=None,
+        help="Sample source views, training rays and GT colours in the DataLoader workers",
+    )
     parser.add_argument(
         "--fixed_test",
         action="store_true",
@@ -61,12 +73,31 @@ print(
     "dset z_near {}, z_far {}, lindisp {}".format(dset.z_near, dset.z_far, dset.lindisp)
 )
 
+nviews = list(map(int, args.nviews.split()))
+
+if args.worker_rays:
+    # Workers sample max(nviews) source views; calc_losses takes a prefix
+    dset = RaySampleDataset(
+        dset, args.ray_batch_size, max(nviews), use_bbox=args.no_bbox_step > 0
+    )
+
 net = make_model(conf["model"]).to(device=device)
 net.stop_encoder_grad = args.freeze_enc
 if args.freeze_enc:
     print("Encoder frozen")
     net.encoder.eval()
 
+latent_caches = {}
+if args.latent_cache is not None:
+    assert args.freeze_enc, "--latent_cache requires --freeze_enc"
+    if args.dataset_format == "dvr_dtu":
+        warnings.warn("Cached latents are computed without color jitter")
+    for split in ["train", "val"]:
+        split_dir = os.path.join(args.latent_cache, split)
+        if os.path.exists(split_dir):
+            latent_caches[split] = LatentCache(split_dir)
+    assert "train" in latent_caches, "No train split in " + args.latent_cache
+
 renderer = NeRFRenderer.from_conf(conf["renderer"], lindisp=dset.lindisp,).to(
     device=device
 )
@@ -74,8 +105,6 @@ renderer = NeRFRenderer.from_conf(conf["renderer"], lindisp=dset.lindisp,).to(
 # Parallize
 render_par = renderer.bind_parallel(net, args.gpu_id).eval()
 
-nviews = list(map(int, args.nviews.split()))
-
 
 class PixelNeRFTrainer(trainlib.Trainer):
     def __init__(self):
@@ -96,6 +125,10 @@ class PixelNeRFTrainer(trainlib.Trainer):
             print("using fine loss")
             fine_loss_conf = conf["loss.rgb_fine"]
         self.rgb_fine_crit = loss.get_rgb_loss(fine_loss_conf, False)
+        if renderer.use_proposal:
+            self.lambda_proposal = conf.get_float("loss.lambda_proposal", 1.0)
+            print("lambda proposal {}".format(self.lambda_proposal))
+            self.proposal_crit = loss.ProposalLoss()
 
         if args.resume:
             if os.path.exists(self.renderer_state_path):
@@ -115,85 +148,70 @@ class PixelNeRFTrainer(trainlib.Trainer):
         torch.save(renderer.state_dict(), self.renderer_state_path)
 
     def calc_losses(self, data, is_train=True, global_step=0):
-        if "images" not in data:
+        if "images" not in data and "rays" not in data:
             return {}
-        all_images = data["images"].to(device=device)  # (SB, NV, 3, H, W)
-
-        SB, NV, _, H, W = all_images.shape
-        all_poses = data["poses"].to(device=device)  # (SB, NV, 4, 4)
-        all_bboxes = data.get("bbox")  # (SB, NV, 4)  cmin rmin cmax rmax
         all_focals = data["focal"]  # (SB)
         all_c = data.get("c")  # (SB)
 
         if self.use_bbox and global_step >= args.no_bbox_step:
             self.use_bbox = False
+            if isinstance(self.train_dataset, RaySampleDataset):
+                # Applies from the next epoch, when the workers are restarted
+                self.train_dataset.use_bbox = False
             print(">>> Stopped using bbox sampling @ iter", global_step)
 
-        if not is_train or not self.use_bbox:
-            all_bboxes = None
-
-        all_rgb_gt = []
-        all_rays = []
-
         curr_nviews = nviews[torch.randint(0, len(nviews), ()).item()]
-        if curr_nviews == 1:
-            image_ord = torch.randint(0, NV, (SB, 1))
-        else:
-            image_ord = torch.empty((SB, curr_nviews), dtype=torch.long)
-        for obj_idx in range(SB):
-            if all_bboxes is not None:
-                bboxes = all_bboxes[obj_idx]
-            images = all_images[obj_idx]  # (NV, 3, H, W)
-            poses = all_poses[obj_idx]  # (NV, 4, 4)
-            focal = all_focals[obj_idx]
-            c = None
-            if "c" in data:
-                c = data["c"][obj_idx]
-            if curr_nviews > 1:
-                # Somewhat inefficient, don't know better way
-                image_ord[obj_idx] = torch.from_numpy(
-                    np.random.choice(NV, curr_nviews, replace=False)
-                )
-            images_0to1 = images * 0.5 + 0.5
-
-            cam_rays = util.gen_rays(
-                poses, W, H, focal, self.z_near, self.z_far, c=c
-            )  # (NV, H, W, 8)
-            rgb_gt_all = images_0to1
-            rgb_gt_all = (
-                rgb_gt_all.permute(0, 2, 3, 1).contiguous().reshape(-1, 3)
-            )  # (NV, H, W, 3)
-
-            if all_bboxes is not None:
-                pix = util.bbox_sample(bboxes, args.ray_batch_size)
-                pix_inds = pix[..., 0] * H * W + pix[..., 1] * W + pix[..., 2]
-            else:
-                pix_inds = torch.randint(0, NV * H * W, (args.ray_batch_size,))
-
-            rgb_gt = rgb_gt_all[pix_inds]  # (ray_batch_size, 3)
-            rays = cam_rays.view(-1, cam_rays.shape[-1])[pix_inds].to(
-                device=device
-            )  # (ray_batch_size, 8)
-
-            all_rgb_gt.append(rgb_gt)
-            all_rays.append(rays)
-
-        all_rgb_gt = torch.stack(all_rgb_gt)  # (SB, ray_batch_size, 3)
-        all_rays = torch.stack(all_rays)  # (SB, ray_batch_size, 8)
 
-        image_ord = image_ord.to(device)
-        src_images = util.batched_index_select_nd(
-            all_images, image_ord
-        )  # (SB, NS, 3, H, W)
-        src_poses = util.batched_index_select_nd(all_poses, image_ord)  # (SB, NS, 4, 4)
-
-        all_bboxes = all_poses = all_images = None
+        if "rays" in data:
+            # Sampled in the DataLoader workers by RaySampleDataset
+            all_rays = data["rays"].to(device=device)  # (SB, ray_batch_size, 8)
+            all_rgb_gt = data["rgb_gt"].to(device=device)  # (SB, ray_batch_size, 3)
+            image_ord = data["src_inds"][:, :curr_nviews].to(device=device)
+            src_images = data["src_images"][:, :curr_nviews].to(device=device)
+            src_poses = data["src_poses"][:, :curr_nviews].to(device=device)
+        else:
+            all_images = data["images"].to(device=device)  # (SB, NV, 3, H, W)
+
+            SB, NV, _, H, W = all_images.shape
+            all_poses = data["poses"].to(device=device)  # (SB, NV, 4, 4)
+            all_bboxes = data.get("bbox")  # (SB, NV, 4)  cmin rmin cmax rmax
+
+            if not is_train or not self.use_bbox:
+                all_bboxes = None
+
+            image_ord = util.sampler.choose_views(SB, NV, curr_nviews, device=device)
+
+            all_rays, all_rgb_gt = util.sampler.sample_rays(
+                all_images,
+                all_poses,
+                all_focals,
+                self.z_near,
+                self.z_far,
+                args.ray_batch_size,
+                c=all_c,
+                bboxes=all_bboxes,
+            )  # (SB, ray_batch_size, 8), (SB, ray_batch_size, 3)
+
+            src_images = util.batched_index_select_nd(
+                all_images, image_ord
+            )  # (SB, NS, 3, H, W)
+            src_poses = util.batched_index_select_nd(
+                all_poses, image_ord
+            )  # (SB, NS, 4, 4)
+
+            all_bboxes = all_poses = all_images = None
+
+        latent_cache = latent_caches.get("train" if is_train else "val")
+        latents = None
+        if latent_cache is not None:
+            latents = latent_cache.get(data["img_id"], image_ord, device=device)
 
         net.encode(
             src_images,
             src_poses,
             all_focals.to(device=device),
             c=all_c.to(device=device) if all_c is not None else None,
+            latents=latents,
         )
 
         render_dict = DotMap(render_par(all_rays, want_weights=True,))
@@ -203,12 +221,23 @@ class PixelNeRFTrainer(trainlib.Trainer):
 
         loss_dict = {}
 
-        rgb_loss = self.rgb_coarse_crit(coarse.rgb, all_rgb_gt)
-        loss_dict["rc"] = rgb_loss.item() * self.lambda_coarse
-        if using_fine:
-            fine_loss = self.rgb_fine_crit(fine.rgb, all_rgb_gt)
-            rgb_loss = rgb_loss * self.lambda_coarse + fine_loss * self.lambda_fine
-            loss_dict["rf"] = fine_loss.item() * self.lambda_fine
+        if renderer.use_proposal:
+            # No coarse NeRF; the proposal MLP is trained to bound the fine weights
+            proposal = render_dict.proposal
+            rgb_loss = self.rgb_fine_crit(fine.rgb, all_rgb_gt) * self.lambda_fine
+            loss_dict["rf"] = rgb_loss.item()
+            prop_loss = self.proposal_crit(
+                fine.z_edges, fine.weights, proposal.z_edges, proposal.weights
+            )
+            rgb_loss = rgb_loss + prop_loss * self.lambda_proposal
+            loss_dict["prop"] = prop_loss.item() * self.lambda_proposal
+        else:
+            rgb_loss = self.rgb_coarse_crit(coarse.rgb, all_rgb_gt)
+            loss_dict["rc"] = rgb_loss.item() * self.lambda_coarse
+            if using_fine:
+                fine_loss = self.rgb_fine_crit(fine.rgb, all_rgb_gt)
+                rgb_loss = rgb_loss * self.lambda_coarse + fine_loss * self.lambda_fine
+                loss_dict["rf"] = fine_loss.item() * self.lambda_fine
 
         loss = rgb_loss
         if is_train:
@@ -267,11 +296,19 @@ class PixelNeRFTrainer(trainlib.Trainer):
         with torch.no_grad():
             test_rays = cam_rays[view_dest]  # (H, W, 8)
             test_images = images[views_src]  # (NS, 3, H, W)
+            latents = None
+            if "val" in latent_caches:
+                latents = latent_caches["val"].get(
+                    data["img_id"][batch_idx : batch_idx + 1],
+                    views_src[None],
+                    device=device,
+                )
             net.encode(
                 test_images.unsqueeze(0),
                 poses[views_src].unsqueeze(0),
                 focal.to(device=device),
                 c=c.to(device=device) if c is not None else None,
+                latents=latents,
             )
             test_rays = test_rays.reshape(1, H * W, -1)
             render_dict = DotMap(render_par(test_rays, want_weights=True))
@@ -280,6 +317,11 @@ class PixelNeRFTrainer(trainlib.Trainer):
 
             using_fine = len(fine) > 0
 
+            if renderer.use_proposal:
+                # Show proposal alpha and depth (no rgb) in the coarse row
+                coarse = render_dict.proposal
+                coarse.rgb = torch.zeros_like(test_rays[..., :3])
+
             alpha_coarse_np = coarse.weights[0].sum(dim=-1).cpu().numpy().reshape(H, W)
             rgb_coarse_np = coarse.rgb[0].cpu().numpy().reshape(H, W, 3)
             depth_coarse_np = coarse.depth[0].cpu().numpy().reshape(H, W)
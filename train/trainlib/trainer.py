@@ -46,7 +46,7 @@ class Trainer:
         os.makedirs(self.summary_path, exist_ok=True)
 
         # Currently only Adam supported
-        self.optim = torch.optim.Adam(net.parameters(), lr=args.lr)
+        self.optim = torch.optim.Adam(self.param_groups(net, args.lr), lr=args.lr)
         if args.gamma != 1.0:
             self.lr_scheduler = torch.optim.lr_scheduler.ExponentialLR(
                 optimizer=self.optim, gamma=args.gamma
@@ -123,6 +123,30 @@ class Trainer:
         """
         raise NotImplementedError()
 
+    @staticmethod
+    def param_groups(net, lr):
+        """
+        Optimizer parameter groups; parameters of submodules defining lr_factor
+        (e.g. HashGridEncoding) get their own group with lr * lr_factor
+        """
+        scaled = {}
+        for module in net.modules():
+            lr_factor = getattr(module, "lr_factor", 1.0)
+            if lr_factor != 1.0:
+                for param in module.parameters():
+                    scaled[id(param)] = lr_factor
+        groups = [{"params": [p for p in net.parameters() if id(p) not in scaled]}]
+        for lr_factor in sorted(set(scaled.values())):
+            groups.append(
+                {
+                    "params": [
+                        p for p in net.parameters() if scaled.get(id(p)) == lr_factor
+                    ],
+                    "lr": lr * lr_factor,
+                }
+            )
+        return groups
+
     def eval_step(self, data, global_step):
         """
         Evaluation step